@@ -0,0 +1,230 @@
+# Picks the number of torch threads, data loader workers and batch size giving the fastest training steps, and writes them as an overlay config
+import torch
+import numpy as np
+import pandas as pd
+import multiprocessing
+import configparser
+import resource
+import tempfile
+import shutil
+import time
+import os
+from models import PretrainedModel, Model
+from data import read_config, get_ASR_datasets, get_SLU_datasets
+from benchmark import synthetic_config, write_synthetic_asr_data, write_synthetic_slu_data
+import argparse
+
+def powers_of_two(maximum, minimum=1):
+	values = []
+	value = minimum
+	while value < maximum:
+		values.append(value)
+		value *= 2
+	return values + [maximum]
+
+def parse_list(values, default):
+	if values == "": return default
+	return [int(value) for value in values.split(",")]
+
+def private_memory_mb(pid):
+	"""
+	Memory used only by process pid (Private_Clean + Private_Dirty of /proc/<pid>/smaps_rollup), or None if it cannot be read.
+	Unlike the RSS, this leaves out the pages shared copy-on-write with the parent (the model, the dataset, torch).
+	"""
+	try:
+		with open("/proc/%d/smaps_rollup" % pid, "r") as f:
+			lines = f.readlines()
+	except OSError:
+		return None
+	return sum(int(line.split()[1]) for line in lines if line.startswith(("Private_Clean:", "Private_Dirty:"))) / 1024 # kB
+
+def workers_memory_mb(loader):
+	"""
+	Private memory of the running workers of loader (see private_memory_mb), or None if it cannot be measured.
+	"""
+	iterator = getattr(loader, "_iterator", None) # persistent workers keep their iterator
+	workers = getattr(iterator, "_workers", [])
+	if len(workers) == 0: return None
+	memory = [private_memory_mb(worker.pid) for worker in workers]
+	if any(value is None for value in memory): return None
+	return sum(memory)
+
+def peak_memory_mb(num_workers, is_cuda, workers_mb=None):
+	"""
+	Peak memory of the current process (device memory on the GPU), plus that of the data loader workers:
+	workers_mb (their peak private memory, measured while they run) if given, otherwise num_workers times
+	the largest RSS of the finished child processes (which overestimates it, since it counts the pages shared with this process).
+	"""
+	if is_cuda: return torch.cuda.max_memory_allocated() / 2**20
+	own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+	if workers_mb is not None: return own + workers_mb
+	workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+	return own + num_workers * workers
+
+def run_trial(config, mode, dataset, batch_size, num_workers, num_threads, steps, warmup):
+	"""
+	mode : "pretrain" (PretrainedModel on an ASRDataset) or "train" (Model on an SLUDataset)
+
+	Runs warmup + steps training steps (forward, backward and optimizer step, with batches from a
+	data loader with num_workers workers), cycling over the dataset if needed.
+
+	Returns the samples/s and audio-seconds/s of the timed steps, and the peak memory in MB.
+	"""
+	torch.set_num_threads(num_threads)
+	torch.manual_seed(config.seed)
+	model = PretrainedModel(config) if mode == "pretrain" else Model(config, lazy_pretrained=True) # the trial does not need the pre-trained weights
+	if model.is_cuda: model.cuda()
+	model.train()
+	optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+	loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True, collate_fn=dataset.loader.collate_fn, persistent_workers=(num_workers > 0))
+
+	num_samples = 0
+	audio_seconds = 0
+	workers_mb = None
+	step = 0
+	while step < warmup + steps:
+		for batch in loader:
+			if step == warmup:
+				if model.is_cuda: torch.cuda.synchronize()
+				start = time.perf_counter()
+			x = batch[0]
+			targets = batch[1:] if mode == "pretrain" else batch[2:]
+			if model.is_cuda:
+				x = x.cuda(); targets = [y.cuda() for y in targets]
+			if mode == "pretrain":
+				phoneme_loss, word_loss, _, _ = model(x, *targets)
+				if config.pretraining_type == 1: loss = phoneme_loss
+				if config.pretraining_type == 2: loss = phoneme_loss + word_loss
+				if config.pretraining_type == 3: loss = word_loss
+			else:
+				loss, _ = model(x, *targets)
+			optimizer.zero_grad()
+			loss.backward()
+			optimizer.step()
+			if step >= warmup:
+				num_samples += x.shape[0]
+				audio_seconds += x.shape[0] * x.shape[1] / config.fs
+			step += 1
+			if step == warmup + steps: break
+		if num_workers > 0 and not model.is_cuda: # sampled once per pass, while the workers are alive
+			memory = workers_memory_mb(loader)
+			if memory is not None: workers_mb = max(memory, workers_mb or 0)
+	if model.is_cuda: torch.cuda.synchronize()
+	elapsed = time.perf_counter() - start
+	del loader # stops the workers, so that their RSS is counted if their private memory could not be read
+	return num_samples / elapsed, audio_seconds / elapsed, peak_memory_mb(num_workers, model.is_cuda, workers_mb)
+
+def trial_process(conn, *args):
+	try:
+		conn.send(run_trial(*args))
+	except Exception as e:
+		conn.send(e)
+	conn.close()
+
+def isolated_trial(args, timeout):
+	"""
+	Runs run_trial(*args) in a forked process, so that each trial starts from the same state and its peak memory
+	is measured separately. Raises an exception if the trial fails or takes longer than timeout seconds.
+	"""
+	context = multiprocessing.get_context("fork")
+	parent_conn, child_conn = context.Pipe()
+	process = context.Process(target=trial_process, args=(child_conn,) + tuple(args))
+	process.start()
+	if not parent_conn.poll(timeout):
+		process.kill(); process.join()
+		raise TimeoutError("timed out after %gs" % timeout)
+	result = parent_conn.recv()
+	process.join()
+	if isinstance(result, Exception): raise result
+	return result
+
+def write_overlay(path, mode, num_threads, num_workers, batch_size):
+	overlay = configparser.ConfigParser()
+	overlay["training"] = {"num_threads": str(num_threads), "num_workers": str(num_workers)}
+	if mode == "pretrain":
+		overlay["pretraining"] = {"pretraining_batch_size": str(batch_size)}
+	else:
+		overlay["training"]["training_batch_size"] = str(batch_size)
+	with open(path, "w") as f:
+		overlay.write(f)
+
+if __name__ == '__main__':
+	# Get args
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config_path', type=str, required=True, help='path to config file with hyperparameters, etc.')
+	parser.add_argument('--mode', choices=['pretrain', 'train'], default='train', help='tune ASR pre-training or SLU training steps')
+	parser.add_argument('--resplit_style', default='original', choices=['original','random', 'utterance_closed', "speaker_or_utterance_closed", "mutually_closed"], help='splits to train on (train mode)')
+	parser.add_argument('--synthetic', action='store_true', help='time the steps on synthetic data instead of the datasets of the config file')
+	parser.add_argument('--num_threads', type=str, default="", help='comma-separated numbers of torch threads to try (default: powers of two up to the number of cores)')
+	parser.add_argument('--num_workers', type=str, default="", help='comma-separated numbers of data loader workers to try (default: 0 and powers of two up to the number of cores)')
+	parser.add_argument('--batch_sizes', type=str, default="", help='comma-separated batch sizes to try (default: half, once and twice the one in the config file)')
+	parser.add_argument('--steps', type=int, default=10, help='number of timed training steps per trial')
+	parser.add_argument('--warmup', type=int, default=2, help='number of training steps before timing')
+	parser.add_argument('--memory_limit_mb', type=float, default=0, help='ignore the settings whose peak memory (device memory on the GPU) is above this (0: no limit)')
+	parser.add_argument('--timeout', type=float, default=600, help='seconds before a trial is abandoned')
+	parser.add_argument('--table_path', type=str, default="autotune.csv", help='path to save the results of all trials')
+	parser.add_argument('--overlay_path', type=str, default=None, help='path to save the best settings (default: <config>_autotune.cfg); pass it to main.py with --overlay_path')
+	args = parser.parse_args()
+
+	# Read config file
+	config = read_config(args.config_path)
+	torch.manual_seed(config.seed); np.random.seed(config.seed)
+
+	# Generate datasets
+	root = None
+	if args.synthetic:
+		root = tempfile.mkdtemp(prefix="slu_autotune_")
+		rng = np.random.default_rng(0)
+		config = synthetic_config(args.config_path, root)
+		if args.mode == "pretrain":
+			write_synthetic_asr_data(config, 4 * config.pretraining_batch_size, 3.0, rng)
+		else:
+			write_synthetic_slu_data(config, 4 * config.training_batch_size, 3.0, rng, data_str=f"{args.resplit_style}_splits")
+	try:
+		if args.mode == "pretrain":
+			dataset, _, _ = get_ASR_datasets(config)
+			batch_size = config.pretraining_batch_size
+		else:
+			cwd = os.getcwd()
+			if root is not None: os.chdir(root) # get_SLU_datasets writes intent_mapping.json to the working directory
+			dataset = get_SLU_datasets(config, data_str=f"{args.resplit_style}_splits", split_style=args.resplit_style)[0]
+			os.chdir(cwd)
+			batch_size = config.training_batch_size
+
+		num_cores = multiprocessing.cpu_count()
+		thread_options = parse_list(args.num_threads, powers_of_two(num_cores))
+		worker_options = parse_list(args.num_workers, [0] + powers_of_two(num_cores))
+		batch_options = parse_list(args.batch_sizes, sorted(set([max(1, batch_size // 2), batch_size, 2 * batch_size])))
+
+		rows = []
+		for num_threads in thread_options:
+			for num_workers in worker_options:
+				for trial_batch_size in batch_options:
+					row = {"num_threads": num_threads, "num_workers": num_workers, "batch_size": trial_batch_size}
+					try:
+						row["samples_per_s"], row["audio_s_per_s"], row["peak_memory_mb"] = isolated_trial((config, args.mode, dataset, trial_batch_size, num_workers, num_threads, args.steps, args.warmup), args.timeout)
+						row["feasible"] = args.memory_limit_mb <= 0 or row["peak_memory_mb"] <= args.memory_limit_mb
+					except Exception as e:
+						print("trial failed: " + str(e))
+						row["feasible"] = False
+					print(row)
+					rows.append(row)
+	finally:
+		if root is not None: shutil.rmtree(root, ignore_errors=True)
+
+	table = pd.DataFrame(rows)
+	table.to_csv(args.table_path, index=False)
+	feasible = table[table.feasible]
+	if len(feasible) == 0:
+		print("No setting ran within the memory limit")
+		exit(1)
+	best = feasible.loc[feasible.samples_per_s.idxmax()]
+	print("========= Fastest setting =========")
+	print(best.to_string())
+
+	overlay_path = args.overlay_path
+	if overlay_path is None: overlay_path = os.path.splitext(args.config_path)[0] + "_autotune.cfg"
+	write_overlay(overlay_path, args.mode, int(best.num_threads), int(best.num_workers), int(best.batch_size))
+	print("Saved to " + overlay_path + "; use it with: python main.py --config_path=" + args.config_path + " --overlay_path=" + overlay_path + " ...")
+	if int(best.batch_size) != batch_size:
+		print("Note: the batch size changed from %d to %d; the learning rate may need to be adjusted" % (batch_size, int(best.batch_size)))
@@ -0,0 +1,265 @@
+# Benchmarks of the data, model and decoding paths on synthetic data (no dataset needed)
+import torch
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import textgrid
+import configparser
+import tempfile
+import platform
+import shutil
+import time
+import json
+import os
+import argparse
+from models import PretrainedModel, Model
+from data import read_config, get_ASR_datasets, get_SLU_datasets, CollateWavsASR, CollateWavsSLU
+
+# used if the experiment folder has no phonemes.txt
+DEFAULT_PHONEMES = ["AA", "AE", "AH", "AO", "AW", "AY", "B", "CH", "D", "DH", "EH", "ER", "EY", "F", "G", "HH", "IH", "IY", "JH", "K", "L", "M", "N", "NG", "OW", "OY", "P", "R", "S", "SH", "T", "TH", "UH", "UW", "V", "W", "Y", "Z", "ZH", "sil", "sp", "spn"]
+
+def synthetic_config(config_path, root):
+	"""
+	Copies the config file to root, pointing the experiment folder, slu_path and asr_path into root,
+	and copies the phoneme and word lists of the experiment (if any).
+
+	Returns the Config object.
+	"""
+	parser = configparser.ConfigParser()
+	parser.read(config_path)
+	original_folder = parser["experiment"]["folder"]
+	parser["experiment"]["folder"] = os.path.join(root, "experiment")
+	parser["pretraining"]["asr_path"] = os.path.join(root, "asr")
+	parser["training"]["slu_path"] = os.path.join(root, "slu")
+	parser["training"]["train_wording_path"] = "None"
+	parser["training"]["test_wording_path"] = "None"
+	synthetic_config_path = os.path.join(root, "benchmark.cfg")
+	with open(synthetic_config_path, "w") as f:
+		parser.write(f)
+	config = read_config(synthetic_config_path)
+
+	for filename in ["phonemes.txt", "words.txt"]:
+		path = os.path.join(original_folder, "pretraining", filename)
+		if os.path.isfile(path): shutil.copy(path, os.path.join(config.folder, "pretraining", filename))
+	return config
+
+def read_list(config, filename, default):
+	path = os.path.join(config.folder, "pretraining", filename)
+	if not os.path.isfile(path): return default
+	with open(path, "r") as f:
+		return [line.rstrip("\n") for line in f.readlines() if line.rstrip("\n") != ""]
+
+def write_synthetic_asr_data(config, num_utterances, seconds, rng):
+	"""
+	Writes wavs and TextGrids (phone and word alignments) laid out like LibriSpeech under config.asr_path.
+	"""
+	phonemes = read_list(config, "phonemes.txt", DEFAULT_PHONEMES)
+	words = read_list(config, "words.txt", ["word%d" % idx for idx in range(config.vocabulary_size)])
+	for split in ["train-clean-100", "dev-clean", "test-clean"]:
+		for idx in range(num_utterances):
+			duration = seconds * rng.uniform(0.5, 1.5)
+			tg = textgrid.TextGrid(minTime=0., maxTime=duration)
+			for tier_name, symbols, interval in [("words", words, 0.4), ("phones", phonemes, 0.08)]:
+				tier = textgrid.IntervalTier(name=tier_name, minTime=0., maxTime=duration)
+				boundaries = list(np.arange(0., duration, interval)) + [duration]
+				for start, end in zip(boundaries[:-1], boundaries[1:]):
+					tier.add(start, end, symbols[rng.integers(len(symbols))])
+				tg.append(tier)
+			textgrid_path = os.path.join(config.asr_path, "text", split, "spk%d" % (idx % 4), "0", "utt%d.TextGrid" % idx)
+			wav_path = textgrid_path.replace("text", "audio").replace(".TextGrid", ".wav")
+			for path in [textgrid_path, wav_path]:
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(textgrid_path, "w") as f:
+				tg.write(f)
+			sf.write(wav_path, 0.1 * rng.standard_normal(int(duration * config.fs)), config.fs)
+
+def write_synthetic_slu_data(config, num_utterances, seconds, rng, data_str="original_splits"):
+	"""
+	Writes wavs and the split CSVs of the FSC layout (or the seq2seq CSVs) under config.slu_path.
+	"""
+	words = read_list(config, "words.txt", ["word%d" % idx for idx in range(config.vocabulary_size)])
+	os.makedirs(os.path.join(config.slu_path, "data", data_str), exist_ok=True)
+	split_paths = {
+		"synthetic": os.path.join("data", "synthetic_data.csv"),
+		"train": os.path.join("data", data_str, "train_data.csv"),
+		"valid": os.path.join("data", data_str, "valid_data.csv"),
+		"test": os.path.join("data", data_str, "test_data.csv"),
+	}
+	if config.seq2seq:
+		split_paths = {split: os.path.join("data", split + "_data_seq2seq.csv") for split in split_paths}
+	for split, split_path in split_paths.items():
+		rows = []
+		for idx in range(num_utterances):
+			wav_path = os.path.join("wavs", split, "utt%d.wav" % idx)
+			os.makedirs(os.path.dirname(os.path.join(config.slu_path, wav_path)), exist_ok=True)
+			sf.write(os.path.join(config.slu_path, wav_path), 0.1 * rng.standard_normal(int(seconds * rng.uniform(0.5, 1.5) * config.fs)), config.fs)
+			row = {"path": wav_path, "speakerId": "spk%d" % (idx % 4), "transcription": " ".join(words[rng.integers(len(words))] for _ in range(5))}
+			intent = {slot: "%s%d" % (slot, rng.integers(3)) for slot in config.slots}
+			if config.seq2seq:
+				row["semantics"] = json.dumps(intent)
+			else:
+				row.update(intent)
+			rows.append(row)
+		pd.DataFrame(rows).to_csv(os.path.join(config.slu_path, split_path), index=False)
+
+def throughput(fn, num_items, repeats=3):
+	"""
+	Runs fn (which processes num_items items) once to warm up, then repeats times.
+
+	Returns the number of items per second of the fastest run.
+	"""
+	fn()
+	times = []
+	for _ in range(repeats):
+		if torch.cuda.is_available(): torch.cuda.synchronize()
+		start = time.perf_counter()
+		fn()
+		if torch.cuda.is_available(): torch.cuda.synchronize()
+		times.append(time.perf_counter() - start)
+	return num_items / min(times)
+
+def benchmark_item_loading(dataset, collate, batch_size, repeats):
+	"""
+	Returns items/s of dataset[idx] and batches/s of the collate function.
+	"""
+	indices = list(range(len(dataset)))
+	items_per_s = throughput(lambda: [dataset[idx] for idx in indices], len(indices), repeats)
+	items = [dataset[idx] for idx in indices]
+	batches = [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+	batches_per_s = throughput(lambda: [collate(batch) for batch in batches], len(batches), repeats)
+	return items_per_s, batches_per_s
+
+def benchmark_train_step(model, batches, loss_fn, repeats):
+	"""
+	loss_fn : function of the outputs of the model returning the loss (as in Trainer.train)
+
+	Returns utterances/s of forward + backward over batches.
+	"""
+	model.train()
+	def run():
+		for batch in batches:
+			loss = loss_fn(*model(*batch))
+			model.zero_grad()
+			loss.backward()
+	return throughput(run, sum(len(batch[0]) for batch in batches), repeats)
+
+def benchmark_decoding(model, batches, repeats):
+	"""
+	Returns utterances/s of decode_intents (beam search for seq2seq models) over batches.
+	"""
+	model.eval()
+	def run():
+		with torch.inference_mode():
+			for batch in batches:
+				model.decode_intents(batch[0])
+	return throughput(run, sum(len(batch[0]) for batch in batches), repeats)
+
+def benchmark_config(config_path, num_utterances, seconds, repeats, keep_data=False):
+	"""
+	Returns a dictionary (benchmark name --> throughput) for one config file.
+	"""
+	root = tempfile.mkdtemp(prefix="slu_benchmark_")
+	rng = np.random.default_rng(0)
+	torch.manual_seed(0)
+	config = synthetic_config(config_path, root)
+	results = {}
+	try:
+		write_synthetic_asr_data(config, num_utterances, seconds, rng)
+		write_synthetic_slu_data(config, num_utterances, seconds, rng)
+
+		# ASR data and model
+		asr_train_dataset, _, _ = get_ASR_datasets(config)
+		results["asr_items_per_s"], results["asr_collate_batches_per_s"] = benchmark_item_loading(asr_train_dataset, CollateWavsASR(), config.pretraining_batch_size, repeats)
+		items = [asr_train_dataset[idx] for idx in range(len(asr_train_dataset))]
+		asr_batches = [CollateWavsASR()(items[start:start + config.pretraining_batch_size]) for start in range(0, len(items), config.pretraining_batch_size)]
+		pretrained_model = PretrainedModel(config)
+		def pretraining_loss(phoneme_loss, word_loss, phoneme_acc, word_acc):
+			if config.pretraining_type == 1: return phoneme_loss
+			if config.pretraining_type == 3: return word_loss
+			return phoneme_loss + word_loss
+		results["pretrained_model_train_utterances_per_s"] = benchmark_train_step(pretrained_model, asr_batches, pretraining_loss, repeats)
+		del pretrained_model
+
+		# SLU data and model
+		cwd = os.getcwd()
+		os.chdir(root) # get_SLU_datasets writes intent_mapping.json to the working directory
+		slu_train_dataset, _, _ = get_SLU_datasets(config, data_str="original_splits", split_style="original")
+		os.chdir(cwd)
+		collate = CollateWavsSLU(slu_train_dataset.Sy_intent, config.seq2seq)
+		try:
+			results["slu_items_per_s"], results["slu_collate_batches_per_s"] = benchmark_item_loading(slu_train_dataset, collate, config.training_batch_size, repeats)
+			items = [slu_train_dataset[idx] for idx in range(len(slu_train_dataset))]
+		except:
+			# SLUDataset reads wavs with torchaudio's sox bindings, which some torchaudio versions do not have
+			print("could not load SLU items with torchaudio; reading the wavs with soundfile instead (slu_items_per_s not measured)")
+			items = []
+			for idx in range(len(slu_train_dataset)):
+				row = slu_train_dataset.df.loc[idx]
+				x, _ = sf.read(os.path.join(config.slu_path, row.path))
+				if config.seq2seq:
+					y_intent = [config.Sy_intent.index("<sos>")] + [config.Sy_intent.index(c) for c in row["semantics"]] + [config.Sy_intent.index("<eos>")]
+				else:
+					y_intent = [config.Sy_intent[slot][row[slot]] for slot in config.slots]
+				items.append((x, row.path, y_intent))
+			batches = [items[start:start + config.training_batch_size] for start in range(0, len(items), config.training_batch_size)]
+			results["slu_collate_batches_per_s"] = throughput(lambda: [collate(batch) for batch in batches], len(batches), repeats)
+		slu_batches = [collate(items[start:start + config.training_batch_size]) for start in range(0, len(items), config.training_batch_size)]
+		slu_batches = [(x, y_intent) for x, _, y_intent in slu_batches]
+		model = Model(config, lazy_pretrained=True) # the benchmark does not need the pre-trained weights
+		results["model_train_utterances_per_s"] = benchmark_train_step(model, slu_batches, lambda intent_loss, intent_acc: intent_loss, repeats)
+		name = "seq2seq_infer_utterances_per_s" if config.seq2seq else "decode_intents_utterances_per_s"
+		results[name] = benchmark_decoding(model, slu_batches, repeats)
+	finally:
+		if not keep_data: shutil.rmtree(root, ignore_errors=True)
+	return results
+
+def compare(results, baseline, tolerance):
+	"""
+	results, baseline : dictionaries (config name --> benchmark name --> throughput)
+
+	Prints the ratio of each throughput to the baseline and returns the list of benchmarks that are more than tolerance slower.
+	"""
+	regressions = []
+	for config_name, benchmarks in results.items():
+		for name, value in benchmarks.items():
+			if config_name not in baseline or name not in baseline[config_name]: continue
+			ratio = value / baseline[config_name][name]
+			flag = ""
+			if ratio < 1 - tolerance:
+				flag = "  <-- regression"
+				regressions.append(config_name + ": " + name)
+			print("%s: %s: %.4g vs %.4g (x%.2f)%s" % (config_name, name, value, baseline[config_name][name], ratio, flag))
+	return regressions
+
+if __name__ == '__main__':
+	# Get args
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config_paths', type=str, default="experiments/no_unfreezing.cfg,experiments/timers_and_such.cfg", help='comma-separated list of config files to benchmark (the seq2seq ones benchmark seq2seq inference)')
+	parser.add_argument('--num_utterances', type=int, default=32, help='number of synthetic utterances per split')
+	parser.add_argument('--seconds', type=float, default=3.0, help='average duration of the synthetic utterances')
+	parser.add_argument('--repeats', type=int, default=3, help='number of timed runs of each benchmark (the fastest is kept)')
+	parser.add_argument('--output_path', type=str, default="benchmark.json", help='path to save the results')
+	parser.add_argument('--baseline_path', type=str, default=None, help='results of a previous run to compare against')
+	parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression')
+	parser.add_argument('--keep_data', action='store_true', help='do not delete the synthetic data')
+	args = parser.parse_args()
+
+	results = {}
+	for config_path in args.config_paths.split(","):
+		print("========= " + config_path + " =========")
+		results[config_path] = benchmark_config(config_path, args.num_utterances, args.seconds, args.repeats, args.keep_data)
+		for name, value in results[config_path].items():
+			print("%s: %.4g" % (name, value))
+
+	output = {"results": results, "environment": {"torch": torch.__version__, "python": platform.python_version(), "device": torch.cuda.get_device_name() if torch.cuda.is_available() else (platform.processor() or platform.machine()), "num_threads": torch.get_num_threads()}, "settings": vars(args)}
+	with open(args.output_path, "w") as f:
+		json.dump(output, f, indent=1)
+
+	if args.baseline_path is not None:
+		with open(args.baseline_path, "r") as f:
+			baseline = json.load(f)
+		print("========= Comparison with " + args.baseline_path + " =========")
+		regressions = compare(results, baseline["results"], args.tolerance)
+		if len(regressions) > 0:
+			print("Regressions: " + ", ".join(regressions))
+			exit(1)
@@ -19,10 +19,15 @@ class Config:
 	def __init__(self):
 		self.use_sincnet = True
 
-def read_config(config_file):
+def read_config(config_file, overlay_file=None):
+	"""
+	overlay_file : optional config file whose values replace those of config_file (e.g., written by autotune.py)
+	"""
 	config = Config()
 	parser = configparser.ConfigParser()
 	parser.read(config_file)
+	if overlay_file is not None:
+		if not parser.read(overlay_file): print("Could not read " + overlay_file)
 
 	#[experiment]
 	config.seed=int(parser.get("experiment", "seed"))
@@ -93,6 +98,11 @@ def read_config(config_file):
 	config.pretraining_num_epochs=int(parser.get("pretraining", "pretraining_num_epochs"))
 	config.pretraining_length_mean=float(parser.get("pretraining", "pretraining_length_mean"))
 	config.pretraining_length_var=float(parser.get("pretraining", "pretraining_length_var"))
+	try:
+		config.activation_checkpointing=[x.strip() for x in parser.get("pretraining", "activation_checkpointing").split(",")]
+	except:
+		# old config file with no activation checkpointing
+		config.activation_checkpointing=["none"]
 
 	#[training]
 	config.slu_path=parser.get("training", "slu_path")
@@ -126,6 +136,94 @@ def read_config(config_file):
 		# old config file
 		config.dataset_upsample_factor = 1
 
+	try:
+		config.precision = parser.get("training", "precision")
+	except:
+		# old config file with no mixed precision
+		config.precision = "fp32"
+
+	try:
+		config.async_checkpointing = (parser.get("training", "async_checkpointing") == "True")
+	except:
+		# old config file
+		config.async_checkpointing = True
+
+	try:
+		config.delta_checkpointing = (parser.get("training", "delta_checkpointing") == "True")
+	except:
+		# old config file
+		config.delta_checkpointing = False
+
+	try:
+		config.audio_cache_dir = parser.get("training", "audio_cache_dir")
+		if config.audio_cache_dir == "None": config.audio_cache_dir = None
+	except:
+		# old config file: decode the wavs on the fly
+		config.audio_cache_dir = None
+
+	try:
+		config.training_dir = parser.get("training", "training_dir")
+		if config.training_dir == "None": config.training_dir = None
+	except:
+		# old config file: SLU checkpoints and logs go to <folder>/training
+		config.training_dir = None
+
+	try:
+		config.num_workers = int(parser.get("training", "num_workers"))
+	except:
+		# old config file: as many data loader workers as cores
+		config.num_workers = multiprocessing.cpu_count()
+
+	try:
+		config.num_threads = int(parser.get("training", "num_threads"))
+	except:
+		# old config file: default number of torch threads
+		config.num_threads = 0
+
+	try:
+		config.profile = (parser.get("training", "profile") == "True")
+		config.profile_trace = (parser.get("training", "profile_trace") == "True")
+	except:
+		# old config file with no profiling
+		config.profile = False
+		config.profile_trace = False
+
+	try:
+		config.early_stopping_patience = int(parser.get("training", "early_stopping_patience"))
+	except:
+		# old config file: no early stopping
+		config.early_stopping_patience = 0
+
+	try:
+		config.early_stopping_metric = parser.get("training", "early_stopping_metric")
+	except:
+		# old config file
+		config.early_stopping_metric = "intent_acc"
+
+	try:
+		config.early_stopping_min_delta = float(parser.get("training", "early_stopping_min_delta"))
+	except:
+		# old config file
+		config.early_stopping_min_delta = 0.
+
+	try:
+		config.validation_interval = int(parser.get("training", "validation_interval"))
+	except:
+		# old config file: only validate at the end of each epoch
+		config.validation_interval = 0
+
+	try:
+		config.validation_subset_size = int(parser.get("training", "validation_subset_size"))
+	except:
+		# old config file
+		config.validation_subset_size = 0
+
+	try:
+		config.training_state_interval = int(parser.get("training", "training_state_interval"))
+	except:
+		# old config file: no resumable training state
+		config.training_state_interval = 0
+
 	# compute downsample factor (divide T by this number)
 	config.phone_downsample_factor = 1
 	for factor in config.cnn_stride + config.cnn_max_pool_len + config.phone_downsample_len:
@@ -286,6 +384,54 @@ def get_SLU_datasets(config,data_str,split_style,use_gold_utterances=False,singl
 	else:
 		return train_dataset, valid_dataset, test_dataset
 
+class AudioCache:
+	"""
+	Decoded audio of all the wavs under a directory, stored in one float32 file (audio.npy) that is memory-mapped,
+	so that concurrent runs and their data loader workers share one copy in the page cache instead of decoding the wavs again.
+	Built by build_audio_cache.
+	"""
+	def __init__(self, cache_dir):
+		with open(os.path.join(cache_dir, "index.json"), "r") as f:
+			index = json.load(f)
+		self.root = index["root"]
+		self.offsets = index["offsets"] # path relative to root --> (start, length)
+		self.audio = np.load(os.path.join(cache_dir, "audio.npy"), mmap_mode="r")
+
+	def get(self, path):
+		"""
+		Returns the signal of the wav file at path as a float32 array, or None if it is not in the cache.
+		"""
+		key = os.path.relpath(os.path.abspath(path), self.root)
+		if key not in self.offsets: return None
+		start, length = self.offsets[key]
+		return np.array(self.audio[start:start+length])
+
+def build_audio_cache(root, cache_dir):
+	"""
+	Decodes the wavs under root (first channel, as SLUDataset reads them) into cache_dir (see AudioCache).
+	Does nothing if the cache already exists.
+	"""
+	if os.path.isfile(os.path.join(cache_dir, "index.json")): return
+	os.makedirs(cache_dir, exist_ok=True)
+	root = os.path.abspath(root)
+	paths = sorted(glob.glob(os.path.join(root, "**", "*.wav"), recursive=True))
+	offsets = {}
+	total = 0
+	for path in paths:
+		length = sf.info(path).frames
+		offsets[os.path.relpath(path, root)] = (total, length)
+		total += length
+	audio = np.lib.format.open_memmap(os.path.join(cache_dir, "audio.npy"), mode="w+", dtype=np.float32, shape=(total,))
+	for path in paths:
+		start, length = offsets[os.path.relpath(path, root)]
+		x, _ = sf.read(path, dtype="float32", always_2d=True)
+		audio[start:start+length] = x[:, 0]
+	audio.flush()
+	del audio
+	with open(os.path.join(cache_dir, "index.json.tmp"), "w") as f:
+		json.dump({"root": root, "offsets": offsets}, f)
+	os.replace(os.path.join(cache_dir, "index.json.tmp"), os.path.join(cache_dir, "index.json")) # written last, so an interrupted build is redone
+
 # taken from https://github.com/jfsantos/maracas/blob/master/maracas/maracas.py
 def rms_energy(x):
 	return 10*np.log10((1e-12 + x.dot(x))/len(x))
@@ -310,8 +456,9 @@ class SLUDataset(torch.utils.data.Dataset):
 		if self.words_out:
 			assert Sy_word is not None
 		self.Sy_word = Sy_word
+		self.audio_cache = AudioCache(config.audio_cache_dir) if config.audio_cache_dir is not None else None
 
-		self.loader = torch.utils.data.DataLoader(self, batch_size=config.training_batch_size, num_workers=multiprocessing.cpu_count(), shuffle=True, collate_fn=CollateWavsSLU(self.Sy_intent, self.seq2seq, pad_all=words_out))
+		self.loader = torch.utils.data.DataLoader(self, batch_size=config.training_batch_size, num_workers=config.num_workers, sampler=ResumableSampler(self, seed=config.seed), generator=torch.Generator().manual_seed(config.seed), collate_fn=CollateWavsSLU(self.Sy_intent, self.seq2seq, pad_all=words_out))
 
 	def __len__(self):
 		#if self.augment: return len(self.df)*2 # second half of dataset is augmented
@@ -323,31 +470,35 @@ class SLUDataset(torch.utils.data.Dataset):
 		idx = idx % len(self.df)
 
 		wav_path = os.path.join(self.base_path, self.df.loc[idx].path)
-		effect = torchaudio.sox_effects.SoxEffectsChain()
-		effect.set_input_file(wav_path)
 		if self.words_out:
 			x_utterance = self.df.loc[idx].transcription.split(" ")
 			y_words=[self.Sy_word.index(k.lower().strip(punctuation)) if k.lower().strip(punctuation) in self.Sy_word else self.config.vocabulary_size for k in x_utterance]
 
 		augment = False
-		if augment:
-			# speed/tempo
-			min_speed = 0.9; max_speed = 1.1; speed_range = max_speed-min_speed
-			speed = speed_range * np.random.rand(1)[0] + min_speed
-			effect.append_effect_to_chain("tempo", speed)
-			del speed
-
-			# volume
-			min_gain = -10; max_gain = 10; gain_range = max_gain-min_gain
-			gain_dB = gain_range * np.random.rand(1)[0] + min_gain
-			gain = 10**(gain_dB/20)
-			effect.append_effect_to_chain("vol", gain)
-			del gain_dB
-
-
-		wav, fs = effect.sox_build_flow_effects()
-		x = wav[0].numpy()
-		del wav, effect
+		x = None
+		if self.audio_cache is not None and not augment:
+			x = self.audio_cache.get(wav_path) # None if the file is not in the cache
+		if x is None:
+			effect = torchaudio.sox_effects.SoxEffectsChain()
+			effect.set_input_file(wav_path)
+			if augment:
+				# speed/tempo
+				min_speed = 0.9; max_speed = 1.1; speed_range = max_speed-min_speed
+				speed = speed_range * np.random.rand(1)[0] + min_speed
+				effect.append_effect_to_chain("tempo", speed)
+				del speed
+
+				# volume
+				min_gain = -10; max_gain = 10; gain_range = max_gain-min_gain
+				gain_dB = gain_range * np.random.rand(1)[0] + min_gain
+				gain = 10**(gain_dB/20)
+				effect.append_effect_to_chain("vol", gain)
+				del gain_dB
+
+
+			wav, fs = effect.sox_build_flow_effects()
+			x = wav[0].numpy()
+			del wav, effect
 
 		if augment:
 			# crop
@@ -406,7 +557,7 @@ class SLU_GoldDataset(torch.utils.data.Dataset):
 		self.SNRs = [0,5,10,15,20]
 		self.seq2seq = config.seq2seq
 		self.config_vocab_size = config.vocabulary_size
-		self.loader = torch.utils.data.DataLoader(self, batch_size=config.training_batch_size, num_workers=multiprocessing.cpu_count(), shuffle=True, collate_fn=CollateWavsSLU(self.Sy_intent, self.seq2seq))
+		self.loader = torch.utils.data.DataLoader(self, batch_size=config.training_batch_size, num_workers=config.num_workers, shuffle=True, collate_fn=CollateWavsSLU(self.Sy_intent, self.seq2seq))
 		self.config = config
 	def __len__(self):
 		#if self.augment: return len(self.df)*2 # second half of dataset is augmented
@@ -629,6 +780,40 @@ def get_ASR_datasets(config):
 
 	return train_dataset, valid_dataset, test_dataset
 
+class ResumableSampler(torch.utils.data.distributed.DistributedSampler):
+	"""
+	Shuffles the dataset with the seed and the epoch (set by Trainer.train), so that each epoch has the same order in every run,
+	and can start an epoch after the examples that an interrupted run had already used (see Trainer.load_training_state).
+	In a distributed run, reads the 1/num_replicas share of one process, as DistributedSampler.
+	"""
+	def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+		super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+		self.start = 0 # examples of the epoch to skip
+
+	def skip(self, num_examples):
+		"""
+		The next iteration (only) starts after the first num_examples examples of the epoch.
+		"""
+		self.start = num_examples
+
+	def __iter__(self):
+		indices = list(super(ResumableSampler, self).__iter__())[self.start:]
+		self.start = 0
+		return iter(indices)
+
+	def __len__(self):
+		return self.num_samples - self.start
+
+def distribute_loader(dataset, rank, world_size, seed=0, shuffle=True):
+	"""
+	Replaces dataset.loader with one that only reads this process's 1/world_size share of the dataset,
+	with the same batch size and collate function and an equal share of the worker processes.
+	The sampler is reshuffled each epoch by Trainer.train.
+	"""
+	loader = dataset.loader
+	sampler = ResumableSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=seed)
+	dataset.loader = torch.utils.data.DataLoader(dataset, batch_size=loader.batch_size, num_workers=(loader.num_workers + world_size - 1) // world_size, sampler=sampler, generator=loader.generator, collate_fn=loader.collate_fn)
+
 class ASRDataset(torch.utils.data.Dataset):
 	def __init__(self, wav_paths, textgrid_paths, Sy_phoneme, Sy_word, config):
 		"""
@@ -646,8 +831,10 @@ class ASRDataset(torch.utils.data.Dataset):
 		self.Sy_word = Sy_word
 		self.phone_downsample_factor = config.phone_downsample_factor
 		self.word_downsample_factor = config.word_downsample_factor
+		self.seed = config.seed
+		self.epoch = 0 # set by Trainer.train; with seed and idx, picks the random snippet of each example
 		
-		self.loader = torch.utils.data.DataLoader(self, batch_size=config.pretraining_batch_size, num_workers=multiprocessing.cpu_count(), shuffle=True, collate_fn=CollateWavsASR())
+		self.loader = torch.utils.data.DataLoader(self, batch_size=config.pretraining_batch_size, num_workers=config.num_workers, sampler=ResumableSampler(self, seed=config.seed), generator=torch.Generator().manual_seed(config.seed), collate_fn=CollateWavsASR())
 
 	def __len__(self):
 		return len(self.wav_paths)
@@ -672,12 +859,13 @@ class ASRDataset(torch.utils.data.Dataset):
 			# if word.mark == '': word_index = -1
 			y_word += [word_index] * round(duration * fs)
 
-		# Cut a snippet of length random_length from the audio
-		random_length = round(fs * max(self.length_mean + self.length_var * torch.randn(1).item(), 0.5))
+		# Cut a snippet of length random_length from the audio (the same for a given example and epoch, whichever worker reads it)
+		generator = torch.Generator().manual_seed(int(np.random.SeedSequence([self.seed, self.epoch, idx]).generate_state(1)[0]))
+		random_length = round(fs * max(self.length_mean + self.length_var * torch.randn(1, generator=generator).item(), 0.5))
 		if len(x) <= random_length:
 			start = 0
 		else:
-			start = torch.randint(low=0, high=len(x)-random_length, size=(1,)).item()
+			start = torch.randint(low=0, high=len(x)-random_length, size=(1,), generator=generator).item()
 		end = start + random_length
 
 		x = x[start:end]
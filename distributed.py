@@ -0,0 +1,50 @@
+import os
+import multiprocessing
+import torch
+import torch.distributed
+
+def init_from_env():
+	"""
+	Joins the process group of a run launched with torchrun (e.g., torchrun --nproc_per_node=4 main.py --train ...),
+	using the gloo backend, and gives each process an equal share of the CPU threads.
+
+	Returns (rank, world size); (0, 1) when not launched with torchrun.
+	"""
+	world_size = int(os.environ.get("WORLD_SIZE", 1))
+	if world_size == 1: return 0, 1
+	rank = int(os.environ["RANK"])
+	torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+	torch.set_num_threads(max(1, multiprocessing.cpu_count() // world_size))
+	return rank, world_size
+
+def is_distributed():
+	return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+def get_rank():
+	return torch.distributed.get_rank() if is_distributed() else 0
+
+def get_world_size():
+	return torch.distributed.get_world_size() if is_distributed() else 1
+
+def all_reduce_sum(values):
+	"""
+	values : list of numbers, or 1-D Tensor
+
+	Returns the element-wise sum over all processes (the values themselves if not distributed).
+	"""
+	if not is_distributed(): return values
+	totals = torch.as_tensor(values, dtype=torch.float64).cpu() # gloo reduces CPU tensors
+	torch.distributed.all_reduce(totals)
+	return totals.tolist() if isinstance(values, list) else totals.to(values.device, values.dtype)
+
+def all_gather_object(value):
+	"""
+	Returns the list of the values of all processes, by rank (call on every process); [value] if not distributed.
+	"""
+	if not is_distributed(): return [value]
+	values = [None] * get_world_size()
+	torch.distributed.all_gather_object(values, value)
+	return values
+
+def cleanup():
+	if is_distributed(): torch.distributed.destroy_process_group()
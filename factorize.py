@@ -0,0 +1,298 @@
+# Post-training low-rank factorization of GRU input projections and linear classifiers
+import torch
+import numpy as np
+import pandas as pd
+import copy
+import time
+import json
+from models import Model, GRU
+from data import get_SLU_datasets, read_config
+from training import Trainer
+import argparse
+import os
+
+class LowRankLinear(torch.nn.Module):
+	"""
+	Linear layer whose weight is stored as the product of two thin matrices, W ~= up * down.
+	"""
+	def __init__(self, in_features, out_features, rank, bias=True):
+		super(LowRankLinear, self).__init__()
+		self.down = torch.nn.Linear(in_features, rank, bias=False)
+		self.up = torch.nn.Linear(rank, out_features, bias=bias)
+		self.rank = rank
+
+	def forward(self, input):
+		return self.up(self.down(input))
+
+class LowRankGRU(torch.nn.Module):
+	"""
+	GRU whose input-to-hidden weights (of both directions) are factorized.
+
+	The shared input projection is applied once to the whole sequence, and a GRU with
+	input_size=rank runs the recurrence, so the fused RNN kernel is still used.
+	The hidden-to-hidden weights are left untouched.
+	"""
+	def __init__(self, input_size, hidden_size, rank, bidirectional):
+		super(LowRankGRU, self).__init__()
+		self.down = torch.nn.Linear(input_size, rank, bias=False)
+		self.rnn = GRU(input_size=rank, hidden_size=hidden_size, batch_first=True, bidirectional=bidirectional)
+		self.rank = rank
+
+	def forward(self, input):
+		return self.rnn(self.down(input))
+
+def select_rank(singular_values, rank=None, energy=None):
+	"""
+	singular_values : Tensor of shape (min(m,n),), in descending order
+	rank : integer (fixed rank)
+	energy : float in (0,1] (fraction of the squared singular values to keep)
+
+	Returns the rank to keep.
+	"""
+	if energy is not None:
+		cumulative = torch.cumsum(singular_values**2, dim=0) / (singular_values**2).sum()
+		return int((cumulative < energy).sum().item()) + 1
+	return min(rank, len(singular_values))
+
+def truncated_svd(weight, rank=None, energy=None):
+	"""
+	weight : Tensor of shape (m, n)
+
+	Returns up (m, r) and down (r, n) such that up.mm(down) is the best rank-r approximation of weight.
+	"""
+	U, S, Vh = torch.linalg.svd(weight.detach().double(), full_matrices=False)
+	r = select_rank(S, rank, energy)
+	up = (U[:, :r] * S[:r]).float()
+	down = Vh[:r].float()
+	return up, down
+
+def factorize_linear(layer, rank=None, energy=None):
+	"""
+	layer : torch.nn.Linear
+
+	Returns a LowRankLinear approximating the layer, or None if the factorization would not save any computation.
+	"""
+	up, down = truncated_svd(layer.weight, rank, energy)
+	r = down.shape[0]
+	if r * (layer.in_features + layer.out_features) >= layer.in_features * layer.out_features:
+		return None
+	new_layer = LowRankLinear(layer.in_features, layer.out_features, r, bias=layer.bias is not None).to(layer.weight.device)
+	new_layer.down.weight.data.copy_(down)
+	new_layer.up.weight.data.copy_(up)
+	if layer.bias is not None:
+		new_layer.up.bias.data.copy_(layer.bias.data)
+	return new_layer
+
+def factorize_gru(layer, rank=None, energy=None):
+	"""
+	layer : torch.nn.GRU (single layer, batch_first)
+
+	Returns a LowRankGRU approximating the layer, or None if the factorization would not save any computation.
+	"""
+	if layer.num_layers != 1:
+		return None
+	suffixes = ["_l0", "_l0_reverse"] if layer.bidirectional else ["_l0"]
+
+	# both directions read the same input, so they can share one projection
+	weight_ih = torch.cat([getattr(layer, "weight_ih" + suffix) for suffix in suffixes], dim=0)
+	up, down = truncated_svd(weight_ih, rank, energy)
+	r = down.shape[0]
+	if r * (weight_ih.shape[0] + weight_ih.shape[1]) >= weight_ih.shape[0] * weight_ih.shape[1]:
+		return None
+
+	new_layer = LowRankGRU(layer.input_size, layer.hidden_size, r, layer.bidirectional).to(weight_ih.device)
+	new_layer.down.weight.data.copy_(down)
+	gate_dim = 3 * layer.hidden_size
+	for index, suffix in enumerate(suffixes):
+		getattr(new_layer.rnn, "weight_ih" + suffix).data.copy_(up[index*gate_dim:(index+1)*gate_dim])
+		for name in ["weight_hh", "bias_ih", "bias_hh"]:
+			getattr(new_layer.rnn, name + suffix).data.copy_(getattr(layer, name + suffix).data)
+	return new_layer
+
+def factorizable_layers(model):
+	"""
+	model : PretrainedModel or Model
+
+	Yields (name, parent, key, layer) for every GRU and classifier that can be factorized,
+	using the layer's name attribute (qualified with the list name if it is already taken, as in profile_layers.named_layers).
+	"""
+	if isinstance(model, Model):
+		pretrained_model = model.pretrained_model
+	else:
+		pretrained_model = model
+
+	for layer_list in [pretrained_model.phoneme_layers, pretrained_model.word_layers]:
+		for index, layer in enumerate(layer_list):
+			if isinstance(layer, torch.nn.GRU): yield layer.name, layer_list, index, layer
+	yield "word_linear", pretrained_model, "word_linear", pretrained_model.word_linear
+
+	if isinstance(model, Model) and not model.seq2seq:
+		layer_lists = [("intent_layers", model.intent_layers)]
+		if model.seperate_RNN: layer_lists += [("semantic_layers", model.semantic_layers), ("final_layers", model.final_layers)]
+		names = set()
+		for list_name, layer_list in layer_lists:
+			for index, layer in enumerate(layer_list):
+				name = getattr(layer, "name", layer.__class__.__name__)
+				if name in names: name = list_name + "." + name # e.g., with seperate_RNN both lists have an intent_rnn0
+				names.add(name)
+				if isinstance(layer, (torch.nn.GRU, torch.nn.Linear)): yield name, layer_list, index, layer
+
+def factorize_model(model, targets, rank=None, energy=None, ranks=None):
+	"""
+	model : PretrainedModel or Model (modified in place)
+	targets : list of layer name prefixes (e.g., ["word_rnn", "word_linear", "final_classifier"]), matched with or without the list name
+	rank : integer (same rank for every target)
+	energy : float (per-layer rank chosen to keep this fraction of the spectral energy)
+	ranks : dictionary (layer name --> rank), e.g. from a previous call; overrides rank and energy
+
+	Replaces the target layers with factorized equivalents and returns a dictionary (layer name --> rank).
+	"""
+	chosen_ranks = {}
+	for name, parent, key, layer in list(factorizable_layers(model)):
+		if not any(name.startswith(target) or name.split(".")[-1].startswith(target) for target in targets): continue
+		if ranks is not None:
+			if name not in ranks: continue
+			layer_rank, layer_energy = ranks[name], None
+		else:
+			layer_rank, layer_energy = rank, energy
+
+		if isinstance(layer, torch.nn.GRU):
+			new_layer = factorize_gru(layer, layer_rank, layer_energy)
+		else:
+			new_layer = factorize_linear(layer, layer_rank, layer_energy)
+		if new_layer is None:
+			print(name + ": rank too high to save computation; not factorized")
+			continue
+
+		new_layer.name = getattr(layer, "name", name)
+		for param in new_layer.parameters():
+			param.requires_grad = all(p.requires_grad for p in layer.parameters())
+		if isinstance(parent, torch.nn.ModuleList):
+			parent[key] = new_layer
+		else:
+			setattr(parent, key, new_layer)
+		chosen_ranks[name] = new_layer.rank
+	return chosen_ranks
+
+def ranks_path(checkpoint_path):
+	"""
+	Path of the file where factorize.py --save_models records the ranks of a factorized checkpoint.
+	"""
+	return os.path.splitext(checkpoint_path)[0] + "_ranks.json"
+
+def load_factorized_checkpoint(trainer, model_path="model_state.pth"):
+	"""
+	trainer : Trainer of a model built from the same config as the factorized model
+	model_path : name of the checkpoint (in the training folder)
+
+	Loads a checkpoint saved by factorize.py --save_models: the model is factorized with the saved ranks
+	before loading, so that the state dict matches. Checkpoints without a ranks file are loaded as usual.
+	"""
+	path = ranks_path(os.path.join(trainer.checkpoint_path, model_path))
+	if os.path.isfile(path):
+		with open(path, "r") as f:
+			ranks = json.load(f)
+		chosen_ranks = factorize_model(trainer.model, list(ranks), ranks=ranks)
+		if chosen_ranks != ranks:
+			raise ValueError("Could not rebuild the factorized layers of %s: expected ranks %s, got %s" % (model_path, ranks, chosen_ranks))
+		trainer.optimizer = torch.optim.Adam(trainer.model.parameters(), lr=trainer.lr) # the optimizer must see the new parameters
+	trainer.load_checkpoint(model_path)
+
+def count_flops(model, x):
+	"""
+	Number of floating point operations in one forward pass of model on x.
+	"""
+	from torch.utils.flop_counter import FlopCounterMode # requires PyTorch >= 2.1
+	with FlopCounterMode(display=False) as flop_counter:
+		with torch.no_grad():
+			model.predict_intents(x)
+	return flop_counter.get_total_flops()
+
+def measure_latency(model, x, num_repeats=20):
+	"""
+	Median latency (in ms) of model.predict_intents on x.
+	"""
+	timings = []
+	with torch.no_grad():
+		model.predict_intents(x) # warm-up
+		for _ in range(num_repeats):
+			if model.is_cuda: torch.cuda.synchronize()
+			start = time.perf_counter()
+			model.predict_intents(x)
+			if model.is_cuda: torch.cuda.synchronize()
+			timings.append(time.perf_counter() - start)
+	return 1000 * float(np.median(timings))
+
+if __name__ == '__main__':
+	# Get args
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config_path', type=str, required=True, help='path to config file with hyperparameters, etc.')
+	parser.add_argument('--model_path', type=str, required=True, help='name of trained model to factorize (in the training folder)')
+	parser.add_argument('--resplit_style', required=True, choices=['original','random', 'utterance_closed', "speaker_or_utterance_closed", "mutually_closed"], help='Path to root of fluent_speech_commands_dataset directory')
+	parser.add_argument('--utility', action='store_true', help='Use utility driven splits')
+	parser.add_argument('--targets', type=str, default="phone_rnn,word_rnn,word_linear,intent_rnn,final_classifier", help='comma-separated layer name prefixes to factorize')
+	parser.add_argument('--ranks', type=str, default="", help='comma-separated list of ranks to try')
+	parser.add_argument('--energies', type=str, default="", help='comma-separated list of energy thresholds to try (e.g., 0.9,0.99)')
+	parser.add_argument('--finetune_epochs', type=int, default=0, help='number of epochs to fine-tune each factorized model')
+	parser.add_argument('--latency_wav_seconds', type=float, default=3.0, help='length of the input used to measure FLOPs and latency')
+	parser.add_argument('--save_models', action='store_true', help='save each factorized model (and its ranks) in the training folder')
+	parser.add_argument('--table_path', type=str, default="factorization.csv", help='path to save the accuracy/FLOPs/latency table')
+	args = parser.parse_args()
+
+	data_str=f"{args.resplit_style}_splits"
+	if args.utility:
+		data_str=data_str+"_utility"
+
+	# Read config file
+	config = read_config(args.config_path)
+	torch.manual_seed(config.seed); np.random.seed(config.seed)
+
+	if args.resplit_style=="speaker_or_utterance_closed":
+		train_dataset, valid_dataset, _, _ = get_SLU_datasets(config,data_str=data_str,split_style=args.resplit_style)
+	else:
+		train_dataset, valid_dataset, _ = get_SLU_datasets(config,data_str=data_str,split_style=args.resplit_style)
+
+	# Load the trained model
+	model = Model(config=config, lazy_pretrained=True)
+	trainer = Trainer(model=model, config=config)
+	trainer.load_checkpoint(args.model_path)
+
+	targets = [target.strip() for target in args.targets.split(",")]
+	settings = [("full", None, None)]
+	settings += [("rank=%s" % r, int(r), None) for r in args.ranks.split(",") if r != ""]
+	settings += [("energy=%s" % e, None, float(e)) for e in args.energies.split(",") if e != ""]
+
+	x = torch.randn(1, int(args.latency_wav_seconds * config.fs))
+	if model.is_cuda: x = x.cuda()
+
+	rows = []
+	for setting, rank, energy in settings:
+		print("========= " + setting + " =========")
+		factorized_model = copy.deepcopy(model)
+		ranks = {}
+		if setting != "full":
+			ranks = factorize_model(factorized_model, targets, rank=rank, energy=energy)
+		factorized_model.eval()
+		row = {"setting": setting, "ranks": json.dumps(ranks)}
+		row["num_params"] = sum(p.numel() for p in factorized_model.parameters())
+		row["flops"] = count_flops(factorized_model, x)
+		row["latency_ms"] = measure_latency(factorized_model, x)
+
+		log_file = "log_factorize_%s.csv" % setting.replace("=", "_")
+		factorized_trainer = Trainer(model=factorized_model, config=config)
+		row["valid_acc"], row["valid_loss"] = factorized_trainer.test(valid_dataset, log_file=log_file)
+		if args.finetune_epochs > 0 and setting != "full":
+			for epoch in range(args.finetune_epochs):
+				factorized_trainer.train(train_dataset, log_file=log_file.replace(".csv", "_finetune.csv")) # training and test logs have different columns
+			row["finetuned_valid_acc"], row["finetuned_valid_loss"] = factorized_trainer.test(valid_dataset, log_file=log_file)
+		if args.save_models and setting != "full":
+			model_name = os.path.splitext(args.model_path)[0] + "_" + setting.replace("=", "_")
+			factorized_trainer.save_checkpoint(model_path=model_name + ".pth")
+			with open(ranks_path(os.path.join(factorized_trainer.checkpoint_path, model_name + ".pth")), "w") as f: # read by load_factorized_checkpoint
+				json.dump(ranks, f)
+		print(row)
+		rows.append(row)
+
+	table = pd.DataFrame(rows)
+	print(table.to_string(index=False))
+	table.to_csv(args.table_path, index=False)
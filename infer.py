@@ -0,0 +1,164 @@
+# Batch inference of a trained SLU model over a directory of audio files or a CSV manifest, written to JSONL or CSV
+import torch
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import multiprocessing
+import json
+import glob
+import csv
+import os
+from models import Model
+from data import read_config, get_SLU_datasets
+from training import Trainer
+from factorize import load_factorized_checkpoint
+from metrics import MetricsWriter
+import argparse
+
+def list_inputs(wav_glob=None, manifest_path=None, path_column="path", audio_root=None):
+	"""
+	Returns a list of (path as listed, path to read) from a (recursive) glob or from a column of a CSV manifest;
+	relative manifest paths are read from audio_root (by default, the directory of the manifest).
+	"""
+	if wav_glob is not None:
+		return [(path, path) for path in sorted(glob.glob(wav_glob, recursive=True))]
+	if audio_root is None: audio_root = os.path.dirname(manifest_path)
+	paths = pd.read_csv(manifest_path, usecols=[path_column])[path_column]
+	return [(path, os.path.join(audio_root, path)) for path in paths]
+
+def read_done_paths(output_path):
+	"""
+	Returns the set of paths already in the output file of an interrupted run.
+	An incomplete last line (from the interruption) is removed first, so that new rows can be appended.
+	"""
+	if not os.path.exists(output_path): return set()
+	with open(output_path, "rb+") as f:
+		contents = f.read()
+		end = contents.rfind(b"\n") + 1
+		if end < len(contents):
+			f.truncate(end)
+	with open(output_path, newline="") as f:
+		if output_path.endswith(".jsonl"):
+			return set(json.loads(line)["path"] for line in f if line.strip())
+		return set(row["path"] for row in csv.DictReader(f))
+
+def make_batches(inputs, batch_size):
+	"""
+	inputs : list of (path as listed, path to read, duration in seconds)
+
+	Sorts the inputs by duration (longest first), so that the utterances of a batch have similar lengths
+	and little padding, and splits them into batches of at most batch_size.
+	"""
+	inputs = sorted(inputs, key=lambda input: -input[2])
+	return [inputs[start:start + batch_size] for start in range(0, len(inputs), batch_size)]
+
+# model and sampling rate of the current process (set by init_worker)
+worker_model = None
+worker_fs = None
+
+def init_worker(model, fs, num_threads):
+	global worker_model, worker_fs
+	worker_model = model
+	worker_fs = fs
+	torch.set_num_threads(num_threads)
+
+def run_batch(batch):
+	"""
+	batch : list of (path as listed, path to read, duration in seconds)
+
+	Returns a list of rows (dictionaries) with the path, duration and intent of each readable input.
+	"""
+	signals, rows = [], []
+	for path, read_path, seconds in batch:
+		try:
+			signal, fs = sf.read(read_path, dtype="float32")
+			if fs != worker_fs:
+				raise ValueError("sampling rate %d instead of %d" % (fs, worker_fs))
+			if signal.ndim > 1: signal = signal.mean(axis=1) # mix down to mono
+			signals.append(torch.from_numpy(signal))
+			rows.append({"path": path, "seconds": seconds})
+		except Exception as e:
+			print(path + ": " + str(e) + "; skipped")
+	if len(signals) == 0: return []
+
+	T = max(len(signal) for signal in signals)
+	x = torch.stack([torch.nn.functional.pad(signal, (0, T - len(signal))) for signal in signals])
+	if worker_model.is_cuda: x = x.cuda()
+	with torch.inference_mode():
+		intents = worker_model.decode_intents(x, structured=True)
+	for row, intent in zip(rows, intents):
+		row.update(intent) # one column per slot ("intent", the decoded string, for seq2seq models)
+	return rows
+
+if __name__ == '__main__':
+	# Get args
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config_path', type=str, required=True, help='path to config file with hyperparameters, etc.')
+	parser.add_argument('--model_path', type=str, required=True, help='name of trained model to use (in the training folder)')
+	parser.add_argument('--resplit_style', default='original', choices=['original','random', 'utterance_closed', "speaker_or_utterance_closed", "mutually_closed"], help='splits the model was trained on (for its intent labels)')
+	parser.add_argument('--utility', action='store_true', help='Use utility driven splits')
+	parser.add_argument('--wav_glob', type=str, help='glob of the audio files to label (e.g., "audio/**/*.wav")')
+	parser.add_argument('--manifest_path', type=str, help='CSV file listing the audio files to label')
+	parser.add_argument('--path_column', type=str, default="path", help='column of the manifest with the audio paths')
+	parser.add_argument('--audio_root', type=str, default=None, help='directory the manifest paths are relative to (default: the directory of the manifest)')
+	parser.add_argument('--output_path', type=str, default="intents.jsonl", help='file to write the intents to (.jsonl, or CSV otherwise)')
+	parser.add_argument('--resume', action='store_true', help='skip the paths already in output_path and append to it')
+	parser.add_argument('--batch_size', type=int, default=16, help='number of utterances per batch')
+	parser.add_argument('--num_workers', type=int, default=1, help='number of processes running the model (1: this process only)')
+	parser.add_argument('--num_threads', type=int, default=0, help='torch threads per process (0: the number of cores divided by num_workers)')
+	args = parser.parse_args()
+	if (args.wav_glob is None) == (args.manifest_path is None):
+		parser.error("give one of --wav_glob and --manifest_path")
+
+	# Read config file
+	config = read_config(args.config_path)
+	torch.manual_seed(config.seed); np.random.seed(config.seed)
+
+	# Read the intent labels from the training set
+	data_str=f"{args.resplit_style}_splits"
+	if args.utility:
+		data_str=data_str+"_utility"
+	get_SLU_datasets(config,data_str=data_str,split_style=args.resplit_style)
+
+	# Load the trained model
+	model = Model(config=config, lazy_pretrained=True)
+	trainer = Trainer(model=model, config=config)
+	load_factorized_checkpoint(trainer, args.model_path) # also loads models saved by factorize.py --save_models
+	model.eval()
+
+	# List the inputs and their durations (from the file headers)
+	done = read_done_paths(args.output_path) if args.resume else set()
+	inputs = []
+	for path, read_path in list_inputs(args.wav_glob, args.manifest_path, args.path_column, args.audio_root):
+		if path in done: continue
+		try:
+			inputs.append((path, read_path, sf.info(read_path).duration))
+		except Exception as e:
+			print(path + ": " + str(e) + "; skipped")
+	print("%d files to label (%d already done)" % (len(inputs), len(done)))
+	batches = make_batches(inputs, args.batch_size)
+
+	num_workers = args.num_workers
+	if model.is_cuda and num_workers > 1:
+		print("running on the GPU in a single process")
+		num_workers = 1
+	num_threads = args.num_threads if args.num_threads > 0 else max(1, multiprocessing.cpu_count() // num_workers)
+
+	# Rows are written as each batch finishes, so an interrupted run can be resumed
+	writer = MetricsWriter(args.output_path, append=args.resume)
+	num_done = 0
+	if num_workers == 1:
+		init_worker(model, config.fs, num_threads)
+		results = map(run_batch, batches)
+	else:
+		pool = multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(model, config.fs, num_threads))
+		results = pool.imap_unordered(run_batch, batches)
+	for rows in results:
+		for row in rows:
+			writer.write(row)
+		writer.flush()
+		num_done += len(rows)
+		print("labelled %d/%d" % (num_done, len(inputs)), end="\r")
+	print()
+	if num_workers > 1:
+		pool.close(); pool.join()
@@ -28,8 +28,8 @@ import os
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 config = data.read_config("experiments/no_unfreezing.cfg"); _,_,_=data.get_SLU_datasets(config)
-model = models.Model(config).eval()
-model.load_state_dict(torch.load("experiments/no_unfreezing/training/model_state.pth", map_location=device)) # load trained model
+model = models.Model(config, lazy_pretrained=True).eval()
+model.load_state_dict(models.read_state_dict("experiments/no_unfreezing/training/model_state.pth", model.is_cuda)) # load trained model
 import pdb
 signal, _ = sf.read("test.wav")
 signal = torch.tensor(signal, device=device).float().unsqueeze(0)
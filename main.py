@@ -2,9 +2,12 @@ import torch
 import numpy as np
 import pandas as pd
 from models import PretrainedModel, Model, obtain_glove_embeddings, obtain_fasttext_embeddings
-from data import get_ASR_datasets, get_SLU_datasets, read_config
+from data import get_ASR_datasets, get_SLU_datasets, read_config, distribute_loader
+from distributed import init_from_env, cleanup
 from training import Trainer
 import argparse
+import json
+import time
 import os
 
 # Get args
@@ -23,6 +26,8 @@ parser.add_argument('--finetune_semantics_embedding', action='store_true', help=
 parser.add_argument('--resplit_style', required=True, choices=['original','random', 'utterance_closed', "speaker_or_utterance_closed", "mutually_closed","unseen","challenge"], help='Path to root of fluent_speech_commands_dataset directory')
 parser.add_argument('--utility', action='store_true', help='Use utility driven splits')
 parser.add_argument('--restart', action='store_true', help='load checkpoint from a previous run')
+parser.add_argument('--resume', action='store_true', help='continue an interrupted --pretrain or --train run from its last training state (see training_state_interval)')
+parser.add_argument('--training_state_interval', type=int, default=None, help='save the training state every this many steps and at the end of each epoch (0: never; overrides the config file)')
 parser.add_argument('--config_path', type=str, help='path to config file with hyperparameters, etc.')
 parser.add_argument('--pipeline_gold_train', action='store_true', help='run SLU training in pipeline manner with gold set utterances')
 parser.add_argument('--seperate_RNN', action='store_true', help='run seperate RNNs over semantic embeddings and over SLU output')
@@ -40,6 +45,17 @@ parser.add_argument('--dele', action='store_true', help='compute results on spli
 parser.add_argument('--aggressive', action='store_true', help='compute results on split optimised aggressively')
 parser.add_argument('--nonagg', action='store_true', help='compute results on split optimised using delete')
 parser.add_argument('--seed', default=None, help='run on diff variants of same dataset')
+parser.add_argument('--precision', choices=['fp32','bf16'], default=None, help='run the model in fp32 or with bf16 autocast (overrides the config file)')
+parser.add_argument('--profile', action='store_true', help='time data loading, host-to-device copy, forward, backward and optimizer step of each training step, and log a summary per epoch')
+parser.add_argument('--profile_trace', action='store_true', help='with --profile, also save the training steps of each epoch as a Chrome trace in the training folder')
+parser.add_argument('--audio_cache_dir', type=str, default=None, help='directory of decoded audio built by data.build_audio_cache (e.g., by sweep.py), read instead of the wavs')
+parser.add_argument('--training_dir', type=str, default=None, help='folder for the SLU checkpoints, logs and training state, instead of the training folder of the experiment (e.g., one per run of sweep.py)')
+parser.add_argument('--summary_path', type=str, default=None, help='path to save the final results of the run as JSON')
+parser.add_argument('--early_stopping_patience', type=int, default=None, help='with --train, stop after this many validations without improvement (0: never; overrides the config file)')
+parser.add_argument('--early_stopping_metric', choices=['intent_acc','intent_loss'], default=None, help='validation metric for early stopping (overrides the config file)')
+parser.add_argument('--validation_interval', type=int, default=None, help='with --train, also validate every this many steps on a subset of the validation set (0: only at the end of each epoch; overrides the config file)')
+parser.add_argument('--validation_subset_size', type=int, default=None, help='number of validation examples used by --validation_interval (0: all; overrides the config file)')
+parser.add_argument('--overlay_path', type=str, default=None, help='config file whose values replace those of config_path (e.g., written by autotune.py)')
 
 args = parser.parse_args()
 pretrain = args.pretrain
@@ -103,12 +119,35 @@ nlu_setup = args.nlu_setup
 
 
 # Read config file
-config = read_config(config_path)
+config = read_config(config_path, overlay_file=args.overlay_path)
+if args.precision is not None: config.precision = args.precision
+if args.profile: config.profile = True
+if args.profile_trace: config.profile = config.profile_trace = True
+if args.audio_cache_dir is not None: config.audio_cache_dir = args.audio_cache_dir
+if args.training_dir is not None: config.training_dir = args.training_dir
+if args.early_stopping_patience is not None: config.early_stopping_patience = args.early_stopping_patience
+if args.early_stopping_metric is not None: config.early_stopping_metric = args.early_stopping_metric
+if args.validation_interval is not None: config.validation_interval = args.validation_interval
+if args.validation_subset_size is not None: config.validation_subset_size = args.validation_subset_size
+if args.training_state_interval is not None: config.training_state_interval = args.training_state_interval
+if args.resume and restart:
+	parser.error("use --restart to evaluate a trained model, or --resume to continue training it")
 torch.manual_seed(config.seed); np.random.seed(config.seed)
 
+# Multi-process data-parallel training when launched with torchrun (e.g., torchrun --nproc_per_node=4 main.py --train ...)
+rank, world_size = init_from_env()
+if config.num_threads > 0: torch.set_num_threads(config.num_threads)
+if world_size > 1 and (pipeline_train or pipeline_gold_train or get_words):
+	parser.error("only --pretrain and --train can run in multiple processes")
+summary = {} # final results of the run (saved to --summary_path)
+trainer = None
+
 if pretrain:
 	# Generate datasets
 	train_dataset, valid_dataset, test_dataset = get_ASR_datasets(config)
+	if world_size > 1: # each process reads its share of each dataset
+		for dataset in [train_dataset, valid_dataset, test_dataset]:
+			distribute_loader(dataset, rank, world_size, seed=config.seed, shuffle=(dataset is train_dataset))
 
 	# Initialize base model
 	pretrained_model = PretrainedModel(config=config)
@@ -116,8 +155,10 @@ if pretrain:
 	# Train the base model
 	trainer = Trainer(model=pretrained_model, config=config)
 	if restart: trainer.load_checkpoint()
+	if args.resume: trainer.load_training_state()
 
-	for epoch in range(config.pretraining_num_epochs):
+	start_epoch = trainer.epoch
+	for epoch in range(start_epoch, config.pretraining_num_epochs):
 		print("========= Epoch %d of %d =========" % (epoch+1, config.pretraining_num_epochs))
 		train_phone_acc, train_phone_loss, train_word_acc, train_word_loss = trainer.train(train_dataset)
 		valid_phone_acc, valid_phone_loss, valid_word_acc, valid_word_loss = trainer.test(valid_dataset)
@@ -127,6 +168,10 @@ if pretrain:
 		print("*words*| train accuracy: %.2f| train loss: %.2f| valid accuracy: %.2f| valid loss: %.2f\n" % (train_word_acc, train_word_loss, valid_word_acc, valid_word_loss) )
 
 		trainer.save_checkpoint()
+		if config.training_state_interval > 0: trainer.save_training_state()
+
+	if config.pretraining_num_epochs > start_epoch:
+		summary.update({"train_phone_acc": train_phone_acc, "train_phone_loss": train_phone_loss, "train_word_acc": train_word_acc, "train_word_loss": train_word_loss, "valid_phone_acc": valid_phone_acc, "valid_phone_loss": valid_phone_loss, "valid_word_acc": valid_word_acc, "valid_word_loss": valid_word_loss})
 
 if train:
 
@@ -210,6 +255,9 @@ if train:
 	else:
 		train_dataset, valid_dataset, test_dataset = get_SLU_datasets(config,data_str=data_str,split_style=resplit_style, single_label=single_label,\
 	 	use_all_gold = use_all_gold, use_gold_utterances = use_gold_utterances)
+	if world_size > 1: # each process reads its share of each dataset
+		for dataset in [train_dataset, valid_dataset] + ([test_closed_utterance_dataset, test_closed_speaker_dataset] if (resplit_style=="unseen" or resplit_style=="challenge") else [test_dataset]):
+			distribute_loader(dataset, rank, world_size, seed=config.seed, shuffle=(dataset is train_dataset))
 	# Initialize final model
 
 	if use_semantic_embeddings: # Load Glove embedding
@@ -231,14 +279,26 @@ if train:
 
 	# Train the final model
 	trainer = Trainer(model=model, config=config)
+	trainer.training_state_path = "training_state" + model_path[len("model_state"):]
 	if restart: 
 		trainer.load_checkpoint(model_path)
 		config.training_num_epochs=0
 		valid_intent_acc=0
 		valid_intent_loss=0
 		log_file=log_file+"_restart"
+	if args.resume and trainer.load_training_state():
+		valid_intent_acc = trainer.extra_state.get("valid_intent_acc", 0)
+		valid_intent_loss = trainer.extra_state.get("valid_intent_loss", 0)
+		if save_best_model:
+			best_valid_acc = trainer.extra_state.get("best_valid_acc", best_valid_acc)
+			best_valid_loss = trainer.extra_state.get("best_valid_loss", 0)
 	log_file=log_file+".csv"
-	for epoch in range(config.training_num_epochs):
+	if config.validation_interval > 0:
+		trainer.set_validation_subset(valid_dataset, config.validation_subset_size)
+	train_start = time.perf_counter()
+	start_epoch = config.training_num_epochs if trainer.early_stopping.stopped else min(trainer.epoch, config.training_num_epochs)
+	start_num_steps = trainer.num_steps
+	for epoch in range(start_epoch, config.training_num_epochs):
 		print("========= Epoch %d of %d =========" % (epoch+1, config.training_num_epochs))
 		train_intent_acc, train_intent_loss = trainer.train(train_dataset,log_file=log_file)
 		valid_intent_acc, valid_intent_loss = trainer.test(valid_dataset,log_file=log_file)
@@ -252,6 +312,24 @@ if train:
 				best_valid_acc=valid_intent_acc
 				best_valid_loss=valid_intent_loss
 				trainer.save_checkpoint(model_path=best_model_path)		
+				trainer.extra_state.update({"best_valid_acc": best_valid_acc, "best_valid_loss": best_valid_loss})
+
+		if config.validation_interval == 0: # otherwise, checked after each validation on the subset
+			trainer.early_stopping.update({"intent_acc": valid_intent_acc, "intent_loss": valid_intent_loss})
+		trainer.extra_state.update({"valid_intent_acc": valid_intent_acc, "valid_intent_loss": valid_intent_loss})
+		if config.training_state_interval > 0: trainer.save_training_state()
+		if trainer.early_stopping.stopped:
+			print("Early stopping: no improvement of %s in the last %d validations (best: %.4f)" % (config.early_stopping_metric, config.early_stopping_patience, trainer.early_stopping.best))
+			break
+
+	if config.training_num_epochs > 0: # compute saved by early stopping
+		train_time = time.perf_counter() - train_start # of this process (after resuming, only the steps from start_num_steps)
+		planned_steps = config.training_num_epochs * len(train_dataset.loader)
+		steps_saved = planned_steps - trainer.num_steps
+		summary.update({"epochs_run": trainer.epoch, "planned_epochs": config.training_num_epochs, "steps_run": trainer.num_steps, "planned_steps": planned_steps, "early_stopped": trainer.early_stopping.stopped, "resumed_from_step": start_num_steps,
+			"compute_saved_fraction": steps_saved / planned_steps if planned_steps > 0 else 0., "train_time_s": train_time, "estimated_time_saved_s": train_time / max(trainer.num_steps - start_num_steps, 1) * steps_saved, "subset_validation_time_s": trainer.validation_time})
+		if trainer.early_stopping.stopped:
+			print("Ran %d of %d training steps: saved %.0f%% of the steps (about %.0fs)" % (trainer.num_steps, planned_steps, 100 * summary["compute_saved_fraction"], summary["estimated_time_saved_s"]))
 
 	if (resplit_style=="unseen" or resplit_style=="challenge"):
 		test_utterance_intent_acc, test_utterance_intent_loss = trainer.test(test_closed_utterance_dataset,log_file=log_file)
@@ -262,9 +340,12 @@ if train:
 		test_intent_acc, test_intent_loss = trainer.test(test_dataset,log_file=log_file)
 		print("========= Test results =========")
 		print("*intents*| test accuracy: %.2f| test loss: %.2f| valid accuracy: %.2f| valid loss: %.2f\n" % (test_intent_acc, test_intent_loss, valid_intent_acc, valid_intent_loss) )
-	if save_best_model:
-		if restart: 
-			exit()
+	summary.update({"valid_intent_acc": valid_intent_acc, "valid_intent_loss": valid_intent_loss})
+	if (resplit_style=="unseen" or resplit_style=="challenge"):
+		summary.update({"test_utterance_intent_acc": test_utterance_intent_acc, "test_utterance_intent_loss": test_utterance_intent_loss, "test_speaker_intent_acc": test_speaker_intent_acc, "test_speaker_intent_loss": test_speaker_intent_loss})
+	else:
+		summary.update({"test_intent_acc": test_intent_acc, "test_intent_loss": test_intent_loss})
+	if save_best_model and not restart: # with --restart, the loaded model was evaluated above
 		trainer.load_checkpoint(model_path=best_model_path) # Compute performance of best model on test set
 		if (resplit_style=="unseen" or resplit_style=="challenge"):
 			test_utterance_intent_acc, test_utterance_intent_loss = trainer.test(test_closed_utterance_dataset,log_file=log_file)
@@ -275,6 +356,11 @@ if train:
 			test_intent_acc, test_intent_loss = trainer.test(test_dataset,log_file=log_file)
 			print("========= Test results =========")
 			print("*intents*| test accuracy: %.2f| test loss: %.2f| valid accuracy: %.2f| valid loss: %.2f\n" % (test_intent_acc, test_intent_loss, best_valid_acc, best_valid_loss) )
+		summary.update({"best_valid_intent_acc": best_valid_acc, "best_valid_intent_loss": best_valid_loss})
+		if (resplit_style=="unseen" or resplit_style=="challenge"):
+			summary.update({"best_test_utterance_intent_acc": test_utterance_intent_acc, "best_test_utterance_intent_loss": test_utterance_intent_loss, "best_test_speaker_intent_acc": test_speaker_intent_acc, "best_test_speaker_intent_loss": test_speaker_intent_loss})
+		else:
+			summary.update({"best_test_intent_acc": test_intent_acc, "best_test_intent_loss": test_intent_loss})
 
 if get_words: # Generate predict utterances by ASR module
 	# Generate datasets
@@ -287,10 +373,10 @@ if get_words: # Generate predict utterances by ASR module
 	# Initialize final model
 	if use_FastText_embeddings: # Load FastText embeddings
 		FastText_embeddings=obtain_fasttext_embeddings(semantic_embeddings_path, Sy_word)
-		model = Model(config=config,pipeline=False, use_semantic_embeddings = use_FastText_embeddings, glove_embeddings=FastText_embeddings,glove_emb_dim=300)
+		model = Model(config=config,pipeline=False, use_semantic_embeddings = use_FastText_embeddings, glove_embeddings=FastText_embeddings,glove_emb_dim=300, lazy_pretrained=restart)
 
 	else:
-		model = Model(config=config)
+		model = Model(config=config, lazy_pretrained=restart) # the fine-tuned checkpoint replaces the pre-trained weights
 
 	# Load pretrained model
 	trainer = Trainer(model=model, config=config)
@@ -303,6 +389,7 @@ if get_words: # Generate predict utterances by ASR module
 			trainer.load_checkpoint("model_state_disjoint_best.pth")
 		elif use_FastText_embeddings:
 			trainer.load_checkpoint("model_state_FastText.pth")
+	model.load_pretrained() # does nothing if a checkpoint was loaded above
 
 	# get words from pretrained model
 	if complete:
@@ -463,3 +550,8 @@ if pipeline_gold_train: # Train model in pipeline manner by using gold set utter
 			print("========= Test results =========")
 			print("*intents*| test accuracy: %.2f| test loss: %.2f| valid accuracy: %.2f| valid loss: %.2f\n" % (test_intent_acc, test_intent_loss, best_valid_acc, best_valid_loss) )
 
+if trainer is not None: trainer.checkpoint_writer.wait() # raises if the last checkpoints could not be written
+if args.summary_path is not None and rank == 0:
+	with open(args.summary_path, "w") as f:
+		json.dump(summary, f, indent=1)
+cleanup()
@@ -0,0 +1,213 @@
+import os
+import csv
+import json
+import time
+import torch
+from distributed import is_distributed, all_reduce_sum
+
+class MetricsWriter:
+	"""
+	Append-only metrics file. Rows (dictionaries) are buffered and appended in batches.
+
+	Files ending in ".jsonl" get one JSON object per line; anything else is written as CSV
+	with the same layout as pandas.DataFrame.to_csv (an unnamed index column, then one column per field).
+	The file is overwritten by the first flush, like the log files of previous runs were, unless append is True:
+	then the rows are added after those already in the file.
+	The CSV columns are those of the first row; when a row has new fields, they are added as columns
+	and the file (usually small) is rewritten with the new header, leaving the new columns empty in the old rows.
+	"""
+	def __init__(self, path, flush_every=1, append=False):
+		self.path = path
+		self.flush_every = flush_every
+		self.jsonl = path.endswith(".jsonl")
+		self.fields = None
+		self.buffer = []
+		self.num_rows = 0
+		self.started = False
+		self.new_fields = False
+		if append and os.path.exists(path) and os.path.getsize(path) > 0:
+			self.started = True
+			if not self.jsonl:
+				with open(path, newline="") as f:
+					rows = csv.reader(f)
+					self.fields = next(rows)[1:]
+					self.num_rows = sum(1 for _ in rows)
+
+	def write(self, row):
+		if self.fields is None:
+			self.fields = list(row)
+		if not self.jsonl and any(field not in self.fields for field in row):
+			self.fields += [field for field in row if field not in self.fields]
+			self.new_fields = True
+		self.buffer.append(row)
+		if len(self.buffer) >= self.flush_every:
+			self.flush()
+
+	def rewrite_header(self):
+		"""
+		Rewrites the CSV file with the current fields as header (the rows already written keep their values).
+		"""
+		with open(self.path, newline="") as f:
+			rows = list(csv.reader(f))
+		with open(self.path + ".tmp", "w", newline="") as f:
+			writer = csv.writer(f)
+			writer.writerow([""] + self.fields)
+			for row in rows[1:]:
+				writer.writerow(row + [""] * (len(self.fields) + 1 - len(row)))
+		os.replace(self.path + ".tmp", self.path)
+
+	def flush(self):
+		if len(self.buffer) == 0 and self.started: return
+		if self.new_fields and self.started:
+			self.rewrite_header()
+		self.new_fields = False
+		with open(self.path, "a" if self.started else "w", newline="") as f:
+			if self.jsonl:
+				for row in self.buffer:
+					f.write(json.dumps(row) + "\n")
+			else:
+				writer = csv.writer(f)
+				if not self.started and self.fields is not None:
+					writer.writerow([""] + self.fields)
+				for row in self.buffer:
+					writer.writerow([self.num_rows] + [row.get(field, "") for field in self.fields])
+					self.num_rows += 1
+		self.started = True
+		self.buffer = []
+
+def steps_path(log_file):
+	"""
+	Name of the per-step log that goes with log_file (e.g., log.csv --> log_steps.csv).
+	"""
+	root, ext = os.path.splitext(log_file)
+	return root + "_steps" + ext
+
+class ThroughputMeter:
+	"""
+	Measures, for each training step, the time spent waiting for the batch and the samples/s and
+	audio-seconds/s (of padded audio), and the same quantities over the whole epoch.
+	"""
+	def __init__(self, fs):
+		self.fs = fs
+		self.start = self.last = time.perf_counter()
+		self.wait = 0
+		self.num_samples = 0
+		self.audio_seconds = 0
+		self.data_wait = 0
+		self.paused = 0
+
+	def batch_ready(self):
+		"""
+		Call when the data loader has returned the batch.
+		"""
+		self.wait = time.perf_counter() - self.last
+		self.data_wait += self.wait
+
+	def step_done(self, x):
+		"""
+		x : Tensor of shape (batch size, T) (the audio of the step)
+
+		Returns the throughput fields of the step (since the end of the previous step).
+		"""
+		now = time.perf_counter()
+		elapsed = now - self.last
+		self.last = now
+		batch_size = x.shape[0]
+		audio_seconds = x.shape[0] * x.shape[1] / self.fs
+		self.num_samples += batch_size
+		self.audio_seconds += audio_seconds
+		return {"batch_size": batch_size, "samples_per_s": batch_size / elapsed, "audio_s_per_s": audio_seconds / elapsed, "data_wait": self.wait}
+
+	def resume(self):
+		"""
+		Call after work between two training steps that is not training (e.g., validation),
+		so that it is neither counted as waiting for data nor in the epoch throughput.
+		"""
+		now = time.perf_counter()
+		self.paused += now - self.last
+		self.last = now
+
+	def all_reduce(self):
+		"""
+		Sums the samples and audio seconds over the processes of a distributed run (call on every process), so that
+		epoch_results gives the throughput of the whole run.
+		"""
+		if not is_distributed(): return
+		self.num_samples, self.audio_seconds = all_reduce_sum([self.num_samples, self.audio_seconds])
+
+	def epoch_results(self):
+		elapsed = time.perf_counter() - self.start - self.paused
+		return {"samples_per_s": self.num_samples / elapsed, "audio_s_per_s": self.audio_seconds / elapsed, "data_wait": self.data_wait}
+
+class MetricsAccumulator:
+	"""
+	Running sums of per-batch metrics, kept as tensors on the device they are computed on,
+	so that the training loop does not wait for the device at every batch.
+	The values are only copied to the host by steps() and means().
+	"""
+	def __init__(self):
+		self.sums = {}
+		self.num_examples = 0
+		self.pending_steps = []
+
+	def add(self, batch_size, metrics, step_info=None):
+		"""
+		batch_size : integer
+		metrics : dictionary (name --> Tensor with one element, the mean over the batch)
+		step_info : dictionary of host values (e.g., step index, throughput); if given, a per-step row is kept until steps() is called
+		"""
+		self.num_examples += batch_size
+		metrics = {name: value.detach().reshape(()).float() for name, value in metrics.items()}
+		for name, value in metrics.items():
+			if name in self.sums:
+				self.sums[name].add_(value, alpha=batch_size)
+			else:
+				self.sums[name] = value * batch_size
+		if step_info is not None:
+			self.pending_steps.append((step_info, metrics))
+
+	def steps(self):
+		"""
+		Returns the per-step rows kept since the last call (one device-to-host copy per metric).
+		"""
+		if len(self.pending_steps) == 0: return []
+		values = {}
+		for name in self.pending_steps[0][1]:
+			values[name] = torch.stack([metrics[name] for _, metrics in self.pending_steps]).tolist()
+		rows = []
+		for idx, (step_info, _) in enumerate(self.pending_steps):
+			row = dict(step_info)
+			for name in values:
+				row[name] = values[name][idx]
+			rows.append(row)
+		self.pending_steps = []
+		return rows
+
+	def all_reduce(self):
+		"""
+		Sums the metrics and example counts over the processes of a distributed run (call on every process),
+		so that means() averages over all the examples seen by the run.
+		"""
+		if not is_distributed() or len(self.sums) == 0: return
+		names = sorted(self.sums)
+		device = self.sums[names[0]].device # some metrics may be on another device (e.g., the CPU placeholder word loss of pretraining_type 1)
+		totals = all_reduce_sum(torch.stack([self.sums[name].to(device) for name in names] + [torch.tensor(float(self.num_examples), device=device)]))
+		for idx, name in enumerate(names):
+			self.sums[name] = totals[idx]
+		self.num_examples = int(round(totals[-1].item()))
+
+	def state_dict(self):
+		"""
+		Returns the running sums and example count (call steps() first), to continue the epoch in a resumed run.
+		"""
+		return {"sums": dict(self.sums), "num_examples": self.num_examples}
+
+	def load_state_dict(self, state):
+		self.sums = {name: total.clone() for name, total in state["sums"].items()}
+		self.num_examples = state["num_examples"]
+
+	def means(self):
+		"""
+		Returns the average of each metric over all examples.
+		"""
+		return {name: (total / self.num_examples).item() for name, total in self.sums.items()}
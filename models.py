@@ -1,9 +1,10 @@
 import torch
+import torch.utils.checkpoint
 import numpy as np
 import sys
 import os
 import math
-import io
+import hashlib
 
 np.random.seed(0)
 
@@ -26,6 +27,54 @@ def sinc(band,t_right):
 
 	return y
 
+def read_state_dict(path, is_cuda=False):
+	"""
+	Reads a state dict saved with torch.save. The file is memory-mapped, so tensors are paged in
+	as load_state_dict copies them instead of being read into memory first.
+
+	Delta checkpoints (see training.CheckpointWriter) are completed with the tensors of their base checkpoint.
+	"""
+	map_location = None if is_cuda else "cpu"
+	try:
+		state_dict = torch.load(path, map_location=map_location, mmap=True)
+	except RuntimeError:
+		# files in the legacy (pre-zipfile) format can't be memory-mapped
+		state_dict = torch.load(path, map_location=map_location)
+
+	if "delta_from" in state_dict:
+		base_path = os.path.join(os.path.dirname(os.path.abspath(path)), state_dict["delta_from"]) # relative to the delta checkpoint
+		if not os.path.isfile(base_path): base_path = state_dict["delta_from"] # older delta checkpoints: relative to the working directory
+		base = read_state_dict(base_path, is_cuda)
+		if "delta_from_fingerprint" in state_dict:
+			unchanged = state_dict_fingerprint(base) == state_dict["delta_from_fingerprint"]
+		else:
+			unchanged = os.path.getsize(base_path) == state_dict["delta_from_size"]
+		if not unchanged:
+			raise ValueError(base_path + " has changed since the delta checkpoint " + path + " was saved, so it cannot be rebuilt")
+		full_state_dict = {state_dict["delta_prefix"] + name: tensor for name, tensor in base.items()}
+		full_state_dict.update(state_dict["state_dict"])
+		return full_state_dict
+	return state_dict
+
+def state_dict_fingerprint(state_dict):
+	"""
+	Returns a hash of the names, shapes, dtypes and values of the tensors of a state dict
+	(delta checkpoints keep the one of their base, to check that it has not changed).
+	"""
+	fingerprint = hashlib.sha1()
+	for name in sorted(state_dict):
+		tensor = state_dict[name].detach().cpu().contiguous()
+		fingerprint.update((name + str(tuple(tensor.shape)) + str(tensor.dtype)).encode("utf-8"))
+		fingerprint.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+	return fingerprint.hexdigest()
+
+def bf16_autocast(module):
+	"""
+	Returns a bf16 autocast context on the device of module if module.use_bf16 is set (otherwise, a context that does nothing).
+	"""
+	device_type = next(module.parameters()).device.type
+	return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=module.use_bf16)
+
 class Downsample(torch.nn.Module):
 	"""
 	Downsamples the input in the time/sequence domain
@@ -79,36 +128,38 @@ class SincLayer(torch.nn.Module):
 
 	def forward(self, x):
 		self.is_cuda = next(self.parameters()).is_cuda
-		filters=torch.zeros((self.N_filt,self.Filt_dim)) #.cuda()
-		if self.is_cuda: filters = filters.cuda()
-		N=self.Filt_dim
-		t_right=(torch.linspace(1, (N-1)/2, steps=int((N-1)/2))/self.fs) #.cuda()
-		if self.is_cuda: t_right = t_right.cuda()
+		# build the filters in fp32 even when the rest of the model runs in bf16
+		with torch.autocast(device_type=x.device.type, enabled=False):
+			filters=torch.zeros((self.N_filt,self.Filt_dim)) #.cuda()
+			if self.is_cuda: filters = filters.cuda()
+			N=self.Filt_dim
+			t_right=(torch.linspace(1, (N-1)/2, steps=int((N-1)/2))/self.fs) #.cuda()
+			if self.is_cuda: t_right = t_right.cuda()
 
-		min_freq=50.0;
-		min_band=50.0;
+			min_freq=50.0;
+			min_band=50.0;
 
-		filt_beg_freq=torch.abs(self.filt_b1)+min_freq/self.freq_scale
-		filt_end_freq=filt_beg_freq+(torch.abs(self.filt_band)+min_band/self.freq_scale)
+			filt_beg_freq=torch.abs(self.filt_b1)+min_freq/self.freq_scale
+			filt_end_freq=filt_beg_freq+(torch.abs(self.filt_band)+min_band/self.freq_scale)
 
-		n=torch.linspace(0, N, steps=N)
+			n=torch.linspace(0, N, steps=N)
 
-		# Filter window (hamming)
-		window=0.54-0.46*torch.cos(2*math.pi*n/N);
-		window=window.float() #.cuda()
-		if self.is_cuda: window = window.cuda()
+			# Filter window (hamming)
+			window=0.54-0.46*torch.cos(2*math.pi*n/N);
+			window=window.float() #.cuda()
+			if self.is_cuda: window = window.cuda()
 
-		for i in range(self.N_filt):
-			low_pass1 = 2*filt_beg_freq[i].float()*sinc(filt_beg_freq[i].float()*self.freq_scale,t_right)
-			low_pass2 = 2*filt_end_freq[i].float()*sinc(filt_end_freq[i].float()*self.freq_scale,t_right)
-			band_pass=(low_pass2-low_pass1)
+			for i in range(self.N_filt):
+				low_pass1 = 2*filt_beg_freq[i].float()*sinc(filt_beg_freq[i].float()*self.freq_scale,t_right)
+				low_pass2 = 2*filt_end_freq[i].float()*sinc(filt_end_freq[i].float()*self.freq_scale,t_right)
+				band_pass=(low_pass2-low_pass1)
 
-			band_pass=band_pass/torch.max(band_pass)
-			if self.is_cuda: band_pass = band_pass.cuda()
+				band_pass=band_pass/torch.max(band_pass)
+				if self.is_cuda: band_pass = band_pass.cuda()
 
-			filters[i,:]=band_pass*window
+				filters[i,:]=band_pass*window
 
-			out=torch.nn.functional.conv1d(x, filters.view(self.N_filt,1,self.Filt_dim), stride=self.stride, padding=self.padding)
+		out=torch.nn.functional.conv1d(x, filters.view(self.N_filt,1,self.Filt_dim), stride=self.stride, padding=self.padding)
 
 		return out
 
@@ -138,6 +189,17 @@ class NCL2NLC(torch.nn.Module):
 
 		return input.transpose(1,2)
 
+class GRU(torch.nn.GRU):
+	"""
+	torch.nn.GRU that keeps its recurrence in fp32 under CPU autocast
+	(the bf16 GRU is not fused on CPU and runs slower than the fp32 one).
+	"""
+	def forward(self, input, hx=None):
+		if input.device.type == "cpu" and torch.is_autocast_enabled("cpu"):
+			with torch.autocast(device_type="cpu", enabled=False):
+				return super(GRU, self).forward(input.float(), hx)
+		return super(GRU, self).forward(input, hx)
+
 class RNNSelect(torch.nn.Module):
 	def __init__(self):
 		super(RNNSelect, self).__init__()
@@ -170,6 +232,58 @@ class Abs(torch.nn.Module):
 	def forward(self, input):
 		return torch.abs(input) 
 
+class MultiSlotClassifier(torch.nn.Module):
+	"""
+	Scores every slot of a fixed-length intent in one pass.
+	The intent logits are the concatenation of one segment of values per slot.
+	"""
+	def __init__(self, values_per_slot):
+		super(MultiSlotClassifier, self).__init__()
+		self.values_per_slot = values_per_slot
+		num_slots = len(values_per_slot)
+		max_values = max(values_per_slot)
+
+		# segment_index[slot, i] is the column of the i-th value of slot; shorter slots are padded
+		segment_index = torch.zeros(num_slots, max_values).long()
+		segment_mask = torch.zeros(num_slots, max_values).bool()
+		start_idx = 0
+		for slot in range(num_slots):
+			end_idx = start_idx + values_per_slot[slot]
+			segment_index[slot, :values_per_slot[slot]] = torch.arange(start_idx, end_idx)
+			segment_mask[slot, :values_per_slot[slot]] = True
+			start_idx = end_idx
+		self.register_buffer("segment_index", segment_index, persistent=False)
+		self.register_buffer("segment_mask", segment_mask, persistent=False)
+
+	def log_probs(self, intent_logits):
+		"""
+		intent_logits : Tensor of shape (batch size, num_values_total)
+
+		Outputs a Tensor of shape (batch size, num_slots, max values per slot)
+		containing the log-softmax over the values of each slot (padding is -inf).
+		"""
+		batch_size = intent_logits.shape[0]
+		logits = intent_logits.gather(1, self.segment_index.view(1, -1).expand(batch_size, -1)).view(batch_size, *self.segment_index.shape)
+		logits = logits.masked_fill(~self.segment_mask, float("-inf"))
+		return torch.nn.functional.log_softmax(logits, dim=2)
+
+	def forward(self, intent_logits, y_intent=None, k=1):
+		"""
+		intent_logits : Tensor of shape (batch size, num_values_total)
+		y_intent : LongTensor of shape (batch size, num_slots), or None
+		k : integer (number of top values to return per slot)
+
+		Returns the loss (sum over slots of the mean cross-entropy; None if y_intent is None),
+		the predicted intent (batch size, num_slots), and the top-k log-probabilities and values (batch size, num_slots, k).
+		"""
+		log_probs = self.log_probs(intent_logits)
+		top_scores, top_values = log_probs.topk(min(k, log_probs.shape[2]), dim=2)
+		predicted_intent = top_values[:, :, 0]
+		intent_loss = None
+		if y_intent is not None:
+			intent_loss = -log_probs.gather(2, y_intent.unsqueeze(2)).sum() / y_intent.shape[0]
+		return intent_loss, predicted_intent, top_scores, top_values
+
 class PretrainedModel(torch.nn.Module):
 	"""
 	Model pre-trained to recognize phonemes and words.
@@ -232,7 +346,7 @@ class PretrainedModel(torch.nn.Module):
 		out_dim = config.cnn_N_filt[-1]
 		for idx in range(num_rnn_layers):
 			# recurrent
-			layer = torch.nn.GRU(input_size=out_dim, hidden_size=config.phone_rnn_num_hidden[idx], batch_first=True, bidirectional=config.phone_rnn_bidirectional)
+			layer = GRU(input_size=out_dim, hidden_size=config.phone_rnn_num_hidden[idx], batch_first=True, bidirectional=config.phone_rnn_bidirectional)
 			layer.name = "phone_rnn%d" % idx
 			self.phoneme_layers.append(layer)
 		
@@ -262,7 +376,7 @@ class PretrainedModel(torch.nn.Module):
 		num_rnn_layers = len(config.word_rnn_num_hidden)
 		for idx in range(num_rnn_layers):
 			# recurrent
-			layer = torch.nn.GRU(input_size=out_dim, hidden_size=config.word_rnn_num_hidden[idx], batch_first=True, bidirectional=config.word_rnn_bidirectional)
+			layer = GRU(input_size=out_dim, hidden_size=config.word_rnn_num_hidden[idx], batch_first=True, bidirectional=config.word_rnn_bidirectional)
 			layer.name = "word_rnn%d" % idx
 			self.word_layers.append(layer)
 		
@@ -288,9 +402,44 @@ class PretrainedModel(torch.nn.Module):
 		self.word_layers = torch.nn.ModuleList(self.word_layers)
 		self.word_linear = torch.nn.Linear(out_dim, config.vocabulary_size)
 		self.pretraining_type = config.pretraining_type
+		self.use_bf16 = (config.precision == "bf16")
+		self.activation_checkpointing = config.activation_checkpointing
 		if self.is_cuda:
 			self.cuda()
 
+	def is_checkpointed(self, block):
+		"""
+		block : "cnn", "phone_rnn<idx>" or "word_rnn<idx>"
+
+		A block is checkpointed if it, or its prefix without the index (e.g., "word_rnn"), is listed in the config, or if "all" is listed.
+		"""
+		for name in self.activation_checkpointing:
+			if name == "all" or name == block or name == block.rstrip("0123456789"):
+				return True
+		return False
+
+	def run_layers(self, layers, out):
+		"""
+		layers : self.phoneme_layers or self.word_layers
+		out : input to the first layer
+
+		Runs the layers in order. During training, the activations of checkpointed blocks are
+		not stored; they are recomputed from the block input in the backward pass.
+		"""
+		blocks = []
+		for layer in layers:
+			block = checkpoint_block(layer)
+			if len(blocks) == 0 or blocks[-1][0] != block:
+				blocks.append((block, []))
+			blocks[-1][1].append(layer)
+
+		for block, block_layers in blocks:
+			if self.training and torch.is_grad_enabled() and self.is_checkpointed(block):
+				out = torch.utils.checkpoint.checkpoint(run_sequential, block_layers, out, use_reentrant=False)
+			else:
+				out = run_sequential(block_layers, out)
+		return out
+
 	def forward(self, x, y_phoneme, y_word):
 		"""
 		x : Tensor of shape (batch size, T)
@@ -305,11 +454,10 @@ class PretrainedModel(torch.nn.Module):
 			y_phoneme = y_phoneme.cuda()
 			y_word = y_word.cuda()
 
-		out = x.unsqueeze(1)
-		for layer in self.phoneme_layers:
-			out = layer(out)
-		phoneme_logits = self.phoneme_linear(out)
-		phoneme_logits = phoneme_logits.view(phoneme_logits.shape[0]*phoneme_logits.shape[1], -1)
+		with bf16_autocast(self):
+			out = self.run_layers(self.phoneme_layers, x.unsqueeze(1))
+			phoneme_logits = self.phoneme_linear(out)
+		phoneme_logits = phoneme_logits.float().view(phoneme_logits.shape[0]*phoneme_logits.shape[1], -1)
 		y_phoneme = y_phoneme.view(-1)
 
 		phoneme_loss = torch.nn.functional.cross_entropy(phoneme_logits, y_phoneme, ignore_index=-1)
@@ -321,10 +469,10 @@ class PretrainedModel(torch.nn.Module):
 			word_loss = torch.tensor([0.])
 			word_acc = torch.tensor([0.])
 		else:
-			for layer in self.word_layers:
-				out = layer(out)
-			word_logits = self.word_linear(out)
-			word_logits = word_logits.view(word_logits.shape[0]*word_logits.shape[1], -1)
+			with bf16_autocast(self):
+				out = self.run_layers(self.word_layers, out)
+				word_logits = self.word_linear(out)
+			word_logits = word_logits.float().view(word_logits.shape[0]*word_logits.shape[1], -1)
 			y_word = y_word.view(-1)
 
 			word_loss = torch.nn.functional.cross_entropy(word_logits, y_word, ignore_index=-1)
@@ -333,20 +481,27 @@ class PretrainedModel(torch.nn.Module):
 
 		return phoneme_loss, word_loss, phoneme_acc, word_acc
 
-	def compute_posteriors(self, x):
+	def compute_outputs(self, x):
+		"""
+		x : Tensor of shape (batch size, T)
+
+		Runs the backbone once and returns the phoneme logits, the features (output of the word layers) and the word logits.
+		"""
 		self.is_cuda = next(self.parameters()).is_cuda
 		if self.is_cuda:
 			x = x.cuda()
 
-		out = x.unsqueeze(1)
-		for layer in self.phoneme_layers:
-			out = layer(out)
-		phoneme_logits = self.phoneme_linear(out)
+		with bf16_autocast(self):
+			out = self.run_layers(self.phoneme_layers, x.unsqueeze(1))
+			phoneme_logits = self.phoneme_linear(out)
 
-		for layer in self.word_layers:
-			out = layer(out)
-		word_logits = self.word_linear(out)
+			features = self.run_layers(self.word_layers, out)
+			word_logits = self.word_linear(features)
+
+			return phoneme_logits, features, word_logits
 
+	def compute_posteriors(self, x):
+		phoneme_logits, _, word_logits = self.compute_outputs(x)
 		return phoneme_logits, word_logits
 
 	def compute_features(self, x):
@@ -354,14 +509,27 @@ class PretrainedModel(torch.nn.Module):
 		if self.is_cuda:
 			x = x.cuda()
 
-		out = x.unsqueeze(1)
-		for layer in self.phoneme_layers:
-			out = layer(out)
+		with bf16_autocast(self):
+			out = self.run_layers(self.phoneme_layers, x.unsqueeze(1))
 
-		for layer in self.word_layers:
-			out = layer(out)
+			out = self.run_layers(self.word_layers, out)
 
-		return out
+			return out
+
+def checkpoint_block(layer):
+	"""
+	Name of the activation checkpointing block that layer belongs to:
+	"cnn" (front-end up to ncl2nlc), "phone_rnn<idx>" or "word_rnn<idx>" (GRU, select, dropout and downsample).
+	"""
+	if layer.name.startswith("phone_") or layer.name.startswith("word_"):
+		idx = layer.name[len(layer.name.rstrip("0123456789")):]
+		return layer.name.split("_")[0] + "_rnn" + idx
+	return "cnn"
+
+def run_sequential(layers, out):
+	for layer in layers:
+		out = layer(out)
+	return out
 
 def freeze_layer(layer):
 	for param in layer.parameters():
@@ -388,7 +556,7 @@ class Seq2SeqEncoder(torch.nn.Module):
 		self.layers = []
 		for idx in range(num_layers):
 			# recurrent
-			layer = torch.nn.GRU(input_size=out_dim, hidden_size=encoder_dim, batch_first=True, bidirectional=True)
+			layer = GRU(input_size=out_dim, hidden_size=encoder_dim, batch_first=True, bidirectional=True)
 			layer.name = "intent_encoder_rnn%d" % idx
 			self.layers.append(layer)
 		
@@ -420,7 +588,6 @@ class Attention(torch.nn.Module):
 		self.key_linear = torch.nn.Linear(encoder_dim, key_dim)
 		self.query_linear = torch.nn.Linear(decoder_dim, key_dim)
 		self.value_linear = torch.nn.Linear(encoder_dim, value_dim)
-		self.softmax = torch.nn.Softmax(dim=1)
 
 	def forward(self, encoder_states, decoder_state):
 		"""
@@ -429,13 +596,33 @@ class Attention(torch.nn.Module):
 
 		Map the input sequence to a summary vector (batch size, value_dim) using attention, given a query.
 		"""
-		keys = self.key_linear(encoder_states)
-		values = self.value_linear(encoder_states)
+		keys, values = self.project(encoder_states)
+		return self.attend(keys, values, decoder_state)
+
+	def project(self, encoder_states):
+		"""
+		encoder_states: Tensor of shape (batch size, T, encoder_dim)
+
+		Compute the keys (batch size, T, key_dim) and values (batch size, T, value_dim).
+		These only depend on the input sequence, so the decoder computes them once per utterance.
+		"""
+		return self.key_linear(encoder_states), self.value_linear(encoder_states)
+
+	def attend(self, keys, values, decoder_state):
+		"""
+		keys: Tensor of shape (batch size, T, key_dim)
+		values: Tensor of shape (batch size, T, value_dim)
+		decoder_state: Tensor of shape (batch size, decoder_dim), or (batch size, N, decoder_dim) for N queries per input (e.g., beam hypotheses)
+
+		Map the precomputed keys and values to a summary vector (batch size, [N,] value_dim) for each query.
+		"""
 		query = self.query_linear(decoder_state)
-		query = query.unsqueeze(2)
-		scores = torch.matmul(keys, query) / self.scale_factor
-		normalized_scores = self.softmax(scores).transpose(1,2)
-		out = torch.matmul(normalized_scores, values).squeeze(1)
+		single_query = (query.dim() == 2)
+		if single_query: query = query.unsqueeze(1)
+		scores = torch.matmul(query, keys.transpose(1,2)) / self.scale_factor
+		normalized_scores = torch.nn.functional.softmax(scores, dim=2)
+		out = torch.matmul(normalized_scores, values)
+		if single_query: out = out.squeeze(1)
 		return out
 
 class DecoderRNN(torch.nn.Module):
@@ -486,25 +673,11 @@ class DecoderRNN(torch.nn.Module):
 		state = torch.stack(state, dim=1)
 		return state 
 
-def sort_beam(beam_extensions, beam_extension_scores, beam_pointers):
-	beam_width = len(beam_pointers); batch_size = beam_pointers[0].shape[0]
-	beam_extensions = torch.stack(beam_extensions); beam_extension_scores = torch.stack(beam_extension_scores); beam_pointers = torch.stack(beam_pointers)
-	beam_extension_scores = beam_extension_scores.view(beam_width,batch_size)
-
-	sort_order = beam_extension_scores.sort(dim=0, descending=True)[1].reshape(beam_width, batch_size)
-	sorted_beam_extensions = beam_extensions.clone(); sorted_beam_extension_scores = beam_extension_scores.clone(); sorted_beam_pointers = beam_pointers.clone()
-	
-	for batch_index in range(batch_size):
-		sorted_beam_extensions[:, batch_index] = beam_extensions[sort_order[:,batch_index], batch_index]
-		sorted_beam_extension_scores[:, batch_index] = beam_extension_scores[sort_order[:,batch_index], batch_index]
-		sorted_beam_pointers[:, batch_index] = beam_pointers[sort_order[:,batch_index], batch_index]
-	return sorted_beam_extensions, sorted_beam_extension_scores, sorted_beam_pointers
-
 class Seq2SeqDecoder(torch.nn.Module):
 	"""
 	Attention-based decoder for seq2seq SLU
 	"""
-	def __init__(self, num_labels, num_layers, encoder_dim, decoder_dim, key_dim, value_dim, SOS=0):
+	def __init__(self, num_labels, num_layers, encoder_dim, decoder_dim, key_dim, value_dim, SOS=0, EOS=None):
 		super(Seq2SeqDecoder, self).__init__()
 		embedding_dim = decoder_dim
 		self.embed = torch.nn.Linear(num_labels, embedding_dim)
@@ -514,6 +687,7 @@ class Seq2SeqDecoder(torch.nn.Module):
 		self.linear = torch.nn.Linear(decoder_dim, num_labels)
 		self.log_softmax = torch.nn.LogSoftmax(dim=1)
 		self.SOS = SOS # index of SOS label
+		self.EOS = EOS # index of EOS label (if None, always decode the maximum number of steps)
 
 	def forward(self, encoder_outputs, y, y_lengths=None):
 		"""
@@ -539,15 +713,16 @@ class Seq2SeqDecoder(torch.nn.Module):
 		y_u_1 = torch.zeros(batch_size, num_labels)
 		y_u_1[:,self.SOS] = 1.
 		if self.is_cuda: y_u_1 = y_u_1.cuda()
+		keys, values = self.attention.project(encoder_outputs)
 		for u in range(0, U):
 			# Feed in the previous element of y and the attention output; update the decoder state
-			context = self.attention(encoder_outputs, decoder_state[:,-1])
+			context = self.attention.attend(keys, values, decoder_state[:,-1])
 			embedding = self.embed(y_u_1)
 			decoder_input = torch.cat([embedding, context], dim=1)
 			decoder_state = self.rnn(decoder_input, decoder_state)
 
 			# Compute log p(y_u|y_1, y_2, ..., x) (the log probability of the next element)
-			decoder_out = self.log_softmax(self.linear(decoder_state[:,-1]))
+			decoder_out = self.log_softmax(self.linear(decoder_state[:,-1]).float())
 			log_p_yu = (decoder_out * y[:,u,:]).sum(dim=1) # y_u is one-hot; use dot-product to select the y_u'th output probability 
 
 			# Add log p(y_u|...) to log p(y|x)
@@ -558,166 +733,161 @@ class Seq2SeqDecoder(torch.nn.Module):
 
 		return log_p_y_x
 
-	def infer(self, encoder_outputs, Sy, B=4, debug=False, y_lengths=None):
+	def infer(self, encoder_outputs, Sy, B=4, debug=False, y_lengths=None, max_length=200):
 		"""
 		encoder_outputs : Tensor of shape (batch size, T, encoder_dim*2)
 		Sy : list of characters (output alphabet)
 		B : integer (beam width)
-		debug : boolean (print debugging statements during search)
+		debug : boolean (print the best hypothesis for the first input at each step)
+		y_lengths : list of integers (if given, decode exactly max(y_lengths) steps)
+		max_length : integer (maximum number of decoding steps)
 		Run beam search to find y_hat = argmax_y log p(y|x) for every (x) in the batch.
 		(If B = 1, this is equivalent to greedy search.)
-		"""
-		#if self.is_cuda: x = x.cuda()
-		self.is_cuda = next(self.parameters()).is_cuda
 
+		The B hypotheses of each input are flattened into the batch dimension, so the decoder
+		runs once per step. Once a hypothesis emits EOS its score is frozen, and the search
+		stops as soon as every hypothesis in the batch has finished.
+
+		Returns beam_scores (B, batch size) and beam (B, batch size, U), a LongTensor of label indices.
+		"""
 		batch_size = encoder_outputs.shape[0]
 		Sy_size = len(Sy)
+		device = encoder_outputs.device
+		U = max_length if y_lengths is None else max(y_lengths)
+		stop_on_eos = self.EOS is not None and y_lengths is None
+
+		# Initialize the decoder state of every hypothesis; all hypotheses share the same keys and values
+		keys, values = self.attention.project(encoder_outputs)
+		decoder_state = self.initial_state.unsqueeze(0).repeat(batch_size * B, 1, 1)
+
+		# At the first decoding timestep, all hypotheses are identical; only extend the first one.
+		beam_scores = torch.full((batch_size, B), float("-inf"), device=device)
+		beam_scores[:, 0] = 0.
+		beam = torch.zeros(batch_size, B, 0, dtype=torch.long, device=device)
+		finished = torch.zeros(batch_size, B, dtype=torch.bool, device=device)
+		batch_index = torch.arange(batch_size, device=device).unsqueeze(1)
+
+		# The first guess is an all-zero vector, so its embedding is just the bias.
+		embedding = self.embed.bias.expand(batch_size * B, -1)
+
+		for u in range(U):
+			# Feed in the previous guesses; update the decoder states
+			context = self.attention.attend(keys, values, decoder_state[:,-1].view(batch_size, B, -1)).view(batch_size * B, -1)
+			decoder_input = torch.cat([embedding, context], dim=1)
+			decoder_state = self.rnn(decoder_input, decoder_state)
 
-		# Initialize the decoder state
-		decoder_state = torch.stack([self.initial_state] * batch_size)
+			# Compute log p(y_u|y_1, y_2, ..., x) (the log probability of the next element)
+			decoder_out = self.log_softmax(self.linear(decoder_state[:,-1]).float()).view(batch_size, B, Sy_size)
+
+			# Find the top B possible extensions for each of the B hypotheses
+			extension_scores, extensions = decoder_out.topk(B, dim=2)
+			if stop_on_eos:
+				# a finished hypothesis can only be extended with EOS, at no cost
+				finished_scores = torch.full_like(extension_scores, float("-inf"))
+				finished_scores[:, :, 0] = 0.
+				extension_scores = torch.where(finished.unsqueeze(2), finished_scores, extension_scores)
+				extensions = extensions.masked_fill(finished.unsqueeze(2), self.EOS)
+			extension_scores = (beam_scores.unsqueeze(2) + extension_scores).view(batch_size, B*B)
+
+			# Pick the top B of the B^2 extended hypotheses
+			beam_scores, top_extensions = extension_scores.topk(B, dim=1)
+			beam_pointers = top_extensions // B # which hypothesis each extension belongs to
+			labels = extensions.view(batch_size, B*B).gather(1, top_extensions)
+			beam = torch.cat([beam[batch_index, beam_pointers], labels.unsqueeze(2)], dim=2)
+			decoder_state = decoder_state[(batch_index * B + beam_pointers).view(-1)]
+			embedding = torch.nn.functional.embedding(labels.view(-1), self.embed.weight.t()) + self.embed.bias # same as embedding the one-hot labels
+
+			if debug:
+				print("".join([Sy[c] for c in beam[0,0]]) + " | score: %1.2f" % beam_scores[0,0].item())
+
+			if stop_on_eos:
+				finished = finished[batch_index, beam_pointers] | (labels == self.EOS)
+				if finished.all(): break
+
+		return beam_scores.transpose(0,1), beam.transpose(0,1)
+
+def embedding_cache_path(filename, vocab, dim, cache_dir=None):
+	"""
+	Path of the .npy cache of the vocab rows of an embedding file. The name is keyed by the embedding file (path, size, modification time), dim and a hash of the vocab.
+	"""
+	stat = os.stat(filename)
+	key = hashlib.sha1(("%s|%d|%d|%d|" % (os.path.abspath(filename), stat.st_size, int(stat.st_mtime), dim)).encode("utf-8"))
+	key.update("\n".join(vocab).encode("utf-8"))
+	if cache_dir is None: cache_dir = os.path.dirname(os.path.abspath(filename))
+	return os.path.join(cache_dir, os.path.basename(filename) + "." + key.hexdigest()[:16] + ".npy")
 
-		true_U = 200
+def read_embedding_vectors(filename, vocab, dim, cache_dir=None):
+	"""
+	filename : text file with one "word v_1 ... v_dim" line per word (GloVe/FastText format)
+	vocab : list of words
 
-		if y_lengths is not None:
-			true_U = max(y_lengths)
+	Returns a float32 array of shape (len(vocab), dim) with the vector of each vocab word (NaN rows for words not in the file).
+	Only the lines of vocab words are parsed; the array is cached (see embedding_cache_path) and memory-mapped on later calls.
+	"""
+	cache_path = embedding_cache_path(filename, vocab, dim, cache_dir)
+	if os.path.isfile(cache_path):
+		return np.load(cache_path, mmap_mode="r")
+
+	vocab_index = {word.encode("utf-8"): idx for idx, word in enumerate(vocab) if word != ""}
+	rows = {}
+	with open(filename, "rb") as f:
+		for line in f:
+			word = line[:line.find(b" ")]
+			if word not in vocab_index: continue
+			values = line[len(word)+1:].strip()
+			if values.count(b" ") + 1 != dim: continue # header line, or a "word" containing spaces
+			rows[vocab_index[word]] = values
+
+	vectors = np.full((len(vocab), dim), np.nan, dtype=np.float32)
+	if len(rows) > 0:
+		indices = np.fromiter(rows.keys(), dtype=np.int64, count=len(rows))
+		values = np.array(b" ".join(rows.values()).split(), dtype=np.float64) # parse all vectors in one call
+		vectors[indices] = values.reshape(len(rows), dim)
+
+	try:
+		with open(cache_path + ".tmp", "wb") as f:
+			np.save(f, vectors)
+		os.replace(cache_path + ".tmp", cache_path)
+	except:
+		print("could not write embedding cache " + cache_path)
+	return vectors
+
+def fill_missing_embeddings(vectors, dim):
+	"""
+	vectors : array of shape (vocabulary size, dim) from read_embedding_vectors
 
-		decoder_state_shape = decoder_state.shape
-		beam = torch.zeros(B,batch_size,true_U,Sy_size); beam_scores = torch.zeros(B,batch_size); decoder_states = torch.zeros(B,decoder_state_shape[0], decoder_state_shape[1], decoder_state_shape[2])
-		if self.is_cuda:
-			beam = beam.cuda()
-			beam_scores = beam_scores.cuda()
-			decoder_states = decoder_states.cuda()
-
-		for u in range(true_U):
-			beam_extensions = []; beam_extension_scores = []; beam_pointers = []
-
-			# Add a delay so that it's easier to read the outputs during debugging
-			if debug and u < true_U:
-				time.sleep(1)
-				print("")
-
-			for b in range(B):
-				# Get previous guess
-				if u == 0: 
-					beam_score = beam_scores[b]
-					y_hat_u_1 = torch.zeros(batch_size, Sy_size)
-					if self.is_cuda:
-						beam_score = beam_score.cuda()
-						y_hat_u_1 = y_hat_u_1.cuda()
-				else: 
-					# Select hypothesis (and corresponding decoder state/score) from beam
-					y_hat = beam[b]
-					decoder_state = decoder_states[b]
-					beam_score = beam_scores[b]
-					y_hat_u_1 = y_hat[:,u-1,:]
-
-					# If in debug mode, print out the current beam
-					if debug and u < true_U: print(self.one_hot_to_string(y_hat[0,:u], Sy).strip("\n") + " | score: %1.2f" % beam_score[0].item())
-
-				# Feed in the previous guess; update the decoder state
-				context = self.attention(encoder_outputs, decoder_state[:,-1])
-				embedding = self.embed(y_hat_u_1)
-				decoder_input = torch.cat([embedding, context], dim=1)
-				decoder_state = self.rnn(decoder_input, decoder_state)
-				decoder_states[b] = decoder_state.clone()
-
-				# Compute log p(y_u|y_1, y_2, ..., x) (the log probability of the next element)
-				decoder_out = self.log_softmax(self.linear(decoder_state[:,-1]))
-
-				# Find the top B possible extensions for each of the B hypotheses
-				top_B_extension_scores, top_B_extensions = decoder_out.topk(B)
-				top_B_extension_scores = top_B_extension_scores.transpose(0,1); top_B_extensions = top_B_extensions.transpose(0,1)
-				for extension_index in range(B):
-					extension = torch.zeros(batch_size, Sy_size)
-					extension_score = top_B_extension_scores[extension_index] + beam_score
-					extension[torch.arange(batch_size), top_B_extensions[extension_index]] = 1.
-					beam_extensions.append(extension.clone())
-					beam_extension_scores.append(extension_score.clone())
-					beam_pointers.append(torch.ones(batch_size).long() * b) # we need to remember which hypothesis this extension belongs to
-
-				# At the first decoding timestep, there are no other hypotheses to extend.
-				if u == 0: break
-
-			# Sort the B^2 extensions
-			beam_extensions, beam_extension_scores, beam_pointers = sort_beam(beam_extensions, beam_extension_scores, beam_pointers)
-			old_beam = beam.clone(); old_beam_scores = beam_scores.clone(); old_decoder_states = decoder_states.clone()
-			beam *= 0; beam_scores *= 0; decoder_states *= 0;
-
-			# Pick the top B extended hypotheses
-			for b in range(len(beam_extensions[:B])):
-				for batch_index in range(batch_size):
-					beam[b,batch_index] = old_beam[beam_pointers[b, batch_index],batch_index]
-					beam[b,batch_index,u,:] = beam_extensions[b, batch_index] # append the extensions to each hypothesis
-					beam_scores[b, batch_index] = beam_extension_scores[b, batch_index] # update the beam scores
-					decoder_states[b, batch_index] = old_decoder_states[beam_pointers[b, batch_index],batch_index]
-
-		return beam_scores, beam
-
-def obtain_glove_embeddings(filename, vocab,dim=100): # Load glove embeddings
-	
-	word_vecs={}
-	with open(filename, 'rb') as f:
-		for l in f:
-			line = l.decode().split()
-			word = line[0]
-			if "." in line[1:]:
-				print(line)
-			vect = np.array(line[1:]).astype(np.float)
-			word_vecs[word]=vect
-	
-	word_embeddings = []
-	for word in vocab:
-		if word in word_vecs:
-			embed=word_vecs[word]
-		else:
-			embed=np.random.normal(scale=0.6, size=(dim, ))
-		word_embeddings.append(embed)
-	
-	embed=np.random.normal(scale=0.6, size=(dim, )) # add embedding for unk
-	word_embeddings.append(embed)
+	Returns an array of shape (vocabulary size + 1, dim): random vectors for the missing words (in vocab order) and for unk.
+	"""
+	word_embeddings = np.empty((len(vectors) + 1, dim))
+	word_embeddings[:-1] = vectors
+	for idx in np.flatnonzero(np.isnan(word_embeddings[:-1, 0])):
+		word_embeddings[idx] = np.random.normal(scale=0.6, size=(dim, ))
 
-	word_embeddings = np.array(word_embeddings)
+	word_embeddings[-1] = np.random.normal(scale=0.6, size=(dim, )) # add embedding for unk
 	return word_embeddings
 
-def obtain_fasttext_embeddings(filename, vocab,dim=300): # Load FastText embeddings
-	
-	fin = io.open(filename, 'r', encoding='utf-8', newline='\n', errors='ignore')
-	n, d = map(int, fin.readline().split())
-	data = {}
-	for line in fin:
-		tokens = line.rstrip().split(' ')
-		emb_list=[float(k) for k in tokens[1:]]
-		data[tokens[0]] = emb_list
-	
-	word_embeddings = []
-	for word in vocab:
-		if word in data:
-			embed=data[word]
-		else:
-			embed=np.random.normal(scale=0.6, size=(dim, ))
-		word_embeddings.append(embed)
-	
-	embed=np.random.normal(scale=0.6, size=(dim, )) # add embedding for unk
-	word_embeddings.append(embed)
+def obtain_glove_embeddings(filename, vocab,dim=100, cache_dir=None): # Load glove embeddings
+	vectors = read_embedding_vectors(filename, vocab, dim, cache_dir)
+	return fill_missing_embeddings(vectors, dim)
 
-	word_embeddings = np.array(word_embeddings)
-	return word_embeddings
+def obtain_fasttext_embeddings(filename, vocab,dim=300, cache_dir=None): # Load FastText embeddings (the "n d" header line is skipped)
+	vectors = read_embedding_vectors(filename, vocab, dim, cache_dir)
+	return fill_missing_embeddings(vectors, dim)
 
 class Model(torch.nn.Module):
 	"""
 	End-to-end SLU model.
 	"""
-	def __init__(self, config, pipeline=False,finetune=False,use_semantic_embeddings = False, glove_embeddings=None,glove_emb_dim=100, finetune_semantic_embeddings = False, seperate_RNN=False, smooth_semantic= False, smooth_semantic_parameter= 1):
+	def __init__(self, config, pipeline=False,finetune=False,use_semantic_embeddings = False, glove_embeddings=None,glove_emb_dim=100, finetune_semantic_embeddings = False, seperate_RNN=False, smooth_semantic= False, smooth_semantic_parameter= 1, lazy_pretrained=False):
 		super(Model, self).__init__()
 		self.is_cuda = torch.cuda.is_available()
+		self.use_bf16 = (config.precision == "bf16")
 		self.Sy_intent = config.Sy_intent
 		pretrained_model = PretrainedModel(config)
+		self.pretrained_model_path = None
 		if config.pretraining_type != 0:
-			pretrained_model_path = os.path.join(config.folder, "pretraining", "model_state.pth")
-			if self.is_cuda:
-				pretrained_model.load_state_dict(torch.load(pretrained_model_path))
-			else:
-				pretrained_model.load_state_dict(torch.load(pretrained_model_path, map_location="cpu"))
+			self.pretrained_model_path = os.path.join(config.folder, "pretraining", "model_state.pth")
+		self.pretrained_loaded = False
 		self.pretrained_model = pretrained_model
 		self.unfreezing_type = config.unfreezing_type
 		self.unfreezing_index = config.starting_unfreezing_index
@@ -729,9 +899,9 @@ class Model(torch.nn.Module):
 		out_dim = config.word_rnn_num_hidden[-1]
 		if config.word_rnn_bidirectional:
 			out_dim *= 2 
-		if pipeline: # Initialise word embedding for intent model with the weights of pretrained word classifier
+		self.pipeline = pipeline
+		if pipeline: # Initialise word embedding for intent model with the weights of pretrained word classifier (see load_pretrained)
 			self.embedding=torch.nn.Embedding(config.vocabulary_size+1,pretrained_model.word_linear.weight.data.shape[1])
-			self.embedding.weight.data[:config.vocabulary_size]=pretrained_model.word_linear.weight.data.clone()
 			self.embedding.weight.requires_grad = finetune
 		self.use_semantic_embeddings = use_semantic_embeddings
 		self.seperate_RNN=seperate_RNN
@@ -747,13 +917,23 @@ class Model(torch.nn.Module):
 		if not self.seq2seq:
 			self.values_per_slot = config.values_per_slot
 			self.num_values_total = sum(self.values_per_slot)
+			self.slot_classifier = MultiSlotClassifier(self.values_per_slot)
+
+			# inverse lookup tables: slot_values[slot][value index] is the value
+			self.slot_names = list(self.Sy_intent)
+			self.slot_values = []
+			for slot in self.slot_names:
+				values = np.empty(len(self.Sy_intent[slot]), dtype=object)
+				for value in self.Sy_intent[slot]:
+					values[self.Sy_intent[slot][value]] = value
+				self.slot_values.append(values)
 			num_rnn_layers = len(config.intent_rnn_num_hidden)
 			if self.seperate_RNN: # Create seperate RNN layers for semantic embedding
 				self.semantic_layers=[]
 				out_dim_semantic=glove_emb_dim
 				for idx in range(num_rnn_layers):
 					# recurrent
-					layer = torch.nn.GRU(input_size=out_dim_semantic, hidden_size=config.intent_rnn_num_hidden[idx], batch_first=True, bidirectional=config.intent_rnn_bidirectional)
+					layer = GRU(input_size=out_dim_semantic, hidden_size=config.intent_rnn_num_hidden[idx], batch_first=True, bidirectional=config.intent_rnn_bidirectional)
 					layer.name = "intent_rnn%d" % idx
 					self.semantic_layers.append(layer)
 			
@@ -778,7 +958,7 @@ class Model(torch.nn.Module):
 				self.semantic_layers = torch.nn.ModuleList(self.semantic_layers)
 			for idx in range(num_rnn_layers):
 				# recurrent
-				layer = torch.nn.GRU(input_size=out_dim, hidden_size=config.intent_rnn_num_hidden[idx], batch_first=True, bidirectional=config.intent_rnn_bidirectional)
+				layer = GRU(input_size=out_dim, hidden_size=config.intent_rnn_num_hidden[idx], batch_first=True, bidirectional=config.intent_rnn_bidirectional)
 				layer.name = "intent_rnn%d" % idx
 				self.intent_layers.append(layer)
 		
@@ -825,21 +1005,45 @@ class Model(torch.nn.Module):
 		# seq2seq
 		else:
 			self.SOS = config.Sy_intent.index("<sos>")
-			#self.EOS = config.EOS
+			self.EOS = config.Sy_intent.index("<eos>")
 			self.num_labels = len(config.Sy_intent) 
 			self.encoder = Seq2SeqEncoder(out_dim, config.num_intent_encoder_layers, config.intent_encoder_dim)
-			self.decoder = Seq2SeqDecoder(self.num_labels, config.num_intent_decoder_layers, config.intent_encoder_dim, config.intent_decoder_dim, config.intent_decoder_key_dim, config.intent_decoder_value_dim, self.SOS)
+			self.decoder = Seq2SeqDecoder(self.num_labels, config.num_intent_decoder_layers, config.intent_encoder_dim, config.intent_decoder_dim, config.intent_decoder_key_dim, config.intent_decoder_value_dim, self.SOS, self.EOS)
 
 		if self.is_cuda:
 			self.cuda()
 
+		# with lazy_pretrained=True, the pre-trained weights are only read if load_pretrained is called
+		# (e.g., by Trainer.load_checkpoint when there is no fine-tuned checkpoint to load instead)
+		if not lazy_pretrained:
+			self.load_pretrained()
+
+	def load_pretrained(self):
+		"""
+		Loads the pre-trained ASR weights into self.pretrained_model (does nothing if they are already loaded).
+		"""
+		if self.pretrained_loaded or self.pretrained_model_path is None: return
+		self.pretrained_model.load_state_dict(read_state_dict(self.pretrained_model_path, self.is_cuda))
+		if self.pipeline:
+			vocabulary_size = self.pretrained_model.word_linear.weight.shape[0]
+			self.embedding.weight.data[:vocabulary_size]=self.pretrained_model.word_linear.weight.data.clone()
+		self.pretrained_loaded = True
+
 	def one_hot_to_string(self, input, S):
 		"""
 		input : Tensor of shape (T, |S|)
 		S : list of characters/tokens
 		"""
 
-		return "".join([S[c] for c in input.max(dim=1)[1]]).lstrip("<sos>").rstrip("<eos>")
+		return self.indices_to_string(input.max(dim=1)[1], S)
+
+	def indices_to_string(self, input, S):
+		"""
+		input : LongTensor of shape (T,)
+		S : list of characters/tokens
+		"""
+
+		return "".join([S[c] for c in input.tolist()]).lstrip("<sos>").rstrip("<eos>")
 
 	def freeze_all_layers(self):
 		for layer in self.pretrained_model.phoneme_layers:
@@ -900,6 +1104,16 @@ class Model(torch.nn.Module):
 					self.unfreezing_index += 1
 					return
 
+	def set_unfreezing_index(self, unfreezing_index):
+		"""
+		Unfreezes the layers that unfreeze_one_layer had unfrozen when it reached unfreezing_index
+		(on a newly constructed model, e.g. when resuming training).
+		"""
+		if unfreezing_index > self.unfreezing_index:
+			self.unfreezing_index = unfreezing_index - 1
+			self.unfreeze_one_layer()
+		self.unfreezing_index = unfreezing_index
+
 	def forward(self, x, y_intent):
 		"""
 		x : Tensor of shape (batch size, T)
@@ -907,52 +1121,44 @@ class Model(torch.nn.Module):
 		"""
 		if self.is_cuda:
 			y_intent = y_intent.cuda()
-		out = self.pretrained_model.compute_features(x)
-		if self.use_semantic_embeddings:
-			if self.smooth_semantic:
-				x_words, x_weight = self.get_top_words( x, k=self.smooth_semantic_parameter)
-				smooth_word_emb=self.semantic_embeddings(x_words)
-				word_emb=torch.matmul(x_weight, smooth_word_emb).reshape(x_weight.shape[0],x_weight.shape[1],-1) # multiply the embeddings with the prediction probability to get combined embedding
-			else:
-				x_words = self.get_words(x) # get words predicted by ASR
-				word_emb=self.semantic_embeddings(x_words)
-			if self.seperate_RNN==False:
-				out = torch.cat((out,word_emb),dim=-1) # Simply concatenate speech embedding with pretrained semantic embedding and pass through common RNN layer
+		with bf16_autocast(self):
+			if self.use_semantic_embeddings:
+				_, out, word_logits = self.pretrained_model.compute_outputs(x) # features and word posteriors from one backbone pass
+				if self.smooth_semantic:
+					word_emb=self.smoothed_word_embeddings(word_logits, k=self.smooth_semantic_parameter) # combine the embeddings of the top k words, weighted by their prediction probability
+				else:
+					x_words = self.words_from_logits(word_logits) # get words predicted by ASR
+					word_emb=self.semantic_embeddings(x_words)
+				if self.seperate_RNN==False:
+					out = torch.cat((out,word_emb),dim=-1) # Simply concatenate speech embedding with pretrained semantic embedding and pass through common RNN layer
+				else:
+					semantic_out=word_emb # get semantic embeddings 
 			else:
-				semantic_out=word_emb # get semantic embeddings 
-
-		if not self.seq2seq:
-			if self.seperate_RNN==False: # Common RNN for semantic and speech embeddings
-				for layer in self.intent_layers:
-					out = layer(out)
-			else: # seperate RNN for semantic and speech embeddings
-				for layer in self.intent_layers:
-					out = layer(out)
-				for layer in self.semantic_layers:
-					semantic_out = layer(semantic_out)
-				out = torch.cat((out,semantic_out),dim=-1)
-				for layer in self.final_layers:
-					out = layer(out)
-			intent_logits = out # shape: (batch size, num_values_total)
-
-			intent_loss = 0.
-			start_idx = 0
-			predicted_intent = []
-			for slot in range(len(self.values_per_slot)):
-				end_idx = start_idx + self.values_per_slot[slot]
-				subset = intent_logits[:, start_idx:end_idx]
-				intent_loss += torch.nn.functional.cross_entropy(subset, y_intent[:, slot])
-				predicted_intent.append(subset.max(1)[1])
-				start_idx = end_idx
-			predicted_intent = torch.stack(predicted_intent, dim=1)
-			intent_acc = (predicted_intent == y_intent).prod(1).float().mean() # all slots must be correct
-
-			return intent_loss, intent_acc
-
-		else: # seq2seq
-			out = self.encoder(out)
-			log_probs = self.decoder(out, y_intent)
-			return -log_probs.mean(), torch.tensor([0.])
+				out = self.pretrained_model.compute_features(x)
+
+			if not self.seq2seq:
+				if self.seperate_RNN==False: # Common RNN for semantic and speech embeddings
+					for layer in self.intent_layers:
+						out = layer(out)
+				else: # seperate RNN for semantic and speech embeddings
+					for layer in self.intent_layers:
+						out = layer(out)
+					for layer in self.semantic_layers:
+						semantic_out = layer(semantic_out)
+					out = torch.cat((out,semantic_out),dim=-1)
+					for layer in self.final_layers:
+						out = layer(out)
+				intent_logits = out # shape: (batch size, num_values_total)
+
+				intent_loss, predicted_intent, _, _ = self.slot_classifier(intent_logits.float(), y_intent)
+				intent_acc = (predicted_intent == y_intent).prod(1).float().mean() # all slots must be correct
+
+				return intent_loss, intent_acc
+
+			else: # seq2seq
+				out = self.encoder(out)
+				log_probs = self.decoder(out, y_intent)
+				return -log_probs.mean(), torch.tensor([0.])
 
 	def run_pipeline(self, x, y_intent): # code to run pipeline model
 		"""
@@ -961,40 +1167,38 @@ class Model(torch.nn.Module):
 		"""
 		if self.is_cuda:
 			y_intent = y_intent.cuda()
-		out = self.embedding(x)
+		with bf16_autocast(self):
+			out = self.embedding(x)
 
-		if self.use_semantic_embeddings:
-			out = torch.cat((out,self.semantic_embeddings(x)),dim=-1)
+			if self.use_semantic_embeddings:
+				out = torch.cat((out,self.semantic_embeddings(x)),dim=-1)
 
-		if not self.seq2seq:
-			for layer in self.intent_layers:
-				out = layer(out)
-			intent_logits = out # shape: (batch size, num_values_total)
-
-			intent_loss = 0.
-			start_idx = 0
-			predicted_intent = []
-			for slot in range(len(self.values_per_slot)):
-				end_idx = start_idx + self.values_per_slot[slot]
-				subset = intent_logits[:, start_idx:end_idx]
-				intent_loss += torch.nn.functional.cross_entropy(subset, y_intent[:, slot])
-				predicted_intent.append(subset.max(1)[1])
-				start_idx = end_idx
-			predicted_intent = torch.stack(predicted_intent, dim=1)
-			intent_acc = (predicted_intent == y_intent).prod(1).float().mean() # all slots must be correct
-
-			return intent_loss, intent_acc
+			if not self.seq2seq:
+				for layer in self.intent_layers:
+					out = layer(out)
+				intent_logits = out # shape: (batch size, num_values_total)
 
-		else: # seq2seq
-			out = self.encoder(out)
-			log_probs = self.decoder(out, y_intent)
-			return -log_probs.mean(), torch.tensor([0.])
+				intent_loss, predicted_intent, _, _ = self.slot_classifier(intent_logits.float(), y_intent)
+				intent_acc = (predicted_intent == y_intent).prod(1).float().mean() # all slots must be correct
+
+				return intent_loss, intent_acc
+
+			else: # seq2seq
+				out = self.encoder(out)
+				log_probs = self.decoder(out, y_intent)
+				return -log_probs.mean(), torch.tensor([0.])
 
 	def get_words(self, x):  # code to get predicted utterances from ASR model
 		"""
 		x : Tensor of shape (batch size, T)
 		"""
-		_, x_words= self.pretrained_model.compute_posteriors(x)
+		_, word_logits = self.pretrained_model.compute_posteriors(x)
+		return self.words_from_logits(word_logits)
+
+	def words_from_logits(self, x_words):
+		"""
+		x_words : Tensor of shape (batch size, T'', vocabulary size) (word logits)
+		"""
 		x_words_old_shape=x_words.shape
 		x_words = x_words.view(x_words.shape[0]*x_words.shape[1], -1)
 		final_words=x_words.max(1)[1]
@@ -1005,15 +1209,32 @@ class Model(torch.nn.Module):
 		"""
 		x : Tensor of shape (batch size, T)
 		"""
-		_, x_words= self.pretrained_model.compute_posteriors(x)
-		x_words_old_shape=x_words.shape
-		x_words = x_words.view(x_words.shape[0]*x_words.shape[1], -1)
-		final_words_weight, final_words=x_words.topk(k,dim=1)
-		final_words_normalised_weight= torch.transpose(torch.transpose(final_words_weight,0,1)/final_words_weight.sum(1),0,1) # normalise  prob such that probabilities for top k sum to 1
-		final_words=final_words.reshape(x_words_old_shape[0],x_words_old_shape[1],k)
-		final_words_normalised_weight=final_words_normalised_weight.reshape(x_words_old_shape[0],x_words_old_shape[1], 1, k)
+		_, word_logits = self.pretrained_model.compute_posteriors(x)
+		return self.top_words_from_logits(word_logits, k)
+
+	def top_words_from_logits(self, x_words, k=5):
+		"""
+		x_words : Tensor of shape (batch size, T'', vocabulary size) (word logits)
+
+		Returns the top-k words at each position, shape (batch size, T'', k), and their posteriors renormalised over the top k (same shape).
+		"""
+		# softmax is monotonic, so the top-k posteriors belong to the top-k logits,
+		# and the softmax over the top-k logits equals the full softmax renormalised over the top k
+		top_logits, final_words = x_words.topk(k, dim=-1)
+		final_words_normalised_weight = torch.nn.functional.softmax(top_logits.float(), dim=-1)
 		return final_words, final_words_normalised_weight
 
+	def smoothed_word_embeddings(self, word_logits, k=5):
+		"""
+		word_logits : Tensor of shape (batch size, T'', vocabulary size)
+
+		Returns the sum of the semantic embeddings of the top-k words at each position, weighted by their posteriors, shape (batch size, T'', embedding dim).
+		"""
+		x_words, x_weight = self.top_words_from_logits(word_logits, k)
+		weight = self.semantic_embeddings.weight
+		word_emb = torch.nn.functional.embedding_bag(x_words.view(-1, k), weight, per_sample_weights=x_weight.view(-1, k).to(weight.dtype), mode="sum") # weighted sum without gathering the k embeddings of each position
+		return word_emb.view(x_words.shape[0], x_words.shape[1], -1)
+
 	def test(self, x, y_intent): # code to return error cases for trained model
 		"""
 		x : Tensor of shape (batch size, T)
@@ -1021,88 +1242,94 @@ class Model(torch.nn.Module):
 		"""
 		if self.is_cuda:
 			y_intent = y_intent.cuda()
-		out = self.pretrained_model.compute_features(x)
-		if self.use_semantic_embeddings:
-			if self.smooth_semantic:
-				x_words, x_weight = self.get_top_words( x, k=self.smooth_semantic_parameter)
-				smooth_word_emb=self.semantic_embeddings(x_words)
-				word_emb=torch.matmul(x_weight, smooth_word_emb).reshape(x_weight.shape[0],x_weight.shape[1],-1) # multiply the embeddings with the prediction probability to get combined embedding
+		with bf16_autocast(self):
+			if self.use_semantic_embeddings:
+				_, out, word_logits = self.pretrained_model.compute_outputs(x) # features and word posteriors from one backbone pass
+				if self.smooth_semantic:
+					word_emb=self.smoothed_word_embeddings(word_logits, k=self.smooth_semantic_parameter) # combine the embeddings of the top k words, weighted by their prediction probability
+				else:
+					x_words = self.words_from_logits(word_logits) # get words predicted by ASR
+					word_emb=self.semantic_embeddings(x_words)
+				out = torch.cat((out,word_emb),dim=-1)
 			else:
-				x_words = self.get_words(x) # get words predicted by ASR
-				word_emb=self.semantic_embeddings(x_words)
-			out = torch.cat((out,word_emb),dim=-1)
+				out = self.pretrained_model.compute_features(x)
 
-		if not self.seq2seq:
-			for layer in self.intent_layers:
-				out = layer(out)
-			intent_logits = out # shape: (batch size, num_values_total)
-
-			intent_loss = 0.
-			start_idx = 0
-			predicted_intent = []
-			for slot in range(len(self.values_per_slot)):
-				end_idx = start_idx + self.values_per_slot[slot]
-				subset = intent_logits[:, start_idx:end_idx]
-				intent_loss += torch.nn.functional.cross_entropy(subset, y_intent[:, slot])
-				predicted_intent.append(subset.max(1)[1])
-				start_idx = end_idx
-			predicted_intent = torch.stack(predicted_intent, dim=1)
-			intent_acc = (predicted_intent == y_intent).prod(1).float().mean() # all slots must be correct
-
-			return predicted_intent,y_intent,intent_loss, intent_acc # return both predicted as well as gold intent
+			if not self.seq2seq:
+				for layer in self.intent_layers:
+					out = layer(out)
+				intent_logits = out # shape: (batch size, num_values_total)
 
-		else: # seq2seq
-			out = self.encoder(out)
-			log_probs = self.decoder(out, y_intent)
-			return -log_probs.mean(), torch.tensor([0.])
+				intent_loss, predicted_intent, _, _ = self.slot_classifier(intent_logits.float(), y_intent)
+				intent_acc = (predicted_intent == y_intent).prod(1).float().mean() # all slots must be correct
+
+				return predicted_intent,y_intent,intent_loss, intent_acc # return both predicted as well as gold intent
+
+			else: # seq2seq
+				out = self.encoder(out)
+				log_probs = self.decoder(out, y_intent)
+				return -log_probs.mean(), torch.tensor([0.])
 
 
 	def predict_intents(self, x, from_text = False):
-		if not from_text:
-			out = self.pretrained_model.compute_features(x)
-		else:
-			out = x
+		with bf16_autocast(self):
+			if not from_text:
+				out = self.pretrained_model.compute_features(x)
+			else:
+				out = x
 
-		if not self.seq2seq:
-			for layer in self.intent_layers:
-				out = layer(out)
-			intent_logits = out # shape: (batch size, num_values_total)
-			start_idx = 0
-			predicted_intent = []
-			for slot in range(len(self.values_per_slot)):
-				end_idx = start_idx + self.values_per_slot[slot]
-				subset = intent_logits[:, start_idx:end_idx]
-				predicted_intent.append(subset.max(1)[1])
-				start_idx = end_idx
-			predicted_intent = torch.stack(predicted_intent, dim=1)
-
-			return intent_logits, predicted_intent
-
-		else: #seq2seq
-			out = self.encoder(out)
-			beam_scores, beam = self.decoder.infer(out, self.Sy_intent, B=4)
-			return beam_scores, beam
-
-	def decode_intents(self, x):
+			if not self.seq2seq:
+				for layer in self.intent_layers:
+					out = layer(out)
+				intent_logits = out # shape: (batch size, num_values_total)
+				_, predicted_intent, _, _ = self.slot_classifier(intent_logits.float())
+
+				return intent_logits.float(), predicted_intent
+
+			else: #seq2seq
+				out = self.encoder(out)
+				beam_scores, beam = self.decoder.infer(out, self.Sy_intent, B=4)
+				return beam_scores, beam
+
+	def predict_top_intents(self, x, k=5):
+		"""
+		x : Tensor of shape (batch size, T)
+
+		Returns the top-k log-probabilities and value indices of each slot, both of shape (batch size, num_slots, k).
+		"""
+		intent_logits, _ = self.predict_intents(x)
+		_, _, top_scores, top_values = self.slot_classifier(intent_logits, k=k)
+		return top_scores, top_values
+
+	def decode_intents(self, x, structured=False):
+		"""
+		x : Tensor of shape (batch size, T)
+		structured : boolean (return a dictionary (slot --> value) per input instead of a list of values)
+
+		Returns the predicted intent of each input (for seq2seq models, a string, or {"intent": string} if structured).
+		"""
 		_, predicted_intent = self.predict_intents(x)
+		return self.decode_predictions(predicted_intent, structured)
 
+	def decode_predictions(self, predicted_intent, structured=False):
+		"""
+		predicted_intent : LongTensor of shape (batch size, num_slots), or (beam, batch size, U) for seq2seq models
+		structured : boolean (return a dictionary (slot --> value) per input instead of a list of values; these are JSON-serializable)
+			seq2seq models have no slots: their decoded string is returned, as {"intent": string} if structured
+		"""
 		if not self.seq2seq:
-			intents = []
-			for prediction in predicted_intent:
-				intent = []
-				for idx, slot in enumerate(self.Sy_intent):
-					for value in self.Sy_intent[slot]:
-						if prediction[idx].item() == self.Sy_intent[slot][value]:
-							intent.append(value)
-				intents.append(intent)
-			return intents
+			predicted_intent = predicted_intent.cpu().numpy() # one transfer for the whole batch
+			columns = [self.slot_values[idx][predicted_intent[:, idx]] for idx in range(len(self.slot_names))]
+			if structured:
+				return [dict(zip(self.slot_names, intent)) for intent in zip(*columns)]
+			return [list(intent) for intent in zip(*columns)]
 
 		else: # seq2seq
 			intents = []
-			#predicted_intent: (beam, batch, U, num_labels)
-			batch_size = predicted_intent.shape[1]
+			#predicted_intent: (beam, batch, U)
+			predicted_intent = predicted_intent[0].cpu()
+			batch_size = predicted_intent.shape[0]
 			for i in range(0, batch_size): 
-				intent = self.one_hot_to_string(predicted_intent[0,i],self.Sy_intent)
-				intents.append(intent)
+				intent = self.indices_to_string(predicted_intent[i],self.Sy_intent)
+				intents.append({"intent": intent} if structured else intent)
 			return intents
 
@@ -0,0 +1,195 @@
+# Per-layer inference latency of a trained model over a set of wavs, with percentiles and realtime factors
+import torch
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import time
+import glob
+from models import Model
+from data import read_config, get_SLU_datasets
+from training import Trainer
+from factorize import load_factorized_checkpoint
+import argparse
+import os
+
+class LayerTimer:
+	"""
+	Times every forward call of the named layers of a model with forward hooks.
+
+	Calls are recorded per layer as (latency in seconds, audio duration in seconds of the current utterance).
+	On the GPU, the hooks synchronize before and after each layer, so this is a profiling mode, not something to leave on.
+	"""
+	def __init__(self, model):
+		self.is_cuda = model.is_cuda
+		self.handles = []
+		self.latencies = {} # layer name --> list of (latency, audio duration)
+		self.starts = {}
+		self.audio_seconds = None
+		for name, layer in named_layers(model):
+			self.latencies[name] = []
+			self.handles.append(layer.register_forward_pre_hook(self.pre_hook(name)))
+			self.handles.append(layer.register_forward_hook(self.hook(name)))
+
+	def sync(self):
+		if self.is_cuda: torch.cuda.synchronize()
+
+	def pre_hook(self, name):
+		def hook(module, input):
+			self.sync()
+			self.starts[name] = time.perf_counter()
+		return hook
+
+	def hook(self, name):
+		def hook(module, input, output):
+			self.sync()
+			self.latencies[name].append((time.perf_counter() - self.starts[name], self.audio_seconds))
+		return hook
+
+	def remove(self):
+		for handle in self.handles:
+			handle.remove()
+		self.handles = []
+
+def named_layers(model):
+	"""
+	model : PretrainedModel or Model
+
+	Yields (name, layer) for the layers of phoneme_layers, word_layers and (for a Model) the intent layers,
+	using their name attribute (qualified with the list name if it is already taken).
+	"""
+	if isinstance(model, Model):
+		layer_lists = [("phoneme_layers", model.pretrained_model.phoneme_layers), ("word_layers", model.pretrained_model.word_layers)]
+		if not model.seq2seq:
+			layer_lists.append(("intent_layers", model.intent_layers))
+			if model.seperate_RNN: layer_lists += [("semantic_layers", model.semantic_layers), ("final_layers", model.final_layers)]
+	else:
+		layer_lists = [("phoneme_layers", model.phoneme_layers), ("word_layers", model.word_layers)]
+
+	names = set()
+	for list_name, layer_list in layer_lists:
+		for layer in layer_list:
+			name = getattr(layer, "name", layer.__class__.__name__)
+			if name in names: name = list_name + "." + name
+			names.add(name)
+			yield name, layer
+
+def length_bucket(audio_seconds, bucket_edges):
+	"""
+	bucket_edges : sorted list of durations in seconds, e.g. [2, 4]
+
+	Returns the label of the bucket containing audio_seconds, e.g. "<2s", "2-4s" or ">=4s".
+	"""
+	lower = None
+	for edge in bucket_edges:
+		if audio_seconds < edge:
+			return ("<%gs" % edge) if lower is None else ("%g-%gs" % (lower, edge))
+		lower = edge
+	return ">=%gs" % lower
+
+def latency_report(latencies, bucket_edges=None):
+	"""
+	latencies : dictionary (layer name --> list of (latency in seconds, audio duration in seconds))
+
+	Returns a DataFrame with one row per layer (and length bucket, if bucket_edges is given):
+	p50/p95/p99/mean latency in ms, share of the total time, and p50/p95/p99 of the realtime factor (latency / audio duration).
+	"""
+	rows = []
+	for name, calls in latencies.items():
+		if len(calls) == 0: continue
+		groups = {"all": calls}
+		if bucket_edges:
+			groups = {}
+			for call in calls:
+				groups.setdefault(length_bucket(call[1], bucket_edges), []).append(call)
+		for bucket, bucket_calls in sorted(groups.items(), key=lambda group: min(call[1] for call in group[1])): # shortest utterances first
+			latency = np.array([call[0] for call in bucket_calls])
+			rtf = latency / np.array([call[1] for call in bucket_calls])
+			row = {"layer": name, "length": bucket, "calls": len(bucket_calls)}
+			for q in [50, 95, 99]:
+				row["p%d_ms" % q] = 1000 * np.percentile(latency, q)
+			row["mean_ms"] = 1000 * latency.mean()
+			row["total_s"] = latency.sum()
+			for q in [50, 95, 99]:
+				row["rtf_p%d" % q] = np.percentile(rtf, q)
+			rows.append(row)
+	report = pd.DataFrame(rows)
+	if len(report) == 0: return report
+	report["share"] = 0. # of the summed layer time, per length bucket
+	for bucket in report.length.unique():
+		in_bucket = report.length == bucket
+		report.loc[in_bucket, "share"] = report.total_s[in_bucket] / report.total_s[in_bucket & (report.layer != "total")].sum()
+	return report
+
+def read_wav(path, fs):
+	"""
+	Returns the signal of a wav file as a Tensor of shape (1, T), or None if its sampling rate is not fs.
+	"""
+	signal, wav_fs = sf.read(path)
+	if wav_fs != fs:
+		print(path + ": sampling rate %d instead of %d; skipped" % (wav_fs, fs))
+		return None
+	if signal.ndim > 1: signal = signal.mean(axis=1) # mix down to mono
+	return torch.tensor(signal).float().unsqueeze(0)
+
+if __name__ == '__main__':
+	# Get args
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config_path', type=str, required=True, help='path to config file with hyperparameters, etc.')
+	parser.add_argument('--model_path', type=str, default=None, help='name of trained model to profile (in the training folder); by default, the pre-trained model with untrained intent layers')
+	parser.add_argument('--resplit_style', default='original', choices=['original','random', 'utterance_closed', "speaker_or_utterance_closed", "mutually_closed"], help='splits the model was trained on (for its intent labels)')
+	parser.add_argument('--utility', action='store_true', help='Use utility driven splits')
+	parser.add_argument('--wav_dir', type=str, required=True, help='directory of wavs to run (searched recursively)')
+	parser.add_argument('--max_wavs', type=int, default=0, help='only use the first max_wavs wavs (0: all)')
+	parser.add_argument('--warmup', type=int, default=5, help='number of wavs to run before timing')
+	parser.add_argument('--length_buckets', type=str, default="", help='comma-separated utterance durations in seconds (e.g., 2,4) to report latencies per length bucket')
+	parser.add_argument('--report_path', type=str, default="layer_latency.csv", help='path to save the per-layer report')
+	args = parser.parse_args()
+
+	# Read config file
+	config = read_config(args.config_path)
+	torch.manual_seed(config.seed); np.random.seed(config.seed)
+
+	# Read the intent labels from the training set
+	data_str=f"{args.resplit_style}_splits"
+	if args.utility:
+		data_str=data_str+"_utility"
+	get_SLU_datasets(config,data_str=data_str,split_style=args.resplit_style)
+
+	# Load the model
+	if args.model_path is not None:
+		model = Model(config=config, lazy_pretrained=True)
+		trainer = Trainer(model=model, config=config)
+		load_factorized_checkpoint(trainer, args.model_path) # also loads models saved by factorize.py --save_models
+	else:
+		model = Model(config=config)
+	model.eval()
+
+	wav_paths = sorted(glob.glob(os.path.join(args.wav_dir, "**", "*.wav"), recursive=True))
+	if args.max_wavs > 0: wav_paths = wav_paths[:args.max_wavs]
+	bucket_edges = sorted(float(edge) for edge in args.length_buckets.split(",") if edge != "")
+
+	timer = LayerTimer(model)
+	timer.latencies["total"] = []
+	num_calls = 0
+	with torch.inference_mode():
+		for path in wav_paths:
+			x = read_wav(path, config.fs)
+			if x is None: continue
+			if model.is_cuda: x = x.cuda()
+			timer.audio_seconds = x.shape[1] / config.fs
+			timer.sync()
+			start = time.perf_counter()
+			model.predict_intents(x)
+			timer.sync()
+			timer.latencies["total"].append((time.perf_counter() - start, timer.audio_seconds))
+			num_calls += 1
+			if num_calls == args.warmup: # discard the warm-up calls (skipped wavs do not count)
+				for name in timer.latencies: timer.latencies[name] = []
+	timer.remove()
+	if num_calls <= args.warmup:
+		for name in timer.latencies: timer.latencies[name] = [] # all of them are warm-up calls
+		print("Warning: only %d wavs were run and the first %d are for warm-up (--warmup); nothing to report" % (num_calls, args.warmup))
+
+	report = latency_report(timer.latencies, bucket_edges)
+	print(report.to_string(index=False, float_format="%.4g"))
+	report.to_csv(args.report_path, index=False)
@@ -0,0 +1,108 @@
+import time
+import json
+import contextlib
+import torch
+
+PHASES = ["data_wait", "h2d", "forward", "backward", "optimizer"]
+
+class StepProfiler:
+	"""
+	Times the phases of each training step: waiting for the next batch from the data loader,
+	host-to-device copy, forward, backward and optimizer step.
+
+	On the CPU, phases are timed with time.perf_counter. On the GPU, they are timed with CUDA events,
+	which are only read at the end of the epoch, so profiling does not add a synchronization per step.
+	When disabled, phase() returns a no-op context manager.
+	"""
+	def __init__(self, enabled=True, use_cuda=False):
+		self.enabled = enabled
+		self.use_cuda = use_cuda
+		self.null_context = contextlib.nullcontext()
+		self.start_epoch()
+
+	def start_epoch(self):
+		self.records = [] # (step, phase, host start time, host end time, start event, end event)
+		self.step = 0
+		self.epoch_start = self.last = time.perf_counter()
+
+	def batch_ready(self):
+		"""
+		Call when the data loader has returned the batch.
+		"""
+		if not self.enabled: return
+		now = time.perf_counter()
+		self.records.append((self.step, "data_wait", self.last, now, None, None))
+
+	def step_done(self):
+		if not self.enabled: return
+		self.step += 1
+		self.last = time.perf_counter()
+
+	def resume(self):
+		"""
+		Call after work between two steps that is not part of them (e.g., validation), so that it is not counted as data_wait.
+		"""
+		self.last = time.perf_counter()
+
+	def phase(self, name):
+		"""
+		name : one of PHASES
+
+		Context manager timing one phase of the current step.
+		"""
+		if not self.enabled: return self.null_context
+		return self.timed_phase(name)
+
+	@contextlib.contextmanager
+	def timed_phase(self, name):
+		start_event = end_event = None
+		if self.use_cuda:
+			start_event = torch.cuda.Event(enable_timing=True)
+			end_event = torch.cuda.Event(enable_timing=True)
+			start_event.record()
+		start = time.perf_counter()
+		yield
+		end = time.perf_counter()
+		if self.use_cuda: end_event.record()
+		self.records.append((self.step, name, start, end, start_event, end_event))
+
+	def durations(self):
+		"""
+		Returns a list of (step, phase, start time (s), duration (s)) for the epoch.
+		Device phases use the device time when running on the GPU (this waits for the device).
+		"""
+		if self.use_cuda: torch.cuda.synchronize()
+		durations = []
+		for step, name, start, end, start_event, end_event in self.records:
+			if start_event is not None:
+				durations.append((step, name, start, start_event.elapsed_time(end_event) / 1000))
+			else:
+				durations.append((step, name, start, end - start))
+		return durations
+
+	def epoch_summary(self):
+		"""
+		Returns the total time (s) spent in each phase during the epoch, and the fraction of the epoch spent waiting for data.
+		"""
+		if not self.enabled: return {}
+		totals = {name: 0. for name in PHASES}
+		for _, name, _, duration in self.durations():
+			totals[name] += duration
+		elapsed = time.perf_counter() - self.epoch_start
+		summary = {"profile_" + name + "_s": totals[name] for name in PHASES}
+		summary["profile_data_wait_fraction"] = totals["data_wait"] / elapsed
+		return summary
+
+	def print_summary(self, summary):
+		num_steps = max(self.step, 1)
+		print("profile (ms/step): " + ", ".join("%s %.1f" % (name, 1000 * summary["profile_" + name + "_s"] / num_steps) for name in PHASES) + " | waiting for data: %.0f%% of the epoch" % (100 * summary["profile_data_wait_fraction"]))
+
+	def write_trace(self, path):
+		"""
+		Writes the phases of the epoch as a Chrome trace (open with chrome://tracing or https://ui.perfetto.dev).
+		"""
+		events = []
+		for step, name, start, duration in self.durations():
+			events.append({"name": name, "ph": "X", "ts": 1e6 * (start - self.epoch_start), "dur": 1e6 * duration, "pid": 0, "tid": 0, "args": {"step": step}})
+		with open(path, "w") as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
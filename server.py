@@ -0,0 +1,241 @@
+# HTTP inference server for a trained SLU model: concurrent requests are grouped into batches for Model.decode_intents
+import torch
+import numpy as np
+import soundfile as sf
+import io
+import json
+import time
+import queue
+import threading
+import collections
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from models import Model
+from data import read_config, get_SLU_datasets
+from training import Trainer
+from factorize import load_factorized_checkpoint
+import argparse
+
+class ServerStats:
+	"""
+	Counters, and latency/queue/batch statistics over the last window requests and batches.
+	"""
+	def __init__(self, window=1000):
+		self.lock = threading.Lock()
+		self.start = time.perf_counter()
+		self.num_requests = 0
+		self.num_batches = 0
+		self.num_errors = 0
+		self.num_rejected = 0
+		self.latencies = collections.deque(maxlen=window) # arrival --> result, per request
+		self.queue_waits = collections.deque(maxlen=window) # arrival --> start of its batch, per request
+		self.batch_sizes = collections.deque(maxlen=window)
+		self.batch_times = collections.deque(maxlen=window) # model time, per batch
+		self.queue_depths = collections.deque(maxlen=window) # requests left waiting when a batch starts
+
+	def add_batch(self, arrivals, start, end, queue_depth, failed=False):
+		"""
+		arrivals : list of the arrival times of the requests in the batch
+		start, end : time.perf_counter() before and after running the model
+		"""
+		with self.lock:
+			self.num_requests += len(arrivals)
+			self.num_batches += 1
+			if failed: self.num_errors += len(arrivals)
+			self.latencies.extend(end - arrival for arrival in arrivals)
+			self.queue_waits.extend(start - arrival for arrival in arrivals)
+			self.batch_sizes.append(len(arrivals))
+			self.batch_times.append(end - start)
+			self.queue_depths.append(queue_depth)
+
+	def add_rejected(self):
+		with self.lock:
+			self.num_rejected += 1
+
+	def summary(self, queue_depth):
+		"""
+		queue_depth : number of requests currently waiting
+
+		Returns a (JSON-serializable) dictionary of the statistics.
+		"""
+		with self.lock:
+			uptime = time.perf_counter() - self.start
+			summary = {"uptime_s": uptime, "requests": self.num_requests, "batches": self.num_batches, "errors": self.num_errors, "rejected": self.num_rejected, "requests_per_s": self.num_requests / uptime, "queue_depth": queue_depth}
+			if self.num_batches == 0: return summary
+			for name, values in [("latency", self.latencies), ("queue_wait", self.queue_waits), ("batch_time", self.batch_times)]:
+				for q in [50, 95, 99]:
+					summary["%s_p%d_ms" % (name, q)] = 1000 * np.percentile(values, q)
+			summary["mean_batch_size"] = float(np.mean(self.batch_sizes))
+			summary["max_batch_size"] = int(np.max(self.batch_sizes))
+			summary["mean_queue_depth"] = float(np.mean(self.queue_depths))
+			summary["max_queue_depth"] = int(np.max(self.queue_depths))
+			return summary
+
+class MicroBatcher:
+	"""
+	Runs the model on one worker thread. Each batch takes the requests that are waiting, plus those arriving
+	up to max_delay seconds after the first one, up to max_batch_size; the signals are zero-padded to the
+	longest one, like CollateWavsSLU does for test().
+	"""
+	def __init__(self, model, max_batch_size=8, max_delay=0.01, max_queue_size=0, stats=None):
+		self.model = model
+		self.max_batch_size = max_batch_size
+		self.max_delay = max_delay
+		self.queue = queue.Queue(maxsize=max_queue_size)
+		self.stats = stats if stats is not None else ServerStats()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def submit(self, signal):
+		"""
+		signal : Tensor of shape (T,)
+
+		Returns a Future for the intent of the signal. Raises queue.Full if max_queue_size requests are already waiting.
+		"""
+		future = concurrent.futures.Future()
+		self.queue.put_nowait((time.perf_counter(), signal, future))
+		return future
+
+	def next_batch(self):
+		batch = [self.queue.get()]
+		deadline = batch[0][0] + self.max_delay
+		while len(batch) < self.max_batch_size:
+			timeout = deadline - time.perf_counter()
+			try:
+				batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+			except queue.Empty:
+				break
+		return batch
+
+	def run(self):
+		while True:
+			batch = self.next_batch()
+			arrivals, signals, futures = zip(*batch)
+			queue_depth = self.queue.qsize()
+			start = time.perf_counter()
+			try:
+				intents = self.infer(signals)
+				failed = False
+			except Exception as e:
+				print("batch of %d failed: %s" % (len(batch), e))
+				failed = True
+			end = time.perf_counter()
+			self.stats.add_batch(arrivals, start, end, queue_depth, failed)
+			for idx, future in enumerate(futures):
+				if failed:
+					future.set_exception(RuntimeError("inference failed"))
+				else:
+					future.set_result({"intent": intents[idx], "latency_ms": 1000 * (end - arrivals[idx]), "queue_ms": 1000 * (start - arrivals[idx]), "batch_size": len(batch)})
+
+	def infer(self, signals):
+		"""
+		signals : list of Tensors of shape (T,)
+
+		Returns the decoded intent of each signal.
+		"""
+		T = max(len(signal) for signal in signals)
+		x = torch.stack([torch.nn.functional.pad(signal, (0, T - len(signal))) for signal in signals])
+		if self.model.is_cuda: x = x.cuda()
+		with torch.inference_mode():
+			return self.model.decode_intents(x, structured=True)
+
+def read_signal(data, fs):
+	"""
+	data : bytes of an audio file (anything soundfile can read)
+
+	Returns the signal as a Tensor of shape (T,) (mixed down to mono).
+	"""
+	signal, file_fs = sf.read(io.BytesIO(data), dtype="float32")
+	if file_fs != fs:
+		raise ValueError("sampling rate %d instead of %d" % (file_fs, fs))
+	if signal.ndim > 1: signal = signal.mean(axis=1)
+	if len(signal) == 0:
+		raise ValueError("empty signal")
+	return torch.from_numpy(signal)
+
+def make_handler(batcher, fs, timeout):
+	class Handler(BaseHTTPRequestHandler):
+		"""
+		POST /predict with the bytes of a wav file --> {"intent": ..., "latency_ms": ..., "queue_ms": ..., "batch_size": ...}
+		GET /stats --> ServerStats.summary()
+		"""
+		def send_json(self, code, body):
+			data = json.dumps(body).encode()
+			self.send_response(code)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def do_GET(self):
+			if self.path.rstrip("/") == "/stats":
+				self.send_json(200, batcher.stats.summary(batcher.queue.qsize()))
+			else:
+				self.send_json(404, {"error": "unknown path " + self.path})
+
+		def do_POST(self):
+			if self.path.rstrip("/") != "/predict":
+				self.send_json(404, {"error": "unknown path " + self.path})
+				return
+			try:
+				signal = read_signal(self.rfile.read(int(self.headers.get("Content-Length", 0))), fs)
+			except Exception as e:
+				self.send_json(400, {"error": "could not read audio: %s" % e})
+				return
+			try:
+				future = batcher.submit(signal)
+			except queue.Full:
+				batcher.stats.add_rejected()
+				self.send_json(503, {"error": "queue full"})
+				return
+			try:
+				self.send_json(200, future.result(timeout=timeout))
+			except concurrent.futures.TimeoutError:
+				self.send_json(504, {"error": "timed out"})
+			except Exception as e:
+				self.send_json(500, {"error": str(e)})
+
+		def log_message(self, format, *args): # no line per request
+			pass
+
+	return Handler
+
+if __name__ == '__main__':
+	# Get args
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config_path', type=str, required=True, help='path to config file with hyperparameters, etc.')
+	parser.add_argument('--model_path', type=str, required=True, help='name of trained model to serve (in the training folder)')
+	parser.add_argument('--resplit_style', default='original', choices=['original','random', 'utterance_closed', "speaker_or_utterance_closed", "mutually_closed"], help='splits the model was trained on (for its intent labels)')
+	parser.add_argument('--utility', action='store_true', help='Use utility driven splits')
+	parser.add_argument('--host', type=str, default="127.0.0.1", help='address to listen on')
+	parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+	parser.add_argument('--max_batch_size', type=int, default=8, help='maximum number of requests per batch')
+	parser.add_argument('--max_delay_ms', type=float, default=10, help='maximum time the first request of a batch waits for others')
+	parser.add_argument('--max_queue_size', type=int, default=0, help='reject requests (503) when this many are waiting (0: no limit)')
+	parser.add_argument('--timeout', type=float, default=30, help='seconds before a request gives up (504)')
+	args = parser.parse_args()
+
+	# Read config file
+	config = read_config(args.config_path)
+	torch.manual_seed(config.seed); np.random.seed(config.seed)
+
+	# Read the intent labels from the training set
+	data_str=f"{args.resplit_style}_splits"
+	if args.utility:
+		data_str=data_str+"_utility"
+	get_SLU_datasets(config,data_str=data_str,split_style=args.resplit_style)
+
+	# Load the trained model
+	model = Model(config=config, lazy_pretrained=True)
+	trainer = Trainer(model=model, config=config)
+	load_factorized_checkpoint(trainer, args.model_path) # also loads models saved by factorize.py --save_models
+	model.eval()
+
+	batcher = MicroBatcher(model, max_batch_size=args.max_batch_size, max_delay=args.max_delay_ms / 1000, max_queue_size=args.max_queue_size)
+	batcher.infer([torch.zeros(config.fs)]) # warm up before taking requests
+	server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, config.fs, args.timeout))
+	print("Serving on http://%s:%d (POST /predict, GET /stats)" % (args.host, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
@@ -0,0 +1,170 @@
+# Runs main.py over a grid of config files and flags, several runs at a time, and collects their final results into one table
+import numpy as np
+import pandas as pd
+import multiprocessing
+import subprocess
+import configparser
+import itertools
+import hashlib
+import shlex
+import glob
+import json
+import time
+import sys
+import os
+from models import read_embedding_vectors
+from data import read_config, build_audio_cache
+import argparse
+
+def make_runs(config_paths, base_args, grid):
+	"""
+	config_paths : list of config files
+	base_args : list of arguments given to every run
+	grid : list of lists of alternatives (each a string of arguments, possibly empty)
+
+	Returns a list of (config path, list of arguments), one per combination.
+	"""
+	runs = []
+	for config_path in config_paths:
+		for alternatives in itertools.product(*grid):
+			args = list(base_args)
+			for alternative in alternatives:
+				args += shlex.split(alternative)
+			runs.append((config_path, args))
+	return runs
+
+def run_name(config_path, args):
+	name = os.path.splitext(os.path.basename(config_path))[0]
+	flags = "_".join(arg.lstrip("-").replace("=", "-").replace("/", "-") for arg in args)
+	return name + ("_" + flags if flags != "" else "")
+
+def get_arg(args, name):
+	"""
+	Returns the value of --name=value (or --name value) in args, or None.
+	"""
+	for idx, arg in enumerate(args):
+		if arg.startswith(name + "="): return arg[len(name) + 1:]
+		if arg == name and idx + 1 < len(args): return args[idx + 1]
+	return None
+
+def share_artifacts(runs, output_dir, audio_cache=True):
+	"""
+	Builds the artifacts that the runs only read, once, before they start:
+	the decoded audio of each SLU dataset (data.build_audio_cache) and the embedding caches (models.read_embedding_vectors).
+	The runs memory-map them (as they do the pre-trained model), so concurrent runs share one copy in the page cache.
+
+	Returns a dictionary (config path --> audio cache directory).
+	"""
+	audio_cache_dirs = {}
+	for config_path in sorted(set(config_path for config_path, _ in runs)):
+		config = read_config(config_path)
+		if audio_cache:
+			cache_dir = os.path.join(output_dir, "audio_cache", hashlib.sha1(os.path.abspath(config.slu_path).encode("utf-8")).hexdigest()[:16])
+			print("decoding the audio of " + config.slu_path + " into " + cache_dir)
+			build_audio_cache(config.slu_path, cache_dir)
+			audio_cache_dirs[config_path] = cache_dir
+
+	for config_path, args in runs:
+		embeddings_path = get_arg(args, "--semantic_embeddings_path")
+		if embeddings_path is None: continue
+		config = read_config(config_path)
+		with open(os.path.join(config.folder, "pretraining", "words.txt"), "r") as f:
+			Sy_word = [line.rstrip("\n") for line in f.readlines()]
+		dim = 300 if "--use_FastText_embeddings" in args else 100
+		read_embedding_vectors(embeddings_path, Sy_word, dim) # writes the cache on the first call
+	return audio_cache_dirs
+
+def write_run_overlay(path, num_threads, num_workers, overlay_path=None):
+	"""
+	Writes a config overlay (main.py --overlay_path) that sets the torch threads and data loader workers of one run,
+	on top of the values of overlay_path (e.g., an overlay written by autotune.py) if given.
+	"""
+	overlay = configparser.ConfigParser()
+	if overlay_path is not None and not overlay.read(overlay_path): print("Could not read " + overlay_path)
+	if not overlay.has_section("training"): overlay.add_section("training")
+	overlay["training"]["num_threads"] = str(num_threads)
+	overlay["training"]["num_workers"] = str(num_workers)
+	with open(path, "w") as f:
+		overlay.write(f)
+
+if __name__ == '__main__':
+	# Get args
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config_paths', type=str, required=True, help='comma-separated list of config files (or globs, e.g. "experiments/no_unfreezing*.cfg")')
+	parser.add_argument('--base_args', type=str, default="--train --resplit_style=original", help='arguments given to main.py in every run')
+	parser.add_argument('--grid', type=str, action='append', default=[], help='"|"-separated alternatives for one axis of the grid (e.g., "--seed=1|--seed=2", or "--utility|" for with and without); can be repeated')
+	parser.add_argument('--output_dir', type=str, default="sweep", help='directory for the output of each run, the shared artifacts and the results table')
+	parser.add_argument('--threads_per_run', type=int, default=1, help='torch threads per run')
+	parser.add_argument('--workers_per_run', type=int, default=1, help='data loader workers per run (0: load in the training process)')
+	parser.add_argument('--memory_per_run_mb', type=float, default=0, help='expected peak memory of one run (with --memory_budget_mb)')
+	parser.add_argument('--memory_budget_mb', type=float, default=0, help='total memory the concurrent runs may use (0: no limit)')
+	parser.add_argument('--max_parallel', type=int, default=0, help='maximum number of concurrent runs (0: as many as the cores and memory budget allow)')
+	parser.add_argument('--no_audio_cache', action='store_true', help='decode the wavs in every run instead of sharing the decoded audio')
+	args = parser.parse_args()
+
+	config_paths = []
+	for pattern in args.config_paths.split(","):
+		config_paths += sorted(glob.glob(pattern)) if any(c in pattern for c in "*?[") else [pattern]
+	grid = [alternatives.split("|") for alternatives in args.grid]
+	runs = make_runs(config_paths, shlex.split(args.base_args), grid)
+	names = [run_name(config_path, run_args) for config_path, run_args in runs]
+	duplicates = sorted(set(name for name in names if names.count(name) > 1))
+	if len(duplicates) > 0:
+		parser.error("these runs would share a run directory (same config and flags): " + ", ".join(duplicates))
+
+	# Resource budget
+	max_parallel = max(1, multiprocessing.cpu_count() // (args.threads_per_run + args.workers_per_run)) # the loader workers of each run need cores too
+	if args.memory_budget_mb > 0 and args.memory_per_run_mb > 0:
+		max_parallel = min(max_parallel, max(1, int(args.memory_budget_mb // args.memory_per_run_mb)))
+	if args.max_parallel > 0: max_parallel = min(max_parallel, args.max_parallel)
+	print("%d runs, %d at a time" % (len(runs), max_parallel))
+
+	os.makedirs(args.output_dir, exist_ok=True)
+	audio_cache_dirs = share_artifacts(runs, args.output_dir, audio_cache=not args.no_audio_cache)
+
+	env = dict(os.environ)
+	env["OMP_NUM_THREADS"] = env["MKL_NUM_THREADS"] = str(args.threads_per_run)
+	main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+	# Schedule the runs; runs with a summary from a previous sweep are skipped
+	pending = list(runs)
+	running = [] # (process, config path, arguments, run directory, start time, log file)
+	finished = [] # (config path, arguments, run directory, return code, elapsed time)
+	while len(pending) > 0 or len(running) > 0:
+		while len(pending) > 0 and len(running) < max_parallel:
+			config_path, run_args = pending.pop(0)
+			run_dir = os.path.join(args.output_dir, run_name(config_path, run_args))
+			if os.path.isfile(os.path.join(run_dir, "summary.json")):
+				finished.append((config_path, run_args, run_dir, 0, np.nan))
+				continue
+			os.makedirs(run_dir, exist_ok=True)
+			overlay_path = os.path.join(run_dir, "overlay.cfg")
+			write_run_overlay(overlay_path, args.threads_per_run, args.workers_per_run, get_arg(run_args, "--overlay_path"))
+			command = [sys.executable, main_path, "--config_path=" + config_path] + run_args + ["--overlay_path=" + overlay_path] # (the last --overlay_path wins; it includes the values of the one in run_args)
+			command += ["--summary_path=" + os.path.join(run_dir, "summary.json"), "--training_dir=" + os.path.join(run_dir, "training")] # each run has its own checkpoints, logs and training state
+			if config_path in audio_cache_dirs: command.append("--audio_cache_dir=" + audio_cache_dirs[config_path])
+			log = open(os.path.join(run_dir, "output.txt"), "w")
+			print("starting " + run_dir)
+			running.append((subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env), config_path, run_args, run_dir, time.perf_counter(), log))
+		time.sleep(1)
+		for entry in list(running):
+			process, config_path, run_args, run_dir, start, log = entry
+			if process.poll() is None: continue
+			log.close()
+			running.remove(entry)
+			finished.append((config_path, run_args, run_dir, process.returncode, time.perf_counter() - start))
+			print("finished %s (exit code %d, %.0fs)" % (run_dir, process.returncode, time.perf_counter() - start))
+
+	# Collect the final results
+	rows = []
+	for config_path, run_args, run_dir, returncode, elapsed in finished:
+		row = {"config": config_path, "args": " ".join(run_args), "exit_code": returncode, "elapsed_s": elapsed}
+		try:
+			with open(os.path.join(run_dir, "summary.json"), "r") as f:
+				row.update(json.load(f))
+		except:
+			print("no results for " + run_dir + " (see its output.txt)")
+		rows.append(row)
+	results = pd.DataFrame(rows)
+	results.to_csv(os.path.join(args.output_dir, "results.csv"), index=False)
+	print(results.to_string(index=False))
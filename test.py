@@ -70,9 +70,9 @@ if __name__ == '__main__':
 			for line in f.readlines():
 				Sy_word.append(line.rstrip("\n"))
 		FastText_embeddings=obtain_fasttext_embeddings(semantic_embeddings_path, Sy_word)
-		model = Model(config=config,pipeline=False, use_semantic_embeddings = use_FastText_embeddings, glove_embeddings=FastText_embeddings,glove_emb_dim=300, smooth_semantic= smooth_semantic, smooth_semantic_parameter= smooth_semantic_parameter)
+		model = Model(config=config,pipeline=False, use_semantic_embeddings = use_FastText_embeddings, glove_embeddings=FastText_embeddings,glove_emb_dim=300, smooth_semantic= smooth_semantic, smooth_semantic_parameter= smooth_semantic_parameter, lazy_pretrained=restart)
 	else:
-		model = Model(config=config)
+		model = Model(config=config, lazy_pretrained=restart) # the fine-tuned checkpoint replaces the pre-trained weights
 
 	# Load the trained model
 	trainer = Trainer(model=model, config=config)
@@ -103,9 +103,9 @@ if __name__ == '__main__':
 				for line in f.readlines():
 					Sy_word.append(line.rstrip("\n"))
 			FastText_embeddings=obtain_fasttext_embeddings(semantic_embeddings_path, Sy_word)
-			model = Model(config=config,pipeline=False, use_semantic_embeddings = use_FastText_embeddings, glove_embeddings=FastText_embeddings,glove_emb_dim=300, smooth_semantic= smooth_semantic, smooth_semantic_parameter= smooth_semantic_parameter)
+			model = Model(config=config,pipeline=False, use_semantic_embeddings = use_FastText_embeddings, glove_embeddings=FastText_embeddings,glove_emb_dim=300, smooth_semantic= smooth_semantic, smooth_semantic_parameter= smooth_semantic_parameter, lazy_pretrained=restart)
 		else:
-			model = Model(config=config)
+			model = Model(config=config, lazy_pretrained=restart) # the fine-tuned checkpoint replaces the pre-trained weights
 
 		# Load the trained model
 		trainer = Trainer(model=model, config=config)
@@ -2,11 +2,146 @@ import numpy as np
 import torch
 from tqdm import tqdm # for displaying progress bar
 import os
+import concurrent.futures
+import random
+import time
 from data import SLUDataset, ASRDataset
-from models import PretrainedModel, Model
+from models import PretrainedModel, Model, read_state_dict, state_dict_fingerprint
+from metrics import MetricsWriter, ThroughputMeter, MetricsAccumulator, steps_path
+from profiler import StepProfiler
+from distributed import get_rank, get_world_size, all_gather_object
 import pandas as pd
 from jiwer import wer
 
+def copy_to_cpu(value):
+	"""
+	Copies the tensors of a (nested) dictionary, list or tuple to host memory.
+	"""
+	if torch.is_tensor(value): return value.detach().to("cpu", copy=True)
+	if isinstance(value, dict): return {key: copy_to_cpu(item) for key, item in value.items()}
+	if isinstance(value, (list, tuple)): return type(value)(copy_to_cpu(item) for item in value)
+	return value
+
+def get_rng_state():
+	"""
+	Returns the states of the random number generators of this process (torch, CUDA, numpy and random).
+	"""
+	return {"torch": torch.get_rng_state(), "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [], "numpy": np.random.get_state(), "python": random.getstate()}
+
+def set_rng_state(state):
+	torch.set_rng_state(state["torch"])
+	if torch.cuda.is_available() and len(state["cuda"]) > 0: torch.cuda.set_rng_state_all(state["cuda"])
+	np.random.set_state(state["numpy"])
+	random.setstate(state["python"])
+
+class CheckpointWriter:
+	"""
+	Saves checkpoints without blocking training: the tensors are copied to host memory,
+	then serialized on a background thread and moved into place with an atomic rename.
+
+	A base checkpoint can be given to save a delta checkpoint containing only the tensors that differ
+	from it; models.read_state_dict rebuilds the full state dict when loading.
+
+	A checkpoint that cannot be written raises its exception in save (when synchronous),
+	or in the next call to save, save_state or wait (on the background thread).
+	"""
+	def __init__(self, asynchronous=True):
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if asynchronous else None
+		self.pending = []
+		self.base_state_dicts = {} # base path --> (modification time and size, state dict, fingerprint)
+
+	def save(self, state_dict, path, base_path=None, base_prefix=""):
+		"""
+		state_dict : state dict of the model
+		path : where to save the checkpoint
+		base_path : checkpoint that the tensors of state_dict whose name starts with base_prefix are compared against (e.g., the pre-trained model)
+		"""
+		snapshot = {name: tensor.detach().to("cpu", copy=True) for name, tensor in state_dict.items()}
+		self.submit(snapshot, path, base_path, base_prefix)
+
+	def save_state(self, state, path):
+		"""
+		state : dictionary of tensors and other values (e.g., the training state of Trainer.save_training_state)
+		"""
+		self.submit(copy_to_cpu(state), path, None, "")
+
+	def submit(self, snapshot, path, base_path, base_prefix):
+		if self.executor is None:
+			self.write(snapshot, path, base_path, base_prefix)
+		else:
+			for future in self.pending:
+				if future.done(): future.result() # raises the exception of a checkpoint that failed
+			self.pending = [future for future in self.pending if not future.done()]
+			self.pending.append(self.executor.submit(self.write, snapshot, path, base_path, base_prefix))
+
+	def read_base(self, base_path):
+		"""
+		Returns the state dict and fingerprint of a base checkpoint (read again if the file has changed).
+		"""
+		stat = os.stat(base_path)
+		version = (stat.st_mtime_ns, stat.st_size)
+		if base_path not in self.base_state_dicts or self.base_state_dicts[base_path][0] != version:
+			base = read_state_dict(base_path)
+			self.base_state_dicts[base_path] = (version, base, state_dict_fingerprint(base))
+		return self.base_state_dicts[base_path][1:]
+
+	def write(self, snapshot, path, base_path, base_prefix):
+		if base_path is not None:
+			base, fingerprint = self.read_base(base_path)
+			changed = {name: tensor for name, tensor in snapshot.items() if not (name.startswith(base_prefix) and name[len(base_prefix):] in base and torch.equal(tensor, base[name[len(base_prefix):]]))}
+			delta_from = os.path.relpath(os.path.abspath(base_path), os.path.dirname(os.path.abspath(path))) # so that the folders can be moved together
+			snapshot = {"delta_from": delta_from, "delta_from_fingerprint": fingerprint, "delta_prefix": base_prefix, "state_dict": changed}
+		try:
+			torch.save(snapshot, path + ".tmp")
+			os.replace(path + ".tmp", path)
+		except:
+			if os.path.exists(path + ".tmp"): os.remove(path + ".tmp")
+			raise
+
+	def wait(self):
+		"""
+		Blocks until all pending checkpoints are written.
+		"""
+		for future in self.pending:
+			future.result()
+		self.pending = []
+
+class EarlyStopping:
+	"""
+	Stops training when a validation metric has not improved by more than min_delta
+	for patience validations in a row (accuracies should increase, losses decrease).
+	patience=0 never stops.
+	"""
+	def __init__(self, metric="intent_acc", patience=0, min_delta=0.):
+		self.metric = metric
+		self.patience = patience
+		self.min_delta = min_delta
+		self.maximize = not metric.endswith("loss")
+		self.best = None
+		self.num_bad = 0 # validations since the last improvement
+		self.stopped = False
+
+	def update(self, results):
+		"""
+		results : dictionary of validation results, including self.metric
+
+		Returns True if the metric improved.
+		"""
+		value = results[self.metric]
+		if self.best is None:
+			improved = True
+		elif self.maximize:
+			improved = value > self.best + self.min_delta
+		else:
+			improved = value < self.best - self.min_delta
+		if improved:
+			self.best = value
+			self.num_bad = 0
+		else:
+			self.num_bad += 1
+		if self.patience > 0 and self.num_bad >= self.patience: self.stopped = True
+		return improved
+
 class Trainer:
 	def __init__(self, model, config):
 		self.model = model
@@ -17,126 +152,324 @@ class Trainer:
 		else:
 			self.lr = config.training_lr
 			self.checkpoint_path = os.path.join(self.config.folder, "training")
+			if config.training_dir is not None: # e.g., one folder per run of a sweep
+				self.checkpoint_path = config.training_dir
+				os.makedirs(self.checkpoint_path, exist_ok=True)
 		self.optimizer = torch.optim.Adam(model.parameters(), lr=self.lr)
 		self.epoch = 0
-		self.df = None
+		self.metrics_writers = {} # log file --> MetricsWriter
+		self.checkpoint_writer = CheckpointWriter(asynchronous=config.async_checkpointing)
+		self.profiler = StepProfiler(enabled=config.profile, use_cuda=model.is_cuda)
+		self.rank = get_rank() # only process 0 of a distributed run writes logs and checkpoints
+		self.world_size = get_world_size()
+		self.early_stopping = EarlyStopping(config.early_stopping_metric, config.early_stopping_patience, config.early_stopping_min_delta)
+		self.validation_subset = None # set by set_validation_subset
+		self.num_steps = 0 # training steps of all epochs
+		self.validation_time = 0 # seconds spent in validate_subset
+		self.training_state_path = "training_state.pth" # in the checkpoint folder (see save_training_state)
+		self.epoch_step = 0 # steps of the current epoch done before the training state was loaded
+		self.epoch_metrics = None # running sums of the metrics of these steps
+		self.extra_state = {} # values of the caller saved with the training state (e.g., the best validation accuracy)
+		self.append_logs = False # True when resuming, to continue the logs of the interrupted run
+		self.wrap_model()
+
+	def wrap_model(self):
+		"""
+		In a distributed run, wraps the model in DistributedDataParallel to average the gradients over the processes.
+		DDP only syncs the parameters that require gradients when it is built, so this is redone after unfreezing a layer.
+		The training loop calls self.ddp_model; everything else uses self.model.
+		"""
+		self.ddp_model = self.model
+		if self.world_size > 1:
+			self.ddp_model = torch.nn.parallel.DistributedDataParallel(self.model, find_unused_parameters=True) # e.g., the word layers when pre-training on phonemes only
 
 	def load_checkpoint(self,model_path="model_state.pth"):
+		self.checkpoint_writer.wait() # the checkpoint may still be being written
 		print(os.path.join(self.checkpoint_path, model_path))
 		if os.path.isfile(os.path.join(self.checkpoint_path, model_path)):
 			try:
-				if self.model.is_cuda:
-					self.model.load_state_dict(torch.load(os.path.join(self.checkpoint_path, model_path)))
-				else:
-					self.model.load_state_dict(torch.load(os.path.join(self.checkpoint_path, model_path), map_location="cpu"))
+				self.model.load_state_dict(read_state_dict(os.path.join(self.checkpoint_path, model_path), self.model.is_cuda))
 			except:
-				print("Could not load previous model; starting from scratch")
+				print("Could not load " + os.path.join(self.checkpoint_path, model_path)) # e.g., a model with other hyperparameters, or a delta checkpoint whose base has changed
+				raise
+			if isinstance(self.model, Model): self.model.pretrained_loaded = True # the checkpoint includes the pre-trained layers
+			return
 		else:
 			print("No previous model; starting from scratch")
+		if isinstance(self.model, Model): self.model.load_pretrained() # for models constructed with lazy_pretrained=True
 
 	def save_checkpoint(self,model_path="model_state.pth"):
-		try:
-			torch.save(self.model.state_dict(), os.path.join(self.checkpoint_path, model_path))
-		except:
-			print("Could not save model")
+		if self.rank != 0: return
+		base_path = None
+		if self.config.delta_checkpointing and isinstance(self.model, Model) and self.model.pretrained_model_path is not None:
+			base_path = self.model.pretrained_model_path # only save the tensors that differ from the pre-trained model
+		self.checkpoint_writer.save(self.model.state_dict(), os.path.join(self.checkpoint_path, model_path), base_path=base_path, base_prefix="pretrained_model.")
+
+	def save_training_state(self, epoch_step=0, accumulator=None):
+		"""
+		Saves everything needed to continue training after epoch_step steps of the current epoch (save_checkpoint only saves the model):
+		the model and optimizer, the epoch and step counters, the unfreezing index, the early stopping, the running sums of the
+		metrics of the epoch (accumulator) and the random number generator states of every process. Call on every process.
+		"""
+		rng_states = all_gather_object(get_rng_state())
+		if self.rank != 0: return
+		self.flush_logs() # the logs stay consistent with the saved state
+		state = {"model": self.model.state_dict(), "optimizer": self.optimizer.state_dict(), "epoch": self.epoch, "epoch_step": epoch_step, "num_steps": self.num_steps,
+			"unfreezing_index": self.model.unfreezing_index if isinstance(self.model, Model) else None, "validation_time": self.validation_time,
+			"early_stopping": {"best": self.early_stopping.best, "num_bad": self.early_stopping.num_bad, "stopped": self.early_stopping.stopped},
+			"epoch_metrics": accumulator.state_dict() if accumulator is not None else None, "extra_state": self.extra_state, "rng": rng_states}
+		self.checkpoint_writer.save_state(state, os.path.join(self.checkpoint_path, self.training_state_path))
 
-	def log(self, results, log_file="log.csv"):
-		if self.df is None:
-			self.df = pd.DataFrame(columns=[field for field in results])
-		self.df.loc[len(self.df)] = results
-		self.df.to_csv(os.path.join(self.checkpoint_path, log_file))
+	def load_training_state(self):
+		"""
+		Restores the state saved by save_training_state: the next call to train continues the epoch where it was saved,
+		with the same data order and random numbers as a run that was not interrupted (with the same number of processes).
+		Returns False if there is no saved state.
+		"""
+		self.checkpoint_writer.wait()
+		path = os.path.join(self.checkpoint_path, self.training_state_path)
+		if not os.path.isfile(path):
+			print("No training state in " + path + "; starting from scratch")
+			return False
+		state = torch.load(path, map_location=None if self.model.is_cuda else "cpu", weights_only=False) # the numpy RNG state is not a tensor
+		self.model.load_state_dict(state["model"])
+		if isinstance(self.model, Model):
+			self.model.pretrained_loaded = True
+			self.model.set_unfreezing_index(state["unfreezing_index"])
+			self.wrap_model()
+		self.optimizer.load_state_dict(state["optimizer"])
+		self.epoch = state["epoch"]
+		self.epoch_step = state["epoch_step"]
+		self.num_steps = state["num_steps"]
+		self.validation_time = state["validation_time"]
+		for name, value in state["early_stopping"].items():
+			setattr(self.early_stopping, name, value)
+		self.epoch_metrics = state["epoch_metrics"]
+		if self.epoch_metrics is not None:
+			device = next(self.model.parameters()).device
+			self.epoch_metrics["sums"] = {name: total.to(device) for name, total in self.epoch_metrics["sums"].items()}
+		self.extra_state = state["extra_state"]
+		self.append_logs = True
+		rng_states = state["rng"]
+		set_rng_state(rng_states[self.rank] if len(rng_states) == self.world_size else rng_states[0])
+		print("Resuming from epoch %d, step %d" % (self.epoch + 1, self.epoch_step))
+		return True
+
+	def resume_epoch(self, dataset, accumulator):
+		"""
+		Continues the epoch of a loaded training state: skips the examples of the steps already done
+		and restores the running sums of their metrics. Returns the number of these steps.
+		"""
+		start_step = self.epoch_step
+		if start_step > 0:
+			dataset.loader.sampler.skip(start_step * dataset.loader.batch_size)
+			accumulator.load_state_dict(self.epoch_metrics)
+		self.epoch_step = 0
+		self.epoch_metrics = None
+		return start_step
+
+	def log(self, results, log_file="log.csv", flush_every=1):
+		if self.rank != 0: return
+		if log_file not in self.metrics_writers:
+			self.metrics_writers[log_file] = MetricsWriter(os.path.join(self.checkpoint_path, log_file), flush_every=flush_every, append=self.append_logs)
+		self.metrics_writers[log_file].write(results)
+
+	def log_step(self, results, log_file="log.csv"):
+		"""
+		Per-step results go to a separate file (e.g., log_steps.csv), flushed every 100 steps and at the end of the epoch.
+		"""
+		self.log(results, steps_path(log_file), flush_every=100)
+
+	def log_steps(self, accumulator, log_file="log.csv"):
+		"""
+		Writes the per-step rows kept by a MetricsAccumulator (this waits for the device to finish them).
+		"""
+		for step_results in accumulator.steps():
+			self.log_step(step_results, log_file)
+
+	def flush_logs(self):
+		for writer in self.metrics_writers.values():
+			writer.flush()
+
+	def profile_epoch(self, log_file="log.csv"):
+		"""
+		Prints the time spent in each phase of the training steps of the epoch and returns it (empty if profiling is off).
+		With profile_trace, the steps are also saved as a Chrome trace (e.g., log_trace_epoch0.json).
+		"""
+		if not self.profiler.enabled: return {}
+		summary = self.profiler.epoch_summary()
+		self.profiler.print_summary(summary)
+		if self.config.profile_trace:
+			self.profiler.write_trace(os.path.join(self.checkpoint_path, os.path.splitext(log_file)[0] + "_trace_epoch%d.json" % self.epoch))
+		return summary
 
 	def train(self, dataset, print_interval=100, log_file="log.csv"):
 		# TODO: refactor to remove if-statement?
 		if isinstance(dataset, ASRDataset):
-			train_phone_acc = 0
-			train_phone_loss = 0
-			train_word_acc = 0
-			train_word_loss = 0
-			num_examples = 0
 			self.model.train()
-			for idx, batch in enumerate(tqdm(dataset.loader)):
+			self.set_sampler_epoch(dataset)
+			meter = ThroughputMeter(self.config.fs)
+			accumulator = MetricsAccumulator()
+			start_step = self.resume_epoch(dataset, accumulator)
+			self.profiler.start_epoch()
+			for idx, batch in enumerate(tqdm(dataset.loader, disable=self.rank != 0), start=start_step):
+				meter.batch_ready()
+				self.profiler.batch_ready()
 				x,y_phoneme,y_word = batch
 				batch_size = len(x)
-				num_examples += batch_size
-				phoneme_loss, word_loss, phoneme_acc, word_acc = self.model(x,y_phoneme,y_word)
-				if self.config.pretraining_type == 1: loss = phoneme_loss
-				if self.config.pretraining_type == 2: loss = phoneme_loss + word_loss
-				if self.config.pretraining_type == 3: loss = word_loss
-				self.optimizer.zero_grad()
-				loss.backward()
-				self.optimizer.step()
-				train_phone_loss += phoneme_loss.cpu().data.numpy().item() * batch_size
-				train_word_loss += word_loss.cpu().data.numpy().item() * batch_size
-				train_phone_acc += phoneme_acc.cpu().data.numpy().item() * batch_size
-				train_word_acc += word_acc.cpu().data.numpy().item() * batch_size
+				with self.profiler.phase("h2d"):
+					if self.model.is_cuda:
+						x = x.cuda(); y_phoneme = y_phoneme.cuda(); y_word = y_word.cuda()
+				with self.profiler.phase("forward"):
+					phoneme_loss, word_loss, phoneme_acc, word_acc = self.ddp_model(x,y_phoneme,y_word)
+					if self.config.pretraining_type == 1: loss = phoneme_loss
+					if self.config.pretraining_type == 2: loss = phoneme_loss + word_loss
+					if self.config.pretraining_type == 3: loss = word_loss
+				with self.profiler.phase("backward"):
+					self.optimizer.zero_grad()
+					loss.backward()
+				with self.profiler.phase("optimizer"):
+					self.optimizer.step()
+				step_info = {"epoch": self.epoch, "step": idx}
+				step_info.update(meter.step_done(x))
+				accumulator.add(batch_size, {"phone_loss": phoneme_loss, "phone_acc": phoneme_acc, "word_loss": word_loss, "word_acc": word_acc}, step_info)
 				if idx % print_interval == 0:
-					print("phoneme loss: " + str(phoneme_loss.cpu().data.numpy().item()))
-					print("word loss: " + str(word_loss.cpu().data.numpy().item()))
-					print("phoneme acc: " + str(phoneme_acc.cpu().data.numpy().item()))
-					print("word acc: " + str(word_acc.cpu().data.numpy().item()))
-			train_phone_loss /= num_examples
-			train_phone_acc /= num_examples
-			train_word_loss /= num_examples
-			train_word_acc /= num_examples
+					self.log_steps(accumulator, log_file) # only wait for the device every print_interval steps
+					if self.rank == 0:
+						print("phoneme loss: " + str(phoneme_loss.item()))
+						print("word loss: " + str(word_loss.item()))
+						print("phoneme acc: " + str(phoneme_acc.item()))
+						print("word acc: " + str(word_acc.item()))
+				self.profiler.step_done()
+				self.num_steps += 1
+				if self.config.training_state_interval > 0 and self.num_steps % self.config.training_state_interval == 0:
+					self.log_steps(accumulator, log_file)
+					self.save_training_state(idx + 1, accumulator)
+					meter.resume(); self.profiler.resume()
+			self.log_steps(accumulator, log_file)
+			accumulator.all_reduce(); meter.all_reduce() # results of the whole run
+			means = accumulator.means()
+			train_phone_loss = means["phone_loss"]
+			train_phone_acc = means["phone_acc"]
+			train_word_loss = means["word_loss"]
+			train_word_acc = means["word_acc"]
 			results = {"phone_loss" : train_phone_loss, "phone_acc" : train_phone_acc, "word_loss" : train_word_loss, "word_acc" : train_word_acc, "set": "train"}
+			results.update(meter.epoch_results())
+			results.update(self.profile_epoch(log_file))
 			self.log(results, log_file)
+			self.flush_logs()
 			self.epoch += 1
 			return train_phone_acc, train_phone_loss, train_word_acc, train_word_loss
 		else: # SLUDataset
 			
-			train_intent_acc = 0
-			train_intent_loss = 0
-			num_examples = 0
 			self.model.train()
 			self.model.print_frozen()
-			for idx, batch in enumerate(tqdm(dataset.loader)):
+			self.set_sampler_epoch(dataset)
+			meter = ThroughputMeter(self.config.fs)
+			accumulator = MetricsAccumulator()
+			start_step = self.resume_epoch(dataset, accumulator)
+			self.profiler.start_epoch()
+			for idx, batch in enumerate(tqdm(dataset.loader, disable=self.rank != 0), start=start_step):
+				meter.batch_ready()
+				self.profiler.batch_ready()
 				x,_,y_intent = batch
 				batch_size = len(x)
-				num_examples += batch_size
-				intent_loss, intent_acc = self.model(x,y_intent)
-				loss = intent_loss
-				self.optimizer.zero_grad()
-				loss.backward()
-				self.optimizer.step()
-				train_intent_loss += intent_loss.cpu().data.numpy().item() * batch_size
-				train_intent_acc += intent_acc.cpu().data.numpy().item() * batch_size
+				with self.profiler.phase("h2d"):
+					if self.model.is_cuda:
+						x = x.cuda(); y_intent = y_intent.cuda()
+				with self.profiler.phase("forward"):
+					intent_loss, intent_acc = self.ddp_model(x,y_intent)
+					loss = intent_loss
+				with self.profiler.phase("backward"):
+					self.optimizer.zero_grad()
+					loss.backward()
+				with self.profiler.phase("optimizer"):
+					self.optimizer.step()
+				step_info = {"epoch": self.epoch, "step": idx}
+				step_info.update(meter.step_done(x))
+				accumulator.add(batch_size, {"intent_loss": intent_loss, "intent_acc": intent_acc}, step_info)
 				if idx % print_interval == 0:
-					print("intent loss: " + str(intent_loss.cpu().data.numpy().item()))
-					print("intent acc: " + str(intent_acc.cpu().data.numpy().item()))
-					if self.model.seq2seq:
-						self.model.cpu(); self.model.is_cuda = False
-						x = x.cpu(); y_intent = y_intent.cpu()
-						print("seq2seq output")
-						self.model.eval()
-						print("guess: " + self.model.decode_intents(x)[0])
-						print("truth: " + self.model.one_hot_to_string(y_intent[0],self.model.Sy_intent))
-						self.model.train()
-						self.model.cuda(); self.model.is_cuda = True
-			train_intent_loss /= num_examples
-			train_intent_acc /= num_examples
+					self.log_steps(accumulator, log_file) # only wait for the device every print_interval steps
+					if self.rank == 0:
+						print("intent loss: " + str(intent_loss.item()))
+						print("intent acc: " + str(intent_acc.item()))
+						if self.model.seq2seq:
+							print("seq2seq output")
+							self.model.eval()
+							with torch.inference_mode():
+								print("guess: " + self.model.decode_intents(x)[0])
+							print("truth: " + self.model.one_hot_to_string(y_intent[0],self.model.Sy_intent))
+							self.model.train()
+				self.profiler.step_done()
+				self.num_steps += 1
+				if self.validation_subset is not None and self.config.validation_interval > 0 and self.num_steps % self.config.validation_interval == 0:
+					self.validate_subset(idx, log_file)
+				if self.config.training_state_interval > 0 and self.num_steps % self.config.training_state_interval == 0:
+					self.log_steps(accumulator, log_file)
+					self.save_training_state(idx + 1, accumulator)
+				meter.resume(); self.profiler.resume() # validating and saving are not training
+				if self.early_stopping.stopped: break # every process validates on the same subset, so they all stop here
+			self.log_steps(accumulator, log_file)
+			accumulator.all_reduce(); meter.all_reduce() # results of the whole run
+			means = accumulator.means()
+			train_intent_loss = means["intent_loss"]
+			train_intent_acc = means["intent_acc"]
 			self.model.unfreeze_one_layer()
+			self.wrap_model()
 			results = {"intent_loss" : train_intent_loss, "intent_acc" : train_intent_acc, "set": "train"}
+			results.update(meter.epoch_results())
+			results.update(self.profile_epoch(log_file))
 			self.log(results, log_file)
+			self.flush_logs()
 			self.epoch += 1
 			return train_intent_acc, train_intent_loss
 
+	def set_validation_subset(self, dataset, size=0):
+		"""
+		Validates on a fixed subset of size examples of dataset (all of it if size is 0) every config.validation_interval
+		training steps, instead of only at the end of each epoch; with early stopping, it is checked after each of these validations.
+		The subset is drawn once with the config seed, so that successive validations are comparable.
+		"""
+		indices = np.arange(len(dataset))
+		if 0 < size < len(dataset):
+			indices = np.sort(np.random.RandomState(self.config.seed).choice(len(dataset), size, replace=False))
+		self.validation_subset = torch.utils.data.Subset(dataset, indices.tolist())
+		self.validation_subset.loader = torch.utils.data.DataLoader(self.validation_subset, batch_size=dataset.loader.batch_size, shuffle=False, num_workers=dataset.loader.num_workers, collate_fn=dataset.loader.collate_fn)
+
+	def validate_subset(self, step, log_file="log.csv"):
+		"""
+		Validates on the subset of set_validation_subset, logs the results (e.g., to log_validation.csv) and updates the early stopping.
+		"""
+		start = time.perf_counter()
+		intent_acc, intent_loss = self.test(self.validation_subset, log_file=None)
+		self.validation_time += time.perf_counter() - start
+		results = {"epoch": self.epoch, "step": step, "num_steps": self.num_steps, "intent_loss": intent_loss, "intent_acc": intent_acc}
+		self.early_stopping.update(results)
+		root, ext = os.path.splitext(log_file)
+		self.log(results, root + "_validation" + ext)
+		if self.rank == 0:
+			print("step %d: subset valid accuracy: %.2f| subset valid loss: %.2f" % (self.num_steps, intent_acc, intent_loss))
+
+	def set_sampler_epoch(self, dataset):
+		"""
+		Reshuffles the dataset (the share of each process of a distributed run) differently every epoch,
+		and picks the random snippets of the epoch (ASRDataset).
+		"""
+		if isinstance(dataset.loader.sampler, torch.utils.data.distributed.DistributedSampler):
+			dataset.loader.sampler.set_epoch(self.epoch)
+		dataset.epoch = self.epoch
+
 	def get_word_SLU(self, dataset, Sy_word, postprocess_words=False, print_interval=100, smooth_semantic= False, smooth_semantic_parameter= None): # Code to return predicted utterances from the model
-		train_intent_acc = 0
-		train_intent_loss = 0
-		num_examples = 0
-		self.model.train()
-		self.model.print_frozen()
 		actual_words_complete=[]
 		audio_paths=[]
-		for idx, batch in enumerate(tqdm(dataset.loader)):
+		def batch_fn(idx, batch):
 			x, x_paths, y_intent = batch
-			batch_size = len(x)
-			num_examples += batch_size
+			_, _, word_logits = self.model.pretrained_model.compute_outputs(x)
 			if smooth_semantic:
-				x_words, x_weight = self.model.get_top_words( x, k=smooth_semantic_parameter)
+				x_words, x_weight = self.model.top_words_from_logits(word_logits, k=smooth_semantic_parameter)
 			else:
-				x_words = self.model.get_words(x)
+				x_words = self.model.words_from_logits(word_logits)
+			x_words = x_words.tolist()
 			if postprocess_words:
 				x_words_new=[]
 				for j in x_words:
@@ -156,20 +489,18 @@ class Trainer:
 				actual_words=[[[Sy_word[topk] for topk in k] for k in j] for j in x_words]
 			else:
 				actual_words=[[Sy_word[k] for k in j] for j in x_words]
-			actual_words_complete=actual_words_complete+actual_words
+			actual_words_complete.extend(actual_words)
 			audio_paths.extend(x_paths)
+		self.evaluate(dataset, batch_fn, progress=True)
 		return actual_words_complete, audio_paths
 
 	def pipeline_train_decoder(self, dataset, postprocess_words=False, print_interval=100,gold=False, log_file="log.csv"): # Code to train model in pipeline manner
-		train_intent_acc = 0
-		train_intent_loss = 0
-		num_examples = 0
 		self.model.train()
 		self.model.print_frozen()
+		accumulator = MetricsAccumulator()
 		for idx, batch in enumerate(tqdm(dataset.loader)):
 			x,_,y_intent = batch
 			batch_size = len(x)
-			num_examples += batch_size
 			if gold: # Use gold set utterances
 				x_words=x.type(torch.LongTensor)
 				if torch.cuda.is_available():
@@ -198,97 +529,103 @@ class Trainer:
 			self.optimizer.zero_grad()
 			loss.backward()
 			self.optimizer.step()
-			train_intent_loss += intent_loss.cpu().data.numpy().item() * batch_size
-			train_intent_acc += intent_acc.cpu().data.numpy().item() * batch_size
+			accumulator.add(batch_size, {"intent_loss": intent_loss, "intent_acc": intent_acc})
 			if idx % print_interval == 0:
-				print("intent loss: " + str(intent_loss.cpu().data.numpy().item()))
-				print("intent acc: " + str(intent_acc.cpu().data.numpy().item()))
+				print("intent loss: " + str(intent_loss.item()))
+				print("intent acc: " + str(intent_acc.item()))
 				if self.model.seq2seq:
-					self.model.cpu(); self.model.is_cuda = False
-					x = x.cpu(); y_intent = y_intent.cpu()
 					print("seq2seq output")
 					self.model.eval()
-					print("guess: " + self.model.decode_intents(x)[0])
+					with torch.inference_mode():
+						print("guess: " + self.model.decode_intents(x)[0])
 					print("truth: " + self.model.one_hot_to_string(y_intent[0],self.model.Sy_intent))
 					self.model.train()
-					self.model.cuda(); self.model.is_cuda = True
-		train_intent_loss /= num_examples
-		train_intent_acc /= num_examples
+		means = accumulator.means()
+		train_intent_loss = means["intent_loss"]
+		train_intent_acc = means["intent_acc"]
 		self.model.unfreeze_one_layer()
 		results = {"intent_loss" : train_intent_loss, "intent_acc" : train_intent_acc, "set": "train"}
 		self.log(results, log_file)
 		self.epoch += 1
 		return train_intent_acc, train_intent_loss
 
+	def evaluate(self, dataset, batch_fn, progress=False):
+		"""
+		Evaluation loop shared by test, pipeline_test_decoder, get_error, get_asr_error and get_word_SLU.
+
+		batch_fn(idx, batch) is called on every batch of dataset and returns a dictionary of metrics
+		(name --> Tensor with one element, the mean over the batch), or None.
+		The model stays on its device and runs in eval mode under torch.inference_mode;
+		its train/eval mode is restored afterwards.
+
+		Returns the MetricsAccumulator of the metrics (summed over the processes of a distributed run).
+		"""
+		accumulator = MetricsAccumulator()
+		was_training = self.model.training
+		self.model.eval()
+		loader = tqdm(dataset.loader) if progress else dataset.loader
+		with torch.inference_mode():
+			for idx, batch in enumerate(loader):
+				metrics = batch_fn(idx, batch)
+				if metrics is not None:
+					accumulator.add(len(batch[0]), metrics)
+		self.model.train(was_training)
+		accumulator.all_reduce() # for the share of the dataset of each process of a distributed run
+		return accumulator
+
+	def decoded_accuracy(self, idx, x, y_intent):
+		"""
+		Accuracy of the decoded intent strings of a batch (seq2seq models), as a Tensor with one element.
+		"""
+		print("decoding batch %d" % idx)
+		guess_strings = np.array(self.model.decode_intents(x))
+		truth_strings = np.array([self.model.one_hot_to_string(y_intent[i],self.model.Sy_intent) for i in range(len(x))])
+		print("acc: " + str((guess_strings == truth_strings).mean()))
+		print("guess: " + guess_strings[0])
+		print("truth: " + truth_strings[0])
+		return torch.tensor((guess_strings == truth_strings).mean())
+
 	def test(self, dataset, log_file="log.csv", asr_setup=False):
 		if isinstance(dataset, ASRDataset) or asr_setup:
-			test_phone_acc = 0
-			test_phone_loss = 0
-			test_word_acc = 0
-			test_word_loss = 0
-			num_examples = 0
-			self.model.eval()
-			for idx, batch in enumerate(dataset.loader):
+			def batch_fn(idx, batch):
 				x,y_phoneme,y_word = batch
-				batch_size = len(x)
-				num_examples += batch_size
 				phoneme_loss, word_loss, phoneme_acc, word_acc = self.model(x,y_phoneme,y_word)
-				test_phone_loss += phoneme_loss.cpu().data.numpy().item() * batch_size
-				test_word_loss += word_loss.cpu().data.numpy().item() * batch_size
-				test_phone_acc += phoneme_acc.cpu().data.numpy().item() * batch_size
-				test_word_acc += word_acc.cpu().data.numpy().item() * batch_size
-			test_phone_loss /= num_examples
-			test_phone_acc /= num_examples
-			test_word_loss /= num_examples
-			test_word_acc /= num_examples
+				return {"phone_loss": phoneme_loss, "phone_acc": phoneme_acc, "word_loss": word_loss, "word_acc": word_acc}
+			means = self.evaluate(dataset, batch_fn).means()
+			test_phone_loss = means["phone_loss"]
+			test_phone_acc = means["phone_acc"]
+			test_word_loss = means["word_loss"]
+			test_word_acc = means["word_acc"]
 			results = {"phone_loss" : test_phone_loss, "phone_acc" : test_phone_acc, "word_loss" : test_word_loss, "word_acc" : test_word_acc,"set": "valid"}
 			self.log(results, log_file)
 			return test_phone_acc, test_phone_loss, test_word_acc, test_word_loss 
 		else:
-			test_intent_acc = 0
-			test_intent_loss = 0
-			num_examples = 0
-			self.model.eval()
-			self.model.cpu(); self.model.is_cuda = False # beam search is memory-intensive; do on CPU for now
-			for idx, batch in enumerate(dataset.loader):
+			def batch_fn(idx, batch):
 				x,x_path, y_intent = batch
-				batch_size = len(x)
-				num_examples += batch_size
 				intent_loss, intent_acc = self.model(x,y_intent)
-				test_intent_loss += intent_loss.cpu().data.numpy().item() * batch_size
-				test_intent_acc += intent_acc.cpu().data.numpy().item() * batch_size
+				metrics = {"intent_loss": intent_loss, "intent_acc": intent_acc}
 				if self.model.seq2seq and self.epoch > 1:
-					print("decoding batch %d" % idx)
-					guess_strings = np.array(self.model.decode_intents(x))
-					truth_strings = np.array([self.model.one_hot_to_string(y_intent[i],self.model.Sy_intent) for i in range(batch_size)])
-					test_intent_acc += (guess_strings == truth_strings).mean() * batch_size
-					print("acc: " + str((guess_strings == truth_strings).mean()))
-					print("guess: " + guess_strings[0])
-					print("truth: " + truth_strings[0])
-			self.model.cuda(); self.model.is_cuda = True
-			test_intent_loss /= num_examples
-			test_intent_acc /= num_examples
+					metrics["decoded_acc"] = self.decoded_accuracy(idx, x, y_intent)
+				return metrics
+			means = self.evaluate(dataset, batch_fn).means()
+			test_intent_loss = means["intent_loss"]
+			test_intent_acc = means["intent_acc"] + means.get("decoded_acc", 0)
 			results = {"intent_loss" : test_intent_loss, "intent_acc" : test_intent_acc, "set": "valid"}
-			self.log(results, log_file)
+			if log_file is not None: self.log(results, log_file)
 			return test_intent_acc, test_intent_loss 
 	
 	def pipeline_test_decoder(self, dataset, postprocess_words=False,gold=False, log_file="log.csv"): #Code to test model in pipeline manner
-		test_intent_acc = 0
-		test_intent_loss = 0
-		num_examples = 0
-		self.model.eval()
-		self.model.cpu(); self.model.is_cuda = False # beam search is memory-intensive; do on CPU for now
-		for idx, batch in enumerate(dataset.loader):
+		def batch_fn(idx, batch):
 			x,x_path, y_intent = batch
-			batch_size = len(x)
-			num_examples += batch_size
 			if gold: # Use gold set utterances
 				x_words=x.type(torch.LongTensor)
+				if self.model.is_cuda:
+					x_words = x_words.cuda()
 			else:
 				x_words = self.model.get_words(x) # Use utterances predicted by ASR
 				if postprocess_words:
 					x_words_new=[]
-					for j in x_words:
+					for j in x_words.tolist():
 						cur_list=[]
 						prev_k=0
 						for k in j:
@@ -301,22 +638,16 @@ class Trainer:
 						cur_list=cur_list+([0]*(len(j)-len(cur_list)))
 						x_words_new.append(cur_list)
 					x_words=torch.LongTensor(x_words_new)
-					if torch.cuda.is_available():
+					if self.model.is_cuda:
 						x_words = x_words.cuda()
 			intent_loss, intent_acc = self.model.run_pipeline(x_words,y_intent)
-			test_intent_loss += intent_loss.cpu().data.numpy().item() * batch_size
-			test_intent_acc += intent_acc.cpu().data.numpy().item() * batch_size
+			metrics = {"intent_loss": intent_loss, "intent_acc": intent_acc}
 			if self.model.seq2seq and self.epoch > 1:
-				print("decoding batch %d" % idx)
-				guess_strings = np.array(self.model.decode_intents(x))
-				truth_strings = np.array([self.model.one_hot_to_string(y_intent[i],self.model.Sy_intent) for i in range(batch_size)])
-				test_intent_acc += (guess_strings == truth_strings).mean() * batch_size
-				print("acc: " + str((guess_strings == truth_strings).mean()))
-				print("guess: " + guess_strings[0])
-				print("truth: " + truth_strings[0])
-		self.model.cuda(); self.model.is_cuda = True
-		test_intent_loss /= num_examples
-		test_intent_acc /= num_examples
+				metrics["decoded_acc"] = self.decoded_accuracy(idx, x, y_intent)
+			return metrics
+		means = self.evaluate(dataset, batch_fn).means()
+		test_intent_loss = means["intent_loss"]
+		test_intent_acc = means["intent_acc"] + means.get("decoded_acc", 0)
 		results = {"intent_loss" : test_intent_loss, "intent_acc" : test_intent_acc, "set": "valid"}
 		self.log(results, log_file)
 		return test_intent_acc, test_intent_loss
@@ -324,9 +655,6 @@ class Trainer:
 	def get_asr_error(self, dataset, error_path=None):
 		# for asr testing setup
 		# dataset 'y_intent' is really the gold transcript words 
-		num_examples = 0
-		self.model.eval()
-		self.model.cpu(); self.model.is_cuda = False # beam search is memory-intensive; do on CPU for now
 		wers = []
 		lengths = []
 		true_ = []
@@ -337,13 +665,12 @@ class Trainer:
 			for line in f.readlines():
 				Sy_word.append(line.rstrip("\n"))
 		Sy_word.append('<UNK>')
-		for idx, batch in enumerate(dataset.loader):
-				
+		def batch_fn(idx, batch):
 			x,x_path, y_word = batch
 			batch_size = len(x)
-			num_examples += batch_size
 			
-			x_words = self.model.test(x,y_word, asr_setup=True)
+			_, _, word_logits = self.model.pretrained_model.compute_outputs(x) # word posteriors of the pre-trained ASR layers
+			x_words = self.model.words_from_logits(word_logits).cpu()
 			for i in range(batch_size):
 				unpadded = {}
 				for lbl, val in zip(['pred', 'true'], [x_words[i].flatten(), y_word[i].flatten()]):
@@ -351,7 +678,7 @@ class Trainer:
 					
 					
 					unpadded[lbl] = [Sy_word[int(v)] for v in val]
-				pred = unpadded['pred']
+				pred = [word for j, word in enumerate(unpadded['pred']) if j == 0 or word != unpadded['pred'][j-1]] # one word per run of frames
 				true = unpadded['true']
 				
 				
@@ -366,6 +693,7 @@ class Trainer:
 				score = wer(true_str, pred_str)
 				wers.append(score)
 				lengths.append(len(true))
+		self.evaluate(dataset, batch_fn)
 		if error_path is not None:
 			errors = pd.DataFrame(data = {'audio_path':paths, 'predicted': pred_, 'ground_truth': true_, 'wer': wers})
 			errors.to_csv(error_path,index=False)
@@ -374,7 +702,7 @@ class Trainer:
 		lengths = np.asarray(lengths)
 		weights = lengths / np.sum(lengths)
 		weights = weights.reshape(len(weights), 1)
-		avg_wer = float(np.matmul(wers,weights).flatten())
+		avg_wer = np.matmul(wers,weights).item()
 		self.log({"wer": avg_wer})
 		
 		
@@ -382,52 +710,17 @@ class Trainer:
 
 	def get_error(self, dataset, error_path=None): # Code to generate csv file containing error cases for model
 		if isinstance(dataset, ASRDataset):
-			test_phone_acc = 0
-			test_phone_loss = 0
-			test_word_acc = 0
-			test_word_loss = 0
-			num_examples = 0
-			self.model.eval()
-			for idx, batch in enumerate(dataset.loader):
-				x,y_phoneme,y_word = batch
-				batch_size = len(x)
-				num_examples += batch_size
-				phoneme_loss, word_loss, phoneme_acc, word_acc = self.model(x,y_phoneme,y_word)
-				test_phone_loss += phoneme_loss.cpu().data.numpy().item() * batch_size
-				test_word_loss += word_loss.cpu().data.numpy().item() * batch_size
-				test_phone_acc += phoneme_acc.cpu().data.numpy().item() * batch_size
-				test_word_acc += word_acc.cpu().data.numpy().item() * batch_size
-			test_phone_loss /= num_examples
-			test_phone_acc /= num_examples
-			test_word_loss /= num_examples
-			test_word_acc /= num_examples
-			results = {"phone_loss" : test_phone_loss, "phone_acc" : test_phone_acc, "word_loss" : test_word_loss, "word_acc" : test_word_acc,"set": "valid"}
-			self.log(results)
-			return test_phone_acc, test_phone_loss, test_word_acc, test_word_loss 
+			return self.test(dataset)
 		else:
 			complete_path_filter=[]
 			complete_pred=[]
 			complete_y=[]
-			test_intent_acc = 0
-			test_intent_loss = 0
-			num_examples = 0
-			self.model.eval()
-			self.model.cpu(); self.model.is_cuda = False # beam search is memory-intensive; do on CPU for now
-			for idx, batch in enumerate(dataset.loader):
+			def batch_fn(idx, batch):
 				x,x_path, y_intent = batch
-				batch_size = len(x)
-				num_examples += batch_size
 				predicted_intent,y_intent,intent_loss, intent_acc = self.model.test(x,y_intent)
-				test_intent_loss += intent_loss.cpu().data.numpy().item() * batch_size
-				test_intent_acc += intent_acc.cpu().data.numpy().item() * batch_size
+				metrics = {"intent_loss": intent_loss, "intent_acc": intent_acc}
 				if self.model.seq2seq and self.epoch > 1:
-					print("decoding batch %d" % idx)
-					guess_strings = np.array(self.model.decode_intents(x))
-					truth_strings = np.array([self.model.one_hot_to_string(y_intent[i],self.model.Sy_intent) for i in range(batch_size)])
-					test_intent_acc += (guess_strings == truth_strings).mean() * batch_size
-					print("acc: " + str((guess_strings == truth_strings).mean()))
-					print("guess: " + guess_strings[0])
-					print("truth: " + truth_strings[0])
+					metrics["decoded_acc"] = self.decoded_accuracy(idx, x, y_intent.cpu())
 
 				# Note(Sid, Vijay, Alissa):
 				# This evaluation should always match end-to-end-SLU/models.py:821.
@@ -437,10 +730,10 @@ class Trainer:
 				complete_path_filter.extend(x_path[match])
 				complete_pred.extend(predicted_intent[match].cpu().numpy())
 				complete_y.extend(y_intent[match].cpu().numpy())
-
-			self.model.cuda(); self.model.is_cuda = True
-			test_intent_loss /= num_examples
-			test_intent_acc /= num_examples
+				return metrics
+			means = self.evaluate(dataset, batch_fn).means()
+			test_intent_loss = means["intent_loss"]
+			test_intent_acc = means["intent_acc"] + means.get("decoded_acc", 0)
 			results = {"intent_loss" : test_intent_loss, "intent_acc" : test_intent_acc, "set": "valid"}
 			self.log(results)
 			df=pd.DataFrame({'audio path': complete_path_filter,'prediction': complete_pred,'correct label': complete_y})